@@ -1,7 +1,7 @@
 from dotenv import load_dotenv  # NEW
 
 load_dotenv(override=False)  # NEW – read .env if present, but don't clobber real env
-from flask import Flask, render_template, request, send_from_directory
+from flask import Flask, render_template, request, send_from_directory, url_for
 import docx
 import fitz  # PyMuPDF
 
@@ -17,12 +17,22 @@ try:  # NEW — optional OCR deps
 except Exception:
     pytesseract = None
     Image = None
+try:  # optional exact BPE token counts
+    import tiktoken
+except Exception:
+    tiktoken = None
+try:  # optional faster JSON (run meta, form fields)
+    import orjson
+except Exception:
+    orjson = None
 from pptx import Presentation
 from striprtf.striprtf import rtf_to_text
 from openai import OpenAI
+import gzip
 import hashlib
-from flask import g, Response
+from flask import g, Response, Request
 import unicodedata
+import sys
 import math
 import random
 from werkzeug.utils import secure_filename
@@ -30,18 +40,20 @@ from uuid import uuid4
 from threading import Lock
 import json
 import zipfile
+import xml.etree.ElementTree as ET
 import time
-from collections import deque
+from collections import OrderedDict, deque
+from functools import lru_cache
 import logging
 import re
 import shutil, subprocess, tempfile, os
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from threading import BoundedSemaphore
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import count, islice
 import os
 
 os.environ["APP_ENABLE_OCR"] = "1"  # Force enable OCR
 _TEX_PAR = int(os.getenv("APP_TEX_PARALLEL", "1"))
-_TEX_SEM = BoundedSemaphore(max(1, _TEX_PAR))
+_TEX_POOL = ThreadPoolExecutor(max_workers=max(1, _TEX_PAR), thread_name_prefix="tectonic")
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s %(levelname)s %(name)s: %(message)s"
@@ -53,22 +65,35 @@ PROGRESS_MAX_ENTRIES = 2000
 
 
 def _prune_progress():
+    # PROGRESS is kept in last-update order (set_progress moves each job to the end),
+    # so the oldest entries are always at the front and no sort is needed.
     now = int(time.time())
     with PROGRESS_LOCK:
-        if len(PROGRESS) > PROGRESS_MAX_ENTRIES:
-            # drop oldest half
-            items = sorted(PROGRESS.items(), key=lambda kv: kv[1].get("ts", 0))
-            for k, _ in items[: len(items) // 2]:
-                PROGRESS.pop(k, None)
-        # TTL pass
-        dead = [k for k, v in PROGRESS.items() if (now - int(v.get("ts", now))) > PROGRESS_TTL_SEC]
-        for k in dead:
-            PROGRESS.pop(k, None)
+        # one walk from the front: drop the oldest half when over the cap, then keep
+        # going while entries are past their TTL
+        excess = len(PROGRESS) // 2 if len(PROGRESS) > PROGRESS_MAX_ENTRIES else 0
+        while PROGRESS:
+            k, v = next(iter(PROGRESS.items()))
+            if excess <= 0 and (now - int(v.get("ts", now))) <= PROGRESS_TTL_SEC:
+                break
+            del PROGRESS[k]
+            excess -= 1
+    # cancel marks age out on the same TTL/cap (dict is in cancel order, oldest first)
+    with CANCELED_LOCK:
+        excess = len(CANCELED_JOBS) // 2 if len(CANCELED_JOBS) > PROGRESS_MAX_ENTRIES else 0
+        while CANCELED_JOBS:
+            k, ts = next(iter(CANCELED_JOBS.items()))
+            if excess <= 0 and (now - ts) <= PROGRESS_TTL_SEC:
+                break
+            del CANCELED_JOBS[k]
+            excess -= 1
 
 
 # --- AI LaTeX repair ---
 
 _TECTONIC_CMD = None
+_TECTONIC_BIN = None
+_TECTONIC_PROBE_LOCK = Lock()
 
 # --- Stage 13: security & rate limits (env-togglable) ---
 BASIC_AUTH_ENABLED = os.getenv("APP_BASIC_AUTH", "0") in ("1", "true", "yes")
@@ -80,18 +105,81 @@ RATE_UPLOADS_PER_MIN = int(os.getenv("APP_RATE_UPLOADS_PER_MIN", "6"))  # POST /
 RATE_STATUS_PER_10S = int(os.getenv("APP_RATE_STATUS_PER_10S", "50"))  # GET /status
 RATE_DOWNLOADS_PER_MIN = int(os.getenv("APP_RATE_DOWNLOADS_PER_MIN", "60"))  # GET /download/*
 
+# Response headers (conservative, CSP omitted to avoid breaking inline scripts/styles)
+_SECURITY_HEADERS = {
+    "X-Content-Type-Options": "nosniff",
+    "X-Frame-Options": "DENY",
+    "Referrer-Policy": "strict-origin-when-cross-origin",
+    "Permissions-Policy": "geolocation=(), microphone=(), camera=()",
+}
+_SECURITY_HEADER_ITEMS = tuple((k.lower(), k, v) for k, v in _SECURITY_HEADERS.items())
+_NO_STORE_PREFIXES = ("/upload", "/status")  # avoid caching on sensitive routes
+_NO_STORE_HEADERS = {"Cache-Control": "no-store", "Pragma": "no-cache", "Expires": "0"}
+_PROBE_PATHS = frozenset(("/healthz", "/readyz"))
+STATIC_MAX_AGE_SEC = 365 * 24 * 3600
+
+# Request ids are for log correlation only: a random per-process prefix plus a counter
+_RID_PREFIX = uuid4().hex[:8]
+_RID_SEQ = count()
+
+
+def _reset_request_ids():
+    # forked workers (gunicorn --preload) must not share the parent's prefix
+    global _RID_PREFIX, _RID_SEQ
+    _RID_PREFIX = uuid4().hex[:8]
+    _RID_SEQ = count()
+
+
+os.register_at_fork(after_in_child=_reset_request_ids)
+
+# Striped locks: one shard set per bucket so /status polling never blocks /upload admission
+_RL_STRIPES = 16
+
+
+class TokenBucket:
+    """Per-key token bucket: capacity `cap`, refilled continuously over `window` seconds."""
+    __slots__ = ("cap", "rate", "window", "table", "locks")
+
+    def __init__(self, cap: int, window: float):
+        self.cap = float(cap)
+        self.rate = cap / window
+        self.window = window
+        self.table = {}  # key -> [tokens, last_refill]
+        self.locks = [Lock() for _ in range(_RL_STRIPES)]
+
+    def allow(self, key: str) -> bool:
+        now = time.monotonic()
+        with self.locks[hash(key) & (_RL_STRIPES - 1)]:
+            st = self.table.get(key)
+            if st is None:
+                st = self.table[key] = [self.cap, now]
+            tokens = min(self.cap, st[0] + (now - st[1]) * self.rate)
+            st[1] = now
+            if tokens >= 1.0:
+                st[0] = tokens - 1.0
+                return True
+            st[0] = tokens
+            return False
+
+    def prune(self, now: float) -> None:
+        """Drop keys idle for over two windows (a refilled bucket carries no state)."""
+        horizon = 2 * self.window
+        for key in list(self.table):
+            with self.locks[hash(key) & (_RL_STRIPES - 1)]:
+                st = self.table.get(key)
+                if st is not None and (now - st[1]) > horizon:
+                    del self.table[key]
+
+
+# view endpoint -> bucket, checked in before_request (/upload admits itself so it can fail_progress)
+_EP_LIMITS = {"status": "status", "download": "download", "download_manifest": "download"}
+
 # Internal buckets
 _RL = {
-    "upload": {},  # ip -> deque[timestamps]
-    "status": {},
-    "download": {},
-}
-_RL_WINDOW = {
-    "upload": 60.0,
-    "status": 10.0,
-    "download": 60.0,
+    "upload": TokenBucket(RATE_UPLOADS_PER_MIN, 60.0),
+    "status": TokenBucket(RATE_STATUS_PER_10S, 10.0),
+    "download": TokenBucket(RATE_DOWNLOADS_PER_MIN, 60.0),
 }
-_RL_LOCK = Lock()
 UPLOAD_FS_LOCK = Lock()
 
 
@@ -134,6 +222,7 @@ ENABLE_OCR = os.getenv("APP_ENABLE_OCR", "1").lower() in ("1", "true", "yes")
 OCR_DPI = env_int("APP_OCR_DPI", 300)  # render DPI for OCR
 OCR_LANG = env_str("APP_OCR_LANG", "eng")  # tesseract language(s), e.g. "eng+deu"
 OCR_PAGE_LIMIT = env_int("APP_OCR_PAGE_LIMIT", PDF_PAGE_LIMIT)
+OCR_WORKERS = env_int("APP_OCR_WORKERS", 4)  # concurrent tesseract runs per PDF
 # DEBUG: Check OCR availability
 print(f"DEBUG: ENABLE_OCR = {ENABLE_OCR}")
 print(f"DEBUG: pytesseract = {pytesseract}")
@@ -145,30 +234,91 @@ if pytesseract is not None:
         print(f"DEBUG: tesseract error = {e}")
 
 
+def _run_tectonic(cmd: list[str], *, cwd: str | None = None, timeout: float | None = None,
+                  input: bytes | None = None):
+    """
+    Run one tectonic subprocess on the shared compile pool, waiting for a free slot.
+    (Compiles happen after all model calls are paid for, so they queue rather than fail.)
+    A pool slot is held only for the subprocess itself: callers do temp-dir setup and cleanup outside.
+    """
+    fut = _TEX_POOL.submit(subprocess.run, cmd, cwd=cwd, timeout=timeout, input=input,
+                           stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return fut.result()
+
+
+def _tectonic_path() -> str | None:
+    """Resolved tectonic binary; a hit is kept for the process, a miss is re-checked next time."""
+    global _TECTONIC_BIN
+    if _TECTONIC_BIN is None:
+        _TECTONIC_BIN = shutil.which("tectonic")
+    return _TECTONIC_BIN
+
+
+def _tectonic_argv(mode: str, td: str, tex_path: str) -> list[str]:
+    exe = _tectonic_path() or "tectonic"
+    if mode == "new":
+        return [exe, "-X", "compile", "--outdir", td, "--keep-logs", tex_path]
+    return [exe, tex_path, "--keep-logs"]
+
+
+def _tectonic_compile_in(td: str, tex_source: str, timeout: float) -> str:
+    """
+    Compile into td and return the PDF path. The V2 CLI reads the source from stdin ("-"),
+    so no .tex file is written; stdin jobs are named texput.*. The old CLI still gets a file.
+    """
+    mode = _detect_tectonic_cmd()
+    src = tex_source.encode("utf-8")
+    if mode == "new":
+        stem, stdin = "texput", src
+        cmd = _tectonic_argv(mode, td, "-")
+    else:
+        stem, stdin = "doc", None
+        tex_path = os.path.join(td, "doc.tex")
+        with open(tex_path, "wb") as f:
+            f.write(src)
+        cmd = _tectonic_argv(mode, td, tex_path)
+    proc = _run_tectonic(cmd, cwd=td, timeout=timeout, input=stdin)
+    pdf_path = os.path.join(td, stem + ".pdf")
+    if proc.returncode != 0 or not os.path.exists(pdf_path):
+        log_tail = ""
+        log_path = os.path.join(td, stem + ".log")
+        if os.path.exists(log_path):
+            with open(log_path, "r", encoding="utf-8", errors="ignore") as lf:
+                log_tail = lf.read()[-4000:]
+        raise RuntimeError(
+            "Tectonic failed.\n\n"
+            f"STDOUT:\n{proc.stdout.decode(errors='ignore')}\n\n"
+            f"STDERR:\n{proc.stderr.decode(errors='ignore')}\n\n"
+            f"LOG tail:\n{log_tail}\n\n"
+            f"Tried:\n{cmd}"
+        )
+    return pdf_path
+
+
 def _detect_tectonic_cmd():
     global _TECTONIC_CMD
     if _TECTONIC_CMD is not None:
         return _TECTONIC_CMD
-    if shutil.which("tectonic") is None:
+    if _tectonic_path() is None:
         raise RuntimeError("tectonic not found on PATH.")
-    td = tempfile.mkdtemp()
-    tex_path = os.path.join(td, "t.tex")
-    with open(tex_path, "w", encoding="utf-8") as f:
-        f.write("\\documentclass{article}\\begin{document}x\\end{document}")
-    try:
-        with _TEX_SEM:
-            proc = subprocess.run(
-                ["tectonic", "-X", "compile", "--outdir", td, tex_path],
-                stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=5
-            )
-        _TECTONIC_CMD = "new" if proc.returncode == 0 else "old"
-    except Exception:
-        _TECTONIC_CMD = "old"
-    finally:
+    # one probe per process: a burst of first compiles must not each spend a pool slot on it
+    with _TECTONIC_PROBE_LOCK:
+        if _TECTONIC_CMD is not None:
+            return _TECTONIC_CMD
+        td = tempfile.mkdtemp()
+        tex_path = os.path.join(td, "t.tex")
+        with open(tex_path, "w", encoding="utf-8") as f:
+            f.write("\\documentclass{article}\\begin{document}x\\end{document}")
         try:
-            shutil.rmtree(td, ignore_errors=True)
+            proc = _run_tectonic([_tectonic_path(), "-X", "compile", "--outdir", td, tex_path], timeout=5)
+            _TECTONIC_CMD = "new" if proc.returncode == 0 else "old"
         except Exception:
-            pass
+            _TECTONIC_CMD = "old"
+        finally:
+            try:
+                shutil.rmtree(td, ignore_errors=True)
+            except Exception:
+                pass
     return _TECTONIC_CMD
 
 
@@ -235,6 +385,12 @@ ERR.update({
     "rl_status": "Too many status checks; please slow down.",
     "rl_download": "Rate limit exceeded for downloads. Please wait a moment and try again.",
 })
+_ERR_BYTES = {k: v.encode("utf-8") for k, v in ERR.items()}  # encoded once for hot rejections
+
+
+def _err_response(key: str, status: int) -> Response:
+    # a fresh Response each time (after_request hooks mutate headers); only the body bytes are shared
+    return Response(_ERR_BYTES[key], status=status, mimetype="text/html")
 
 _HEADER_PREFIX_RE = re.compile(r"""(?ix)
     ^\s*
@@ -256,9 +412,9 @@ _HEADER_PREFIX_RE = re.compile(r"""(?ix)
 def chunk_items_by_tokens(items: list[str], max_input_tokens: int) -> list[list[str]]:
     """Greedily pack numbered items into batches without exceeding max_input_tokens."""
     batches, cur, cur_tok = [], [], 0
-    for it in items:
-        # cost for item content plus numbering/glue
-        t = fast_token_estimate(it) + 6
+    # cost for item content plus numbering/glue (~3.8 chars/token, the same fallback token_counts uses)
+    costs = [(len(it) * 10) // 38 + 6 for it in items]
+    for t, it in zip(costs, items):
         if cur and (cur_tok + t) > max_input_tokens:
             batches.append(cur);
             cur, cur_tok = [], 0
@@ -278,12 +434,11 @@ def strip_category_header_prefix(item: str) -> str:
     return (prefix + rest).lstrip()
 
 
-def strip_headers_from_items(items: list[str]) -> list[str]:
-    return [strip_category_header_prefix(it) for it in items]
+_RENUMBER_RE = re.compile(r'(?m)^\s*(\d+)[\)\-:]\s+')
 
 
 def normalize_numbering(s: str) -> str:
-    s = re.sub(r'(?m)^\s*(\d+)[\)\-:]\s+', r'\1. ', s)
+    s = _RENUMBER_RE.sub(r'\1. ', s)
     s = re.sub(r'(?<!\n)\s+(\d+\.\s+)', r'\n\1', s)
     return s
 
@@ -292,10 +447,10 @@ _SPLIT_RE = re.compile(r'(?m)^\s*\d+[\.\)]\s+')
 
 
 def split_numbered_items(s: str) -> list[str]:
-    s = re.sub(r'(?m)^\s*(\d+)[\)\-:]\s+', r'\1. ', s)
+    """Split a numbered list into items, dropping any category header prefix from each."""
+    s = _RENUMBER_RE.sub(r'\1. ', s)
     parts = _SPLIT_RE.split(s)
-    items = [p.strip() for p in parts if p.strip()]
-    return items
+    return [strip_category_header_prefix(p) for p in map(str.strip, parts) if p]
 
 
 def clamp_items(items: list[str], n: int) -> list[str]:
@@ -367,81 +522,133 @@ FRACTIONS = {
 
 SUPERS = dict(zip("⁰¹²³⁴⁵⁶⁷⁸⁹⁺⁻⁼⁽⁾", "0123456789+-=()"))
 SUBS = dict(zip("₀₁₂₃₄₅₆₇₈₉₊₋₌₍₎", "0123456789+-=()"))
+_SUP_TABLE = str.maketrans(SUPERS)
+_SUB_TABLE = str.maketrans(SUBS)
 
 # ----- math/no-math segmentation -----
 _MATH_SEGMENT_PATTERN = re.compile(
-    r'(\\\[(?:.|\n)+?\\\])'  # \[...\]
-    r'|(\\\((?:.|\n)+?\\\))'  # \(...\)
-    r'|(\$\$(?:.|\n)+?\$\$)'  # $$...$$
-    r'|(\$(?:.|\n)+?\$)',  # $...$
-    re.MULTILINE
+    r'(\\\[.+?\\\])'  # \[...\]
+    r'|(\\\(.+?\\\))'  # \(...\)
+    r'|(\$\$.+?\$\$)'  # $$...$$
+    r'|(\$.+?\$)',  # $...$
+    re.DOTALL
 )
 
-def _transform_inside_math(tex: str, fn_disp_and_inl):
-    def repl_disp(m):
-        inner = m.group(1)
-        return r'\[' + fn_disp_and_inl(inner) + r'\]'
+# next \[ or \( opener; closers are then located with str.find, so each segment is scanned once
+_MATH_OPEN_RE = re.compile(r'\\[\[(]')
+
+
+def _rewrite_math_segments(tex: str, fn, display: bool) -> str:
+    """
+    Apply fn to the body of every \\(...\\) (and \\[...\\] when display) in one left-to-right scan.
+    Equivalent to one pass of the lazy alternation \\[(.+?)\\]|\\((.+?)\\) (DOTALL): whichever opener
+    comes first claims the text up to its nearest closer, and fn sees each segment once.
+    The old code did two passes (all display math, then inline math over the result), so output
+    differs only when the delimiters are interleaved or nested: e.g. in \\( a \\[ b \\) c \\] the
+    inline segment wins here, where the two-pass version rewrote the display span first, and an
+    inline segment inside display math is no longer rewritten a second time.
+    """
+    find = tex.find
+    search = _MATH_OPEN_RE.search if display else None
+    out, last, pos = [], 0, 0
+    unclosed = set()  # closers known to be absent from here on (keeps unclosed openers linear)
+    while True:
+        if search is not None:
+            m = search(tex, pos)
+            if m is None:
+                break
+            b = m.start()
+            opener, close = (r'\[', r'\]') if tex[b + 1] == '[' else (r'\(', r'\)')
+        else:
+            b = find(r'\(', pos)
+            if b < 0:
+                break
+            opener, close = r'\(', r'\)'
+        j = find(close, b + 3) if close not in unclosed else -1  # body is at least one character
+        if j < 0:
+            unclosed.add(close)
+            pos = b + 1
+            continue
+        out += (tex[last:b], opener, fn(tex[b + 2:j]), close)
+        last = pos = j + 2
+    if not out:
+        return tex
+    out.append(tex[last:])
+    return "".join(out)
 
-    def repl_inl(m):
-        inner = m.group(1)
-        return r'\(' + fn_disp_and_inl(inner) + r'\)'
 
-    tex = re.sub(r'\\\[(.+?)\\\]', repl_disp, tex, flags=re.S)
-    tex = re.sub(r'\\\((.+?)\\\)', repl_inl, tex, flags=re.S)
-    return tex  # NOTE: do NOT call _sanitize_tex_math() here
+def _transform_inside_math(tex: str, fn_disp_and_inl):
+    return _rewrite_math_segments(tex, fn_disp_and_inl, True)  # NOTE: do NOT call _sanitize_tex_math() here
 
 
 def _transform_inline_math_only(tex: str, fn_inl):
-    def repl_inl(m):
-        inner = m.group(1)
-        return r'\(' + fn_inl(inner) + r'\)'
+    return _rewrite_math_segments(tex, fn_inl, False)
+_SUP_SEQ_RE = re.compile(r"[⁰¹²³⁴⁵⁶⁷⁸⁹⁺⁻⁼⁽⁾]+")
+_SUB_SEQ_RE = re.compile(r"[₀₁₂₃₄₅₆₇₈₉₊₋₌₍₎]+")
+# √(expr) | √word | bare √, tried in that order at each √
+_SQRT_RE = re.compile(r"√(?:\s*\(([^)]+)\)|\s*([A-Za-z0-9]+)|(?=\s|$))")
 
-    return re.sub(r'\\\((.+?)\\\)', repl_inl, tex, flags=re.S)
-def _replace_super_sub_sequences(text: str) -> str:
-    def sup_repl(m):
-        mapped = "".join(SUPERS.get(ch, "") for ch in m.group(0))
-        return f"$^{{{mapped}}}$" if mapped else m.group(0)
 
-    def sub_repl(m):
-        mapped = "".join(SUBS.get(ch, "") for ch in m.group(0))
-        return f"$_{{{mapped}}}$" if mapped else m.group(0)
+def _sup_repl(m):
+    mapped = m.group(0).translate(_SUP_TABLE)
+    return f"$^{{{mapped}}}$" if mapped else m.group(0)
+
+
+def _sub_repl(m):
+    mapped = m.group(0).translate(_SUB_TABLE)
+    return f"$_{{{mapped}}}$" if mapped else m.group(0)
+
 
-    text = re.sub(r"[⁰¹²³⁴⁵⁶⁷⁸⁹⁺⁻⁼⁽⁾]+", sup_repl, text)
-    text = re.sub(r"[₀₁₂₃₄₅₆₇₈₉₊₋₌₍₎]+", sub_repl, text)
+def _replace_super_sub_sequences(text: str) -> str:
+    text = _SUP_SEQ_RE.sub(_sup_repl, text)
+    text = _SUB_SEQ_RE.sub(_sub_repl, text)
     return text
 
 
+def _sqrt_repl(m):
+    arg = m.group(1) or m.group(2)
+    return f"$\\sqrt{{{arg}}}$" if arg else r"$\sqrt{\quad}$"
+
+
 def _replace_sqrt(text: str) -> str:
-    text = re.sub(r"√\s*\(([^)]+)\)", lambda m: r"$\sqrt{%s}$" % m.group(1), text)
-    text = re.sub(r"√\s*([A-Za-z0-9]+)", lambda m: r"$\sqrt{%s}$" % m.group(1), text)
-    text = re.sub(r"√(?=\s|$)", lambda m: r"$\sqrt{\quad}$", text)
-    return text
+    return _SQRT_RE.sub(_sqrt_repl, text)
 
 
-def _limits_op(text: str, symbol: str, latex_cmd: str) -> str:
+# (symbol, latex_cmd) -> [(compiled pattern, replacement fn), ...], built on first use
+_LIMIT_PATS: dict[tuple[str, str], tuple] = {}
+
+
+def _limit_rules(symbol: str, latex_cmd: str) -> tuple:
     sym = re.escape(symbol)
-    pat1 = rf"{sym}\s*_\s*\{{([^}}]+)\}}\s*\^\s*\{{([^}}]+)\}}"
-    text = re.sub(pat1, lambda m: f"${latex_cmd}_{{{m.group(1)}}}^{{{m.group(2)}}}$", text)
-    pat2 = rf"{sym}\s*\^\s*\{{([^}}]+)\}}\s*_\s*\{{([^}}]+)\}}"
-    text = re.sub(pat2, lambda m: f"${latex_cmd}_{{{m.group(2)}}}^{{{m.group(1)}}}$", text)
-    pat3 = rf"{sym}\s*_\s*([A-Za-z0-9+\-*/\\().]+)\s*\^\s*([A-Za-z0-9+\-*/\\().]+)"
-    text = re.sub(pat3, lambda m: f"${latex_cmd}_{{{m.group(1)}}}^{{{m.group(2)}}}$", text)
-    pat4 = rf"{sym}\s*\^\s*([A-Za-z0-9+\-*/\\().]+)\s*_\s*([A-Za-z0-9+\-*/\\().]+)"
-    text = re.sub(pat4, lambda m: f"${latex_cmd}_{{{m.group(2)}}}^{{{m.group(1)}}}$", text)
-    pat5 = rf"{sym}([₀₁₂₃₄₅₆₇₈₉]+)([⁰¹²³⁴⁵⁶⁷⁸⁹]*)"
 
     def subscript_repl(m):
-        sub_chars = m.group(1)
-        sup_chars = m.group(2) if m.group(2) else ""
-        sub_normal = "".join(SUBS.get(ch, ch) for ch in sub_chars)
-        sup_normal = "".join(SUPERS.get(ch, ch) for ch in sup_chars)
+        sub_normal = m.group(1).translate(_SUB_TABLE)
+        sup_normal = (m.group(2) or "").translate(_SUP_TABLE)
         if sup_normal:
             return f"${latex_cmd}_{{{sub_normal}}}^{{{sup_normal}}}$"
         else:
             return f"${latex_cmd}_{{{sub_normal}}}$"
 
-    text = re.sub(pat5, subscript_repl, text)
-    text = re.sub(rf"\b{re.escape(symbol)}\b", lambda m: f"${latex_cmd}$", text)
+    return (
+        (re.compile(rf"{sym}\s*_\s*\{{([^}}]+)\}}\s*\^\s*\{{([^}}]+)\}}"),
+         lambda m: f"${latex_cmd}_{{{m.group(1)}}}^{{{m.group(2)}}}$"),
+        (re.compile(rf"{sym}\s*\^\s*\{{([^}}]+)\}}\s*_\s*\{{([^}}]+)\}}"),
+         lambda m: f"${latex_cmd}_{{{m.group(2)}}}^{{{m.group(1)}}}$"),
+        (re.compile(rf"{sym}\s*_\s*([A-Za-z0-9+\-*/\\().]+)\s*\^\s*([A-Za-z0-9+\-*/\\().]+)"),
+         lambda m: f"${latex_cmd}_{{{m.group(1)}}}^{{{m.group(2)}}}$"),
+        (re.compile(rf"{sym}\s*\^\s*([A-Za-z0-9+\-*/\\().]+)\s*_\s*([A-Za-z0-9+\-*/\\().]+)"),
+         lambda m: f"${latex_cmd}_{{{m.group(2)}}}^{{{m.group(1)}}}$"),
+        (re.compile(rf"{sym}([₀₁₂₃₄₅₆₇₈₉]+)([⁰¹²³⁴⁵⁶⁷⁸⁹]*)"), subscript_repl),
+        (re.compile(rf"\b{sym}\b"), lambda m: f"${latex_cmd}$"),
+    )
+
+
+def _limits_op(text: str, symbol: str, latex_cmd: str) -> str:
+    rules = _LIMIT_PATS.get((symbol, latex_cmd))
+    if rules is None:
+        rules = _LIMIT_PATS[(symbol, latex_cmd)] = _limit_rules(symbol, latex_cmd)
+    for pat, repl in rules:
+        text = pat.sub(repl, text)
     return text
 
 
@@ -451,7 +658,7 @@ def _client_ip():
     # honor common proxy header; take the first hop
     xff = request.headers.get("X-Forwarded-For", "")
     if xff:
-        return xff.split(",")[0].strip()
+        return xff.partition(",")[0].strip()
     return request.remote_addr or "0.0.0.0"
 
 
@@ -473,19 +680,25 @@ def _need_www_auth():
     )
 
 
-def _rate_allow(bucket: str, ip: str, max_count: int) -> bool:
-    """Simple sliding-window counter with per-endpoint windows."""
-    now = time.time()
-    win = _RL_WINDOW[bucket]
-    with _RL_LOCK:
-        dq = _RL[bucket].setdefault(ip, deque())
-        # drop old
-        while dq and (now - dq[0]) > win:
-            dq.popleft()
-        if len(dq) >= max_count:
-            return False
-        dq.append(now)
-        return True
+def _prune_rl():
+    now = time.monotonic()
+    for tb in _RL.values():
+        tb.prune(now)
+
+
+MAINTENANCE_INTERVAL_SEC = 5.0
+_last_maintenance = 0.0
+
+
+def _periodic_maintenance():
+    """Prune progress and rate-limit tables at most once per interval, not on every request."""
+    global _last_maintenance
+    now = time.monotonic()
+    if now - _last_maintenance < MAINTENANCE_INTERVAL_SEC:
+        return
+    _last_maintenance = now  # racing threads may both prune; both prunes are idempotent
+    _prune_progress()
+    _prune_rl()
 
 
 def get_difficulty_profile(difficulty: str):
@@ -519,69 +732,52 @@ def get_difficulty_profile(difficulty: str):
 
 
 # ---- NEW: malformed \frac fixers & backslash sanitizers ----
+_MALFORMED_FRAC_STEP1_RE = re.compile(r'\\frac\s*\{\s*\\text\s*\}\s*\{\s*([^{}]+)\s*\}\s*\{\s*\\text\s*\{\s*([^{}]+)\s*\}\s*\}')
+_MALFORMED_FRAC_STEP2_RE = re.compile(r'\\frac\s*\{\s*\\text\s*\}\s*\{\s*([^{}]+)\s*\}\s*\{\s*([^{}]+)\s*\}')
+_MALFORMED_FRAC_STEP3_RE = re.compile(r'\\frac\s*\{\s*([^{}]+)\s*\}\s*\{\s*([^{}]+)\s*\}\s*\{\s*[^{}]+\s*\}')
+_MALFORMED_FRAC_STEP4_RE = re.compile(r'\\frac\s+([^\s{}]+)\s+([^\s{}]+)')
+_MALFORMED_FRAC_STEP5_RE = re.compile(r'\\frac\s*\{\s*\\text\s*\{\s*\}\s*\}\s*\{\s*([^{}]+)\s*\}')
+_MALFORMED_FRAC_STEP6_RE = re.compile(r'\\text\s+([A-Za-z]+)')
+
+
 def _fix_malformed_frac_text(tex: str) -> str:
     """Clean rewrite to fix malformed fractions systematically."""
 
     def fix(inner: str) -> str:
         # STEP 1: Fix the most common problematic pattern first
         # Pattern: \frac{\text}{X}{\text{Y}} -> \frac{\text{X}}{\text{Y}}
-        inner = re.sub(
-            r'\\frac\s*\{\s*\\text\s*\}\s*\{\s*([^{}]+)\s*\}\s*\{\s*\\text\s*\{\s*([^{}]+)\s*\}\s*\}',
-            r'\\frac{\\text{\1}}{\\text{\2}}',
-            inner
-        )
+        inner = _MALFORMED_FRAC_STEP1_RE.sub(r'\\frac{\\text{\1}}{\\text{\2}}', inner)
 
         # STEP 2: Fix pattern with only one \text wrapper
         # Pattern: \frac{\text}{X}{Y} -> \frac{\text{X}}{\text{Y}}
-        inner = re.sub(
-            r'\\frac\s*\{\s*\\text\s*\}\s*\{\s*([^{}]+)\s*\}\s*\{\s*([^{}]+)\s*\}',
-            r'\\frac{\\text{\1}}{\\text{\2}}',
-            inner
-        )
+        inner = _MALFORMED_FRAC_STEP2_RE.sub(r'\\frac{\\text{\1}}{\\text{\2}}', inner)
 
         # STEP 3: Fix completely malformed fractions with 3+ arguments
         # Pattern: \frac{A}{B}{C} -> \frac{A}{B} (drop extra arguments)
-        inner = re.sub(
-            r'\\frac\s*\{\s*([^{}]+)\s*\}\s*\{\s*([^{}]+)\s*\}\s*\{\s*[^{}]+\s*\}',
-            r'\\frac{\1}{\2}',
-            inner
-        )
+        inner = _MALFORMED_FRAC_STEP3_RE.sub(r'\\frac{\1}{\2}', inner)
 
         # STEP 4: Fix fractions with missing braces
         # Pattern: \frac A B -> \frac{A}{B}
-        inner = re.sub(
-            r'\\frac\s+([^\s{}]+)\s+([^\s{}]+)',
-            r'\\frac{\1}{\2}',
-            inner
-        )
+        inner = _MALFORMED_FRAC_STEP4_RE.sub(r'\\frac{\1}{\2}', inner)
 
         # STEP 5: Fix empty \text{} commands
         # Pattern: \frac{\text{}}{\text{X}} -> \frac{1}{\text{X}}
-        inner = re.sub(
-            r'\\frac\s*\{\s*\\text\s*\{\s*\}\s*\}\s*\{\s*([^{}]+)\s*\}',
-            r'\\frac{1}{\1}',
-            inner
-        )
+        inner = _MALFORMED_FRAC_STEP5_RE.sub(r'\\frac{1}{\1}', inner)
 
         # STEP 6: Clean up any remaining malformed \text commands
         # Pattern: \text X -> \text{X}
-        inner = re.sub(
-            r'\\text\s+([A-Za-z]+)',
-            r'\\text{\1}',
-            inner
-        )
+        inner = _MALFORMED_FRAC_STEP6_RE.sub(r'\\text{\1}', inner)
 
         return inner.strip()
 
     return _transform_inside_math(tex, fix)
 
+_SLASH_FRAC_RE = re.compile(r'(?<![A-Za-z0-9_/])([A-Za-z0-9\\][A-Za-z0-9\\^_{}]{0,12})\s*/\s*([A-Za-z0-9\\][A-Za-z0-9\\^_{}]{0,12})(?![A-Za-z0-9_/])')
+
+
 def convert_slashes_only_inside_math(tex: str) -> str:
     def _fracify(inner: str) -> str:
-        return re.sub(
-            r'(?<![A-Za-z0-9_/])([A-Za-z0-9\\][A-Za-z0-9\\^_{}]{0,12})\s*/\s*([A-Za-z0-9\\][A-Za-z0-9\\^_{}]{0,12})(?![A-Za-z0-9_/])',
-            r'\\frac{\1}{\2}',
-            inner
-        )
+        return _SLASH_FRAC_RE.sub(r'\\frac{\1}{\2}', inner)
 
     return _transform_inside_math(tex, _fracify)
 
@@ -594,8 +790,14 @@ _MATH_MACRO_CORE = r'(?:' + '|'.join([
 ]) + r')'
 
 _MATHY_FRAGMENT = re.compile(
-    # A single-line fragment (stop before hard terminators) that contains a math macro
-    rf'(?P<frag>[^\n$]*\\{_MATH_MACRO_CORE}[^$.\n;:]*)'
+    rf"""
+    (?P<frag>
+        [^\n$]*                   # lead-in on the same line, never crossing existing math
+        \\{_MATH_MACRO_CORE}      # at least one math macro
+        [^$.\n;:]*                # greedy tail up to a hard terminator
+    )
+    """,
+    re.VERBOSE,
 )
 
 _DOLLAR_MATH = re.compile(r'\$(.+?)\$', re.S)
@@ -604,37 +806,41 @@ _DOLLAR_MATH = re.compile(r'\$(.+?)\$', re.S)
 _VEC_LIKE = r'(?:vec|hat|bar|tilde|overline|underline|dot|ddot|breve|check|grave|acute)'
 
 
+_VECLIKE_ARG1_RE = re.compile(rf'\\({_VEC_LIKE})\s*([A-Za-z])\b')
+_VECLIKE_ARG2_RE = re.compile(rf'\\({_VEC_LIKE})\s*\{{\s*\\({_VEC_LIKE})\s*([A-Za-z])\s*\}}')
+
+
 def _fix_veclike_args_in_math(tex: str) -> str:
     r"""Ensure \vec x -> \vec{x}, \hat i -> \hat{i}, etc., and nest properly."""
 
     def fix(inner: str) -> str:
         # \vec x  -> \vec{x}  (and similar for other macros)
-        inner = re.sub(rf'\\({_VEC_LIKE})\s*([A-Za-z])\b', r'\\\1{\2}', inner)
+        inner = _VECLIKE_ARG1_RE.sub(r'\\\1{\2}', inner)
         # \vec{\vec x} -> \vec{\vec{x}}  (rare, but makes braces explicit)
-        inner = re.sub(rf'\\({_VEC_LIKE})\s*\{{\s*\\({_VEC_LIKE})\s*([A-Za-z])\s*\}}',
-                       r'\\\1{\\\2{\3}}', inner)
+        inner = _VECLIKE_ARG2_RE.sub(r'\\\1{\\\2{\3}}', inner)
         return inner
 
     return _transform_inside_math(tex, fix)
 
 
+_FRAC_FORM1_RE = re.compile(r'\\frac\s+([^\s{}]+)\s+([^\s{}]+)')
+_FRAC_FORM2_RE = re.compile(rf'\\frac\s*\{{\s*([^{{}}]*\\(?:{_VEC_LIKE}))\s*\}}\s*\{{\s*([^{{}}]+)\s*\}}\s*\{{\s*([^{{}}]+)\s*\}}')
+_FRAC_FORM3_RE = re.compile(r'\\frac\s*\{\s*([^{}]+)\s*\}\s*\{\s*([^{}]+)\s*\}\s*\{\s*([^{}]+)\s*\}')
+
+
 def _fix_frac_forms_in_math(tex: str) -> str:
     """Normalize various broken \frac forms to exactly two arguments."""
 
     def fix(inner: str) -> str:
         # 1) Whitespace form: \frac a b  -> \frac{a}{b}
-        inner = re.sub(r'\\frac\s+([^\s{}]+)\s+([^\s{}]+)', r'\\frac{\1}{\2}', inner)
+        inner = _FRAC_FORM1_RE.sub(r'\\frac{\1}{\2}', inner)
 
         # 2) Triple-arg form where first arg ends with a vec-like macro needing an argument:
         #    \frac{d\vec}{r}{dt} -> \frac{d\vec{r}}{dt}
-        inner = re.sub(
-            rf'\\frac\s*\{{\s*([^{{}}]*\\(?:{_VEC_LIKE}))\s*\}}\s*\{{\s*([^{{}}]+)\s*\}}\s*\{{\s*([^{{}}]+)\s*\}}',
-            r'\\frac{\1{\2}}{\3}', inner)
+        inner = _FRAC_FORM2_RE.sub(r'\\frac{\1{\2}}{\3}', inner)
 
         # 3) Generic triple-arg fallback: \frac{A}{B}{C} -> \frac{A}{B} (drop 3rd to avoid runaway)
-        inner = re.sub(
-            r'\\frac\s*\{\s*([^{}]+)\s*\}\s*\{\s*([^{}]+)\s*\}\s*\{\s*([^{}]+)\s*\}',
-            r'\\frac{\1}{\2}', inner)
+        inner = _FRAC_FORM3_RE.sub(r'\\frac{\1}{\2}', inner)
 
         # 4) Very common slip: "\frac{something" with missing closing }... try to close up to end of group
         #    Heuristic: add a } if we see an opening { without a close before a delimiter.
@@ -644,6 +850,10 @@ def _fix_frac_forms_in_math(tex: str) -> str:
     return _transform_inside_math(tex, fix)
 
 
+_TEXT_MACRO1_RE = re.compile(r'\\text\s+([A-Za-z]+(?:\s+[A-Za-z]+)?)')
+_TEXT_MACRO2_RE = re.compile(r'\\frac\s*\{\s*\\text\s*\}\s*(\{)')
+
+
 def _fix_text_macros_in_math(tex: str) -> str:
     """
     Ensure \text has a braced argument inside math and repair the very common slips:
@@ -653,10 +863,10 @@ def _fix_text_macros_in_math(tex: str) -> str:
 
     def fix(inner: str) -> str:
         # 1) \text dm  -> \text{dm}       (single or two-word tokens)
-        inner = re.sub(r'\\text\s+([A-Za-z]+(?:\s+[A-Za-z]+)?)', r'\\text{\1}', inner)
+        inner = _TEXT_MACRO1_RE.sub(r'\\text{\1}', inner)
 
         # 2) \frac{\text}{...}  -> \frac{\text{}}{...}  (balances braces so later frac normalizers can run)
-        inner = re.sub(r'\\frac\s*\{\s*\\text\s*\}\s*(\{)', r'\\frac{\\text{}}\\1', inner)
+        inner = _TEXT_MACRO2_RE.sub(r'\\frac{\\text{}}\\1', inner)
 
         return inner
 
@@ -682,12 +892,71 @@ def adaptive_summary_length(file_tokens: int, target_summary_tokens: int, conten
         return target_summary_tokens
 
 
+# Small files share one summary call: each bullet carries its file's [F{tag}], so the reply splits cleanly
+SUMMARY_BATCH_SMALL_FILE = env_int("APP_SUM_BATCH_SMALL", 1500)  # files under this many tokens may be batched
+SUMMARY_BATCH_MAX_TOKENS = env_int("APP_SUM_BATCH_TOKENS", 6000)  # raw input tokens per batched call
+_TAGGED_BULLET_RE = re.compile(r'^\s*(?:[-*\u2022]|\d+[.)])?\s*\[F(\d+)\]\s*(.*)$')
+_SUMMARY_HEADER_RE = re.compile(r'^[\s#=*]*\[?F(\d+)\]?[\s#=*:]*$')
+_ANY_BULLET_RE = re.compile(r'^\s*(?:[-*\u2022]|\d+[.)])\s+(.+)$')
+
+
+def pack_summary_batches(file_tokens: list[int], small_max: int = SUMMARY_BATCH_SMALL_FILE,
+                         batch_max: int = SUMMARY_BATCH_MAX_TOKENS) -> list[list[int]]:
+    """Group file positions for summarization: large files alone, small files greedily packed up to batch_max."""
+    groups, cur, cur_tok = [], [], 0
+    for i, t in enumerate(file_tokens):
+        if t >= small_max:
+            groups.append([i])
+            continue
+        if cur and cur_tok + t > batch_max:
+            groups.append(cur)
+            cur, cur_tok = [], 0
+        cur.append(i)
+        cur_tok += t
+    if cur:
+        groups.append(cur)
+    return groups
+
+
+def split_batched_summary(text: str, tags: list[int]) -> dict[int, str]:
+    """
+    Route the bullets of a batched summary reply back to their files by [F{tag}].
+    Files with no tagged bullets fall back to the untagged bullets under their own header;
+    a file can still come back empty, in which case the caller summarizes it alone.
+    """
+    tagged = {t: [] for t in tags}
+    under_header = {t: [] for t in tags}
+    current = None
+    for ln in (text or "").splitlines():
+        m = _SUMMARY_HEADER_RE.match(ln)
+        if m:
+            current = int(m.group(1)) if int(m.group(1)) in tagged else None
+            continue
+        m = _TAGGED_BULLET_RE.match(ln)
+        if m and int(m.group(1)) in tagged:
+            if m.group(2):
+                tagged[int(m.group(1))].append(f"- [F{m.group(1)}] {m.group(2).strip()}")
+            continue
+        m = _ANY_BULLET_RE.match(ln)
+        if m and current is not None:
+            under_header[current].append(f"- [F{current}] {m.group(1).strip()}")
+    return {t: "\n".join(tagged[t] or under_header[t]) for t in tags}
+
+
 # =========================
 # Normalization helpers
 # =========================
+@lru_cache(maxsize=1)
+def _combining_marks_table() -> dict:
+    """str.translate table deleting every combining mark (built once, on first non-ASCII input)."""
+    return {cp: None for cp in range(sys.maxunicode + 1) if unicodedata.combining(chr(cp))}
+
+
 def unicode_to_ascii(s):
-    normalized = unicodedata.normalize("NFKD", s)
-    return "".join(c for c in normalized if not unicodedata.combining(c))
+    if s.isascii():
+        return s  # nothing to decompose
+    # NFKD splits accents into combining marks; drop only those (symbols like √ or Greek letters stay)
+    return unicodedata.normalize("NFKD", s).translate(_combining_marks_table())
 # =========================
 # Latency models
 # =========================
@@ -706,14 +975,19 @@ def t_non_model_seconds(n_files: int, total_raw_tokens: int, total_questions: in
 # =========================
 # Q/A token estimators
 # =========================
+# base + per-item tokens, columns ordered (Long, Short, MCQ, Math)
+TOK_Q_BASE, TOK_Q_PER_ITEM = 20, (180, 80, 120, 240)
+TOK_A_BASE, TOK_A_PER_ITEM = 15, (150, 50, 20, 220)
+
+
 def estimate_tokens_main_questions(n_long: int, n_short: int, n_mcq: int, n_math: int) -> int:
-    BASE, TOK_LONG, TOK_SHORT, TOK_MCQ, TOK_MATH = 20, 180, 80, 120, 240
-    return int(BASE + TOK_LONG * n_long + TOK_SHORT * n_short + TOK_MCQ * n_mcq + TOK_MATH * n_math)
+    TOK_LONG, TOK_SHORT, TOK_MCQ, TOK_MATH = TOK_Q_PER_ITEM
+    return int(TOK_Q_BASE + TOK_LONG * n_long + TOK_SHORT * n_short + TOK_MCQ * n_mcq + TOK_MATH * n_math)
 
 
 def estimate_tokens_main_answers(n_long: int, n_short: int, n_mcq: int, n_math: int) -> int:
-    BASE, TOK_LONG, TOK_SHORT, TOK_MCQ, TOK_MATH = 15, 150, 50, 20, 220
-    return int(BASE + TOK_LONG * n_long + TOK_SHORT * n_short + TOK_MCQ * n_mcq + TOK_MATH * n_math)
+    TOK_LONG, TOK_SHORT, TOK_MCQ, TOK_MATH = TOK_A_PER_ITEM
+    return int(TOK_A_BASE + TOK_LONG * n_long + TOK_SHORT * n_short + TOK_MCQ * n_mcq + TOK_MATH * n_math)
 
 
 # =========================
@@ -734,9 +1008,9 @@ LOWER = 40.0
 UPPER = 50.0
 
 
-def estimate_compile_seconds() -> float:
-    # Empirical, conservative for two Tectonic runs in parallel
-    return 5.0
+# Empirical, conservative for two Tectonic runs in parallel
+_COMPILE_SECONDS = 5.0
+_SUM_BUDGET_MIN_S, _SUM_BUDGET_MAX_S = 4.0, 35.0  # was max 25.0
 
 def plan_summarization_sla(
         timings_so_far: dict,
@@ -749,11 +1023,14 @@ def plan_summarization_sla(
         hard_min: int = 150,  # Reduced from 200
         hard_max: int = 1200  # Increased from 800 for longer summaries when needed
 ):
-    T_nonmodel = sum(timings_so_far.get(k, 0.0) for k in ("ingest_write", "preprocess", "token_count"))
+    t = timings_so_far
+    T_nonmodel = t.get("ingest_write", 0.0) + t.get("preprocess", 0.0) + t.get("token_count", 0.0)
     T_QA_pred = t_4o_latest_seconds(n_in_tokens=n_out_q_cap, n_out_tokens=n_out_a_cap)
-    T_compile = estimate_compile_seconds()
-
-    T_rem_for_sum = max(4.0, min(35.0, TARGET_MID - T_nonmodel - T_QA_pred - T_compile))  # was min(25.0, ...)
+    T_rem_for_sum = TARGET_MID - _COMPILE_SECONDS - T_nonmodel - T_QA_pred
+    if T_rem_for_sum < _SUM_BUDGET_MIN_S:
+        T_rem_for_sum = _SUM_BUDGET_MIN_S
+    elif T_rem_for_sum > _SUM_BUDGET_MAX_S:
+        T_rem_for_sum = _SUM_BUDGET_MAX_S
 
     K_parallel = choose_summary_parallelism(
         n_files, raw_avg_tokens, RECOMMENDED_SUMMARY_TOKENS,
@@ -767,10 +1044,15 @@ def plan_summarization_sla(
     return T_rem_for_sum, K_parallel, S_use
 
 
+def _summary_waves(n_files: int, K_parallel: int) -> int:
+    """Number of summary waves C = ceil(n_files / K) shared by the planners below."""
+    return -(-n_files // K_parallel)
+
+
 def break_even_raw_avg_tokens_per_file(n_files: int, K_parallel: int, S_summary_tokens_per_file: int) -> float:
     if n_files <= 0 or K_parallel <= 0:
         return float('inf')
-    C = math.ceil(n_files / K_parallel)
+    C = _summary_waves(n_files, K_parallel)
     alpha = (2.0 / 3.0) * (C / n_files)
     numerator = S_summary_tokens_per_file + (40_000 * C / n_files) * (0.5 + S_summary_tokens_per_file / 100.0)
     denominator = max(1e-9, (1.0 - alpha))
@@ -787,7 +1069,7 @@ def summary_tokens_cap_per_file(T_sum_budget_s: float, n_files: int, K_parallel:
                                 hard_max: int = SUMMARY_TOKENS_HARD_MAX) -> int:
     if n_files <= 0 or K_parallel <= 0:
         return hard_min
-    C = math.ceil(n_files / K_parallel)
+    C = _summary_waves(n_files, K_parallel)
     s_max = 100.0 * (T_sum_budget_s / C - 0.5 - raw_avg_tokens_per_file / 60_000.0)
     return int(max(hard_min, min(hard_max, math.floor(s_max))))
 
@@ -801,6 +1083,21 @@ def choose_summary_parallelism(n_files, raw_avg_tokens_per_file, S_summary_token
     return max(min_k, min(max_k, k))
 
 
+_MATH_STEP_PREFIX = (
+    "Match step counts by difficulty: easy 1, medium 3-4, hard 4–6 with linked subparts. "
+    "Prefer exact forms when sensible; avoid trivial plug-in.\n\n"
+)
+_MATH_FOCUS_HIGH = _MATH_STEP_PREFIX + (
+    "Note: This paper focuses primarily on mathematical calculations and problem-solving. "
+    "Emphasize formulas, procedures, computational techniques, and direct problem-solving. "
+    "Extract mathematical problems, worked examples, formulas, and calculation methods.\n\n"
+)
+_MATH_FOCUS_MIXED = _MATH_STEP_PREFIX + (
+    "Note: Include mathematical calculations and problem-solving questions. "
+    "Focus on formulas, procedures, and computational techniques alongside conceptual understanding.\n\n"
+)
+
+
 def enhance_math_content_for_questions(text_for_main: str, num_math: int, total_questions: int) -> str:
     """
     Lightly bias the input material toward computational/procedural content when Math items are requested.
@@ -809,74 +1106,56 @@ def enhance_math_content_for_questions(text_for_main: str, num_math: int, total_
     if num_math <= 0 or total_questions <= 0:
         return text_for_main
 
-    math_ratio = num_math / total_questions
+    # math ratio > 0.5 / > 0.3, compared in integers
+    if num_math * 2 > total_questions:
+        return _MATH_FOCUS_HIGH + text_for_main
+    if num_math * 10 > total_questions * 3:
+        return _MATH_FOCUS_MIXED + text_for_main
+    return _MATH_STEP_PREFIX + text_for_main
 
-    prefix = (
-        "Match step counts by difficulty: easy 1, medium 3-4, hard 4–6 with linked subparts. "
-        "Prefer exact forms when sensible; avoid trivial plug-in.\n\n"
-    )
-
-    if math_ratio > 0.5:
-        note = (
-            "Note: This paper focuses primarily on mathematical calculations and problem-solving. "
-            "Emphasize formulas, procedures, computational techniques, and direct problem-solving. "
-            "Extract mathematical problems, worked examples, formulas, and calculation methods.\n\n"
-        )
-        return prefix + note + text_for_main
-    elif math_ratio > 0.3:
-        note = (
-            "Note: Include mathematical calculations and problem-solving questions. "
-            "Focus on formulas, procedures, and computational techniques alongside conceptual understanding.\n\n"
-        )
-        return prefix + note + text_for_main
 
-    return prefix + text_for_main
+# \sqrt x (group 1) or a \sqrt with no braced argument; an unmatched group 1 expands to ""
+_SQRT_ARG_RE = re.compile(r'\\sqrt(?:\s+([A-Za-z0-9+\-*/().])|(?!\s*\{))')
+# \frac{\sqrt}{A} with an optional {B} (group 2)
+_FRAC_SQRT_RE = re.compile(r'\\frac\s*\{\s*\\sqrt\s*\}\s*\{\s*([^{}]+)\s*\}(?:\s*\{\s*([^{}]+)\s*\})?')
 
 
 def _fix_sqrt_args_in_math(tex: str) -> str:
     """Ensure \\sqrt has a braced argument inside math."""
 
     def fix(inner: str) -> str:
-        # \sqrt x -> \sqrt{x}
-        inner = re.sub(r'\\sqrt\s+([A-Za-z0-9+\-*/().])', r'\\sqrt{\1}', inner)
-        # Bare \sqrt (no following { or token) -> \sqrt{}
-        inner = re.sub(r'\\sqrt(?!\s*\{)', r'\\sqrt{}', inner)
-        return inner
+        # \sqrt x -> \sqrt{x}; bare \sqrt (no following { or token) -> \sqrt{}
+        return _SQRT_ARG_RE.sub(r'\\sqrt{\1}', inner)
 
     return _transform_inside_math(tex, fix)
 
 
-def _fix_frac_sqrt_edgecases_in_math(tex: str) -> str:
-    r"""Repair \frac{\sqrt}{A}{B} and \frac{\sqrt}{A} edge cases inside math."""
+def _frac_sqrt_repl(m):
+    a, b = m.group(1), m.group(2)
+    if b is not None:
+        return r'\frac{\sqrt{' + a + '}}{' + b + '}'  # \frac{\sqrt}{A}{B} -> \frac{\sqrt{A}}{B}
+    return r'\sqrt{' + a + '}'  # \frac{\sqrt}{A} -> \sqrt{A} (no denominator present; best-effort)
 
-    def fix(inner: str) -> str:
-        # \frac{\sqrt}{A}{B} -> \frac{\sqrt{A}}{B}
-        inner = re.sub(
-            r'\\frac\s*\{\s*\\sqrt\s*\}\s*\{\s*([^{}]+)\s*\}\s*\{\s*([^{}]+)\s*\}',
-            r'\\frac{\\sqrt{\1}}{\2}', inner
-        )
-        # \frac{\sqrt}{A}  ->  \sqrt{A}   (no denominator present; best-effort)
-        inner = re.sub(
-            r'\\frac\s*\{\s*\\sqrt\s*\}\s*\{\s*([^{}]+)\s*\}',
-            r'\\sqrt{\1}', inner
-        )
-        return inner
 
-    return _transform_inside_math(tex, fix)
+def _fix_frac_sqrt_edgecases_in_math(tex: str) -> str:
+    r"""Repair \frac{\sqrt}{A}{B} and \frac{\sqrt}{A} edge cases inside math."""
+    return _transform_inside_math(tex, lambda inner: _FRAC_SQRT_RE.sub(_frac_sqrt_repl, inner))
 
 
 # --- Stage 10: downloads metadata -
 
 def _read_run_meta() -> dict | None:
     try:
+        if orjson is not None:
+            with open(META_PATH, "rb") as f:
+                return orjson.loads(f.read())
         with open(META_PATH, "r", encoding="utf-8") as f:
             return json.load(f)
     except Exception:
         return None
 
 
-def get_quality_answer_instruction():
-    return """Create a comprehensive mark scheme for this question paper.
+_QUALITY_ANSWER_INSTRUCTION = """Create a comprehensive mark scheme for this question paper.
 
 Quality Requirements:
 - Provide detailed marking criteria for each question
@@ -895,9 +1174,39 @@ Focus on accuracy and completeness over brevity.
 """
 
 
-def fast_token_estimate(text: str) -> int:
-    """Faster token estimation using character count heuristic"""
-    return len(text) // 3.8  # More accurate ratio for mixed content
+def get_quality_answer_instruction():
+    return _QUALITY_ANSWER_INSTRUCTION
+
+
+# Exact BPE counts only below this size; past it the char heuristic is close enough and O(1)
+TOKEN_EXACT_MAX_CHARS = env_int("APP_TOKEN_EXACT_MAX_CHARS", 200_000)
+TOKEN_ENCODER_RETRY_SEC = 300.0  # a failed tiktoken load (e.g. no network for the BPE file) is retried later
+_TOKEN_ENC = None
+_TOKEN_ENC_RETRY_AT = 0.0
+_TOKEN_ENC_LOCK = Lock()
+
+
+def _token_encoder():
+    """gpt-4o BPE encoder, or None when tiktoken (or its encoding file) is unavailable."""
+    global _TOKEN_ENC, _TOKEN_ENC_RETRY_AT
+    if _TOKEN_ENC is not None or tiktoken is None or time.monotonic() < _TOKEN_ENC_RETRY_AT:
+        return _TOKEN_ENC
+    with _TOKEN_ENC_LOCK:  # one thread loads (and maybe downloads) the encoding; the rest wait for it
+        if _TOKEN_ENC is None and time.monotonic() >= _TOKEN_ENC_RETRY_AT:
+            try:
+                _TOKEN_ENC = tiktoken.encoding_for_model("gpt-4o")
+            except Exception:
+                _TOKEN_ENC_RETRY_AT = time.monotonic() + TOKEN_ENCODER_RETRY_SEC
+        return _TOKEN_ENC
+
+
+def token_counts(texts: list[str]) -> list[int]:
+    """Token count per text: tiktoken when available (batch encoded in parallel), else ~3.8 chars/token."""
+    enc = _token_encoder()
+    if enc is None:
+        return [len(t) * 10 // 38 for t in texts]
+    encoded = iter(enc.encode_ordinary_batch([t for t in texts if len(t) <= TOKEN_EXACT_MAX_CHARS]))
+    return [len(next(encoded)) if len(t) <= TOKEN_EXACT_MAX_CHARS else len(t) * 10 // 38 for t in texts]
 
 
 def max_input_tokens_for_main_questions(
@@ -914,7 +1223,7 @@ def max_input_tokens_for_main_questions(
         T_sum_budget_s: float | None = None,
 ) -> int:
     T_nonmodel = t_non_model_seconds(n_files, total_raw_tokens, total_questions)
-    C = math.ceil(max(1, n_files) / max(1, n_summary_calls_parallel))
+    C = _summary_waves(max(1, n_files), max(1, n_summary_calls_parallel))
     per_file_sum_time = t_4o_mini_summary_seconds(raw_avg_tokens_per_file, S_summary_tokens_per_file)
     T_summaries = C * per_file_sum_time if n_files > 0 else 0.0
     if T_sum_budget_s is not None:
@@ -941,32 +1250,53 @@ def fail_progress(job: str, *, pct: int = 97, step: int | None = 5,
 
 # --- Stage 7: blueprint-driven mark scheme helpers ---
 
+def _spec_line(i: int, spec: tuple) -> str:
+    t, d, p = spec
+    parts = ["Type: " + t]
+    if d:
+        parts.append("Difficulty: " + d)
+    if p:
+        parts.append("Additional instructions: " + p)
+    return f"Item {i}: {'; '.join(parts)}"
+
+
+def _bp_spec_key(blueprint: list[dict]) -> tuple:
+    """Hashable view of the blueprint fields the spec lines depend on."""
+    return tuple((it.get("type", "Long"), it.get("difficulty"), it.get("topic")) for it in blueprint)
+
+
+@lru_cache(maxsize=64)
+def _spec_lines_for(spec_key: tuple) -> tuple[str, ...]:
+    return tuple(_spec_line(i, spec) for i, spec in enumerate(spec_key, 1))
+
+
+def precompute_spec_lines(blueprint: list[dict]) -> list[str]:
+    """All per-item spec lines for a blueprint; continuation prompts slice windows out of this."""
+    return list(_spec_lines_for(_bp_spec_key(blueprint)))
+
+
 def _per_item_answer_spec_lines(blueprint: list[dict], start_idx: int = 1, end_idx: int | None = None) -> str:
     """Reference lines to remind the model of each item's Type/Additional instructions/Difficulty."""
     if end_idx is None:
         end_idx = len(blueprint)
-    out = []
-    for i in range(start_idx, end_idx + 1):
-        it = blueprint[i - 1]
-        parts = [f"Type: {it.get('type', 'Long')}"]
-        if it.get("difficulty"):
-            parts.append(f"Difficulty: {it['difficulty']}")
-        if it.get("topic"):
-            parts.append(f"Additional instructions: {it['topic']}")
-        out.append(f"Item {i}: " + "; ".join(parts))
-    return "\n".join(out)
+    return "\n".join(_spec_lines_for(_bp_spec_key(blueprint))[start_idx - 1:end_idx])
 
 
 def get_quality_answer_instruction_from_blueprint(blueprint: list[dict]) -> str:
     """Wrap your existing answer instruction with a strict 1..N alignment note + per-item refs."""
-    N = len(blueprint)
+    return _quality_answer_instruction_for(_bp_spec_key(blueprint))
+
+
+@lru_cache(maxsize=64)
+def _quality_answer_instruction_for(spec_key: tuple) -> str:
+    N = len(spec_key)
     base = get_quality_answer_instruction()  # reuse your detailed guidance
     return (
         f"{base}\n"
         f"\nStructure:\n"
         f"- Provide answers for items 1..{N} exactly (no extra items, no missing items)\n"
         f"- Number each answer to match the question paper\n"
-        f"\nPer-item reference:\n{_per_item_answer_spec_lines(blueprint)}\n"
+        f"\nPer-item reference:\n{chr(10).join(_spec_lines_for(spec_key))}\n"
     )
 
 
@@ -976,9 +1306,13 @@ def continue_mark_scheme_from_blueprint(
         end_idx: int,
         questions_text: str,
         blueprint: list[dict],
+        spec_lines: list[str] | None = None,
 ) -> str:
     """Continuation prompt that preserves numbering and uses the per-item plan."""
-    subplan = _per_item_answer_spec_lines(blueprint, start_idx, end_idx)
+    if spec_lines is not None:
+        subplan = "\n".join(spec_lines[start_idx - 1:end_idx])
+    else:
+        subplan = _per_item_answer_spec_lines(blueprint, start_idx, end_idx)
     return f"""Continue the mark scheme by writing items {start_idx} to {end_idx} ONLY.
 
 Rules:
@@ -1004,15 +1338,19 @@ Previous mark scheme items:
 # =========================
 UPLOAD_DIR = "uploads"
 OUTPUT_DIR = "generated"
-PROGRESS = {}
+PROGRESS = OrderedDict()  # job -> state, oldest update first
 PROGRESS_LOCK = Lock()
-CANCELED_JOBS = set()
+CANCELED_JOBS = {}  # job -> cancel time, oldest first; writes under CANCELED_LOCK, membership reads need no lock
 CANCELED_LOCK = Lock()
 
 
 def is_canceled(job: str) -> bool:
+    return job in CANCELED_JOBS
+
+
+def mark_canceled(job: str) -> None:
     with CANCELED_LOCK:
-        return job in CANCELED_JOBS
+        CANCELED_JOBS.setdefault(job, int(time.time()))
 
 
 META_PATH = os.path.join(OUTPUT_DIR, "_meta.json")
@@ -1024,29 +1362,43 @@ def _write_run_meta(mode: str, title: str, available: list[str], extra: dict | N
         "mode": mode,  # "exam"
         "title": (title or "").strip(),
         "available": sorted(set(available)),  # e.g. ["answers"] or ["questions","answers"]
-        "timestamp": int(__import__("time").time())
+        "timestamp": int(time.time())
     }
     if extra:
         meta.update(extra)
     try:
-        with open(META_PATH, "w", encoding="utf-8") as f:
-            json.dump(meta, f, ensure_ascii=False, indent=2)
+        if orjson is not None:
+            with open(META_PATH, "wb") as f:
+                f.write(orjson.dumps(meta, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+        else:
+            with open(META_PATH, "w", encoding="utf-8") as f:
+                json.dump(meta, f, ensure_ascii=False, indent=2)
     except Exception:
         pass  # non-fatal
 
 
 def set_progress(job: str, pct: int, step: int | None = None, label: str | None = None, status: str = "running"):
-    """Monotonic %; safe to call many times."""
+    """
+    Monotonic %; safe to call many times.
+    Each update stores a fresh state dict, so readers can PROGRESS.get() without the lock;
+    a call that would change nothing within the same second skips the lock entirely.
+    """
     now = int(time.time())
+    pct = int(pct)
+    cur = PROGRESS.get(job)
+    if (cur is not None and cur["ts"] == now and cur["status"] == status and cur["pct"] >= pct
+            and (step is None or cur["step"] == step) and (label is None or cur["label"] == label)):
+        return
     with PROGRESS_LOCK:
-        state = PROGRESS.setdefault(job, {"pct": 0, "step": 0, "label": "", "status": "running", "ts": now})
-        state["pct"] = max(int(state.get("pct", 0)), int(pct))
-        if step is not None:
-            state["step"] = int(step)
-        if label is not None:
-            state["label"] = str(label)
-        state["status"] = status
-        state["ts"] = now
+        cur = PROGRESS.get(job) or {"pct": 0, "step": 0, "label": ""}
+        PROGRESS[job] = {
+            "pct": max(cur["pct"], pct),
+            "step": cur["step"] if step is None else int(step),
+            "label": cur["label"] if label is None else str(label),
+            "status": status,
+            "ts": now,
+        }
+        PROGRESS.move_to_end(job)
 
 
 # Stage 1: load OpenAI key from env (fail fast if missing)
@@ -1073,7 +1425,8 @@ Hard rules:
 
 def sanitize_latex_pair(client, questions_tex: str, answers_tex: str) -> tuple[str, str]:
         return questions_tex, answers_tex
-ALLOWED_EXTENSIONS = {".txt", ".pdf", ".docx", ".pptx", ".rtf"}
+ALLOWED_EXTENSIONS_ORDERED = (".txt", ".pdf", ".docx", ".pptx", ".rtf")  # display order on the upload page
+ALLOWED_EXTENSIONS = frozenset(ALLOWED_EXTENSIONS_ORDERED)
 VALID_MODES = {"exam"}
 DIFF_ALLOWED = {"easy", "medium", "hard"}
 # --- Stage 3: qcount → blueprint helpers ---
@@ -1219,45 +1572,20 @@ def estimate_output_token_caps_from_bp(blueprint: list[dict]) -> tuple[int, int]
 
 # --- Stage 6: blueprint-driven question prompt helpers ---
 
-def _bp_counts(blueprint: list[dict]) -> dict:
-    # light wrapper (readability)
-    return counts_from_blueprint(blueprint)
+_LONG_RANGE = {"easy": "30-50", "medium": "60-100", "hard": "80-140"}
+_SHORT_RANGE = {"easy": "6-10", "medium": "10-18", "hard": "14-24"}
+_DIFF_LINE = {
+    "easy": "Ensure questions are easy, accessible and cover core topics; prioritize clarity over trickiness.",
+    "medium": "Ensure questions require multi-step problem solving, conceptual understanding, and application of principles in unfamiliar contexts.",
+    "hard": "Ensure questions are non-routine, multi-step, and integrate ideas; still solvable with standard methods for the intended level.",
+}
 
 
 def _difficulty_profile_for_prompt(global_diff: str | None):
     d = (global_diff or "medium").strip().lower()
     if d not in ("easy", "medium", "hard"):
         d = "medium"
-
-    LONG_RANGE = {"easy": "30-50", "medium": "60-100", "hard": "80-140"}
-    SHORT_RANGE = {"easy": "6-10", "medium": "10-18", "hard": "14-24"}
-
-    diff_line_map = {
-        "easy": "Ensure questions are easy, accessible and cover core topics; prioritize clarity over trickiness.",
-        "medium": "Ensure questions require multi-step problem solving, conceptual understanding, and application of principles in unfamiliar contexts.",
-        "hard": "Ensure questions are non-routine, multi-step, and integrate ideas; still solvable with standard methods for the intended level.",
-    }
-    diff_guidance_map = {
-        "easy": (
-                "- Single-idea prompts; no contrived contexts, no asking student to explain or discuss concepts.\n"
-                "- Avoid multi-step; keep MCQ distractors simple\n"
-                "- Prioritize very simple, short questions, can involve MCQ/Math; avoid long questions unless explicitly requested in Advanced.\n"
-                + _math_difficulty_rubric("easy")
-        ),
-        "medium": (
-                "- Require 3-4 step problem solving with conceptual links between ideas\n"
-                "- Include unfamiliar scenarios requiring application of learned principles\n"
-                "- For MCQ: use sophisticated distractors based on common error patterns and partial understanding\n"
-                "- Demand explanation, analysis, or evaluation rather than simple recall\n"
-                + _math_difficulty_rubric("medium")
-        ),
-        "hard": (
-                "- Prefer scenario-based or proof/‘show that’ items with dependencies between parts\n"
-                "- Do NOT use MCQ for hard items **unless** explicitly requested (Type=MCQ + Difficulty=hard in Advanced); otherwise use Long, Short or Math with multi-step reasoning\n"
-                + _math_difficulty_rubric("hard")
-        ),
-    }
-    return d, LONG_RANGE[d], SHORT_RANGE[d], diff_line_map[d], diff_guidance_map[d]
+    return d, _LONG_RANGE[d], _SHORT_RANGE[d], _DIFF_LINE[d], _DIFF_GUIDANCE[d]
 
 
 def _math_difficulty_rubric(level: str) -> str:
@@ -1282,6 +1610,28 @@ def _math_difficulty_rubric(level: str) -> str:
     )
 
 
+_DIFF_GUIDANCE = {
+    "easy": (
+            "- Single-idea prompts; no contrived contexts, no asking student to explain or discuss concepts.\n"
+            "- Avoid multi-step; keep MCQ distractors simple\n"
+            "- Prioritize very simple, short questions, can involve MCQ/Math; avoid long questions unless explicitly requested in Advanced.\n"
+            + _math_difficulty_rubric("easy")
+    ),
+    "medium": (
+            "- Require 3-4 step problem solving with conceptual links between ideas\n"
+            "- Include unfamiliar scenarios requiring application of learned principles\n"
+            "- For MCQ: use sophisticated distractors based on common error patterns and partial understanding\n"
+            "- Demand explanation, analysis, or evaluation rather than simple recall\n"
+            + _math_difficulty_rubric("medium")
+    ),
+    "hard": (
+            "- Prefer scenario-based or proof/‘show that’ items with dependencies between parts\n"
+            "- Do NOT use MCQ for hard items **unless** explicitly requested (Type=MCQ + Difficulty=hard in Advanced); otherwise use Long, Short or Math with multi-step reasoning\n"
+            + _math_difficulty_rubric("hard")
+    ),
+}
+
+
 # Triviality patterns across domains
 _GENERIC_EASY_PATTERNS = [
     r"\bdefine\b",
@@ -1328,6 +1678,14 @@ def _looks_trivial(item: str, qtype: str) -> bool:
     return soft_no_parts and few_tokens
 
 
+def _try(fn, *args, **kwargs):
+    """fn(*args, **kwargs), or None if it raised (for best-effort model calls)."""
+    try:
+        return fn(*args, **kwargs)
+    except Exception:
+        return None
+
+
 def _rewrite_hard_item(item: str, qtype: str, model: str, max_tokens: int) -> str:
     # Generic, neutral hardening prompt
     instr = (
@@ -1360,12 +1718,16 @@ def enforce_hard_items(q_items: list[str], blueprint: list[dict], global_diff: s
         local_diff = (bp.get("difficulty") or d or "medium").lower()
         if local_diff == "hard" and _looks_trivial(out[i], qtype):
             flagged.append(i)
-    for i in flagged[:max_regens]:
-        try:
-            qtype = (blueprint[i].get("type") or "").lower()
-            out[i] = _rewrite_hard_item(out[i], qtype, model=model, max_tokens=n_out_q_cap)
-        except Exception:
-            pass
+    flagged = flagged[:max_regens]
+    # rewrites are independent: issue them concurrently rather than one round-trip after another
+    rewritten = parallel_map(
+        lambda _, i: _try(_rewrite_hard_item, out[i], (blueprint[i].get("type") or "").lower(),
+                          model=model, max_tokens=n_out_q_cap),
+        flagged, max_workers=max(1, len(flagged)),
+    )
+    for i, new in zip(flagged, rewritten):
+        if new is not None:
+            out[i] = new
     return out
 
 
@@ -1426,12 +1788,15 @@ def enforce_hard_math(q_items: list[str], blueprint: list[dict], global_diff: st
     for i, bp in zip(idxs, blueprint):
         if _needs_upgrade(out[i], bp, global_diff):
             flagged.append(i)
-    # limit rewrites so we stay within time budget
-    for i in flagged[:max_regens]:
-        try:
-            out[i] = _rewrite_hard_math(out[i], model=model, max_tokens=n_out_q_cap)
-        except Exception:
-            pass
+    # limit rewrites so we stay within time budget; run them concurrently
+    flagged = flagged[:max_regens]
+    rewritten = parallel_map(
+        lambda _, i: _try(_rewrite_hard_math, out[i], model=model, max_tokens=n_out_q_cap),
+        flagged, max_workers=max(1, len(flagged)),
+    )
+    for i, new in zip(flagged, rewritten):
+        if new is not None:
+            out[i] = new
     return out
 
 
@@ -1441,16 +1806,7 @@ def _per_item_spec_lines(blueprint: list[dict], start_idx: int = 1, end_idx: int
     """
     if end_idx is None:
         end_idx = len(blueprint)
-    out = []
-    for i in range(start_idx, end_idx + 1):
-        it = blueprint[i - 1]
-        parts = [f"Type: {it.get('type', 'Long')}"]
-        if it.get("difficulty"):
-            parts.append(f"Difficulty: {it['difficulty']}")
-        if it.get("topic"):
-            parts.append(f"Additional instructions: {it['topic']}")
-        out.append(f"Item {i}: " + "; ".join(parts))
-    return "\n".join(out)
+    return "\n".join(_spec_lines_for(_bp_spec_key(blueprint))[start_idx - 1:end_idx])
 
 
 def get_quality_question_instruction_from_blueprint(
@@ -1461,12 +1817,17 @@ def get_quality_question_instruction_from_blueprint(
     Build the full instruction string using the blueprint order and optional per-item
     difficulty/topics. MCQs keep the 'A) ... B) ... C) ... D) ...' format.
     """
-    N = len(blueprint)
-    counts = _bp_counts(blueprint)
+    return _quality_question_instruction_for(_bp_spec_key(blueprint), global_difficulty)
+
+
+@lru_cache(maxsize=64)
+def _quality_question_instruction_for(spec_key: tuple, global_difficulty: str | None) -> str:
+    N = len(spec_key)
+    n_math = sum(1 for t, _, _ in spec_key if t == "Math")
     d, LONG_RANGE, SHORT_RANGE, diff_line, diff_guidance = _difficulty_profile_for_prompt(global_difficulty)
 
     # math heavy?
-    math_heavy = counts["Math"] / max(1, N) > 0.5
+    math_heavy = n_math / max(1, N) > 0.5
 
     # quality requirements (mirrors your original but itemized)
     # quality requirements (math gets an explicit rubric)
@@ -1503,7 +1864,7 @@ def get_quality_question_instruction_from_blueprint(
         - Hard-difficulty items must NOT be MCQ **unless** the per-item plan explicitly sets 'Type: MCQ' with 'Difficulty: hard' (explicit override); otherwise convert to Short or Math
         - Follow the per-item plan below (order and type are mandatory):"""
 
-    per_item_plan = _per_item_spec_lines(blueprint)
+    per_item_plan = "\n".join(_spec_lines_for(spec_key))
 
     return f"""Create a high-quality mock exam paper from the material below.
 
@@ -1531,11 +1892,15 @@ def continue_numbered_list_from_blueprint(
         material: str,
         blueprint: list[dict],
         global_difficulty: str | None,
+        spec_lines: list[str] | None = None,
 ) -> str:
     """
     Continuation instruction for missing items using the same per-item plan.
     """
-    subplan = _per_item_spec_lines(blueprint, start_idx, end_idx)
+    if spec_lines is not None:
+        subplan = "\n".join(spec_lines[start_idx - 1:end_idx])
+    else:
+        subplan = _per_item_spec_lines(blueprint, start_idx, end_idx)
     d, LONG_RANGE, SHORT_RANGE, diff_line, diff_guidance = _difficulty_profile_for_prompt(global_difficulty)
     return f"""Continue the mock exam by writing items {start_idx} to {end_idx} ONLY.
 
@@ -1640,13 +2005,14 @@ def _parse_seq_field(raw: str | None) -> list[str] | None:
     s = str(raw).strip()
     if not s:
         return None
-    # Try JSON first
-    try:
-        val = json.loads(s)
-        if isinstance(val, list):
-            return [str(x).strip() for x in val]
-    except Exception:
-        pass
+    # Try JSON first, but only when it can be a JSON list (plain CSV never starts with '[')
+    if s[0] == "[":
+        try:
+            val = orjson.loads(s) if orjson is not None else json.loads(s)
+            if isinstance(val, list):
+                return [str(x).strip() for x in val]
+        except Exception:
+            pass
     # Fallback: CSV
     return [t.strip() for t in s.split(",")]
 
@@ -1662,11 +2028,15 @@ red_flags = ['Multiple Choice', 'Choice', 'Short', 'Long', 'Math/Calculation', '
              'MCQ', 'Question', 'Answer', 'Mark Scheme']
 
 
+_LATEX_ESCAPES = str.maketrans({
+    "\\": r"\textbackslash{}", "&": r"\&", "%": r"\%", "$": r"\$", "#": r"\#",
+    "_": r"\_", "{": r"\{", "}": r"\}", "~": r"\~{}", "^": r"\^{}",
+})
+
+
 def latex_escape(s: str) -> str:
-    return (s or "").replace("\\", r"\textbackslash{}") \
-        .replace("&", r"\&").replace("%", r"\%").replace("$", r"\$") \
-        .replace("#", r"\#").replace("_", r"\_").replace("{", r"\{") \
-        .replace("}", r"\}").replace("~", r"\~{}").replace("^", r"\^{}")
+    # single pass, so the braces emitted for \textbackslash{} and \~{} are not escaped again
+    return (s or "").translate(_LATEX_ESCAPES)
 
 
 PREAMBLE = r"""
@@ -1684,10 +2054,11 @@ POSTAMBLE = r"\end{document}"
 
 def tex_from_items(items: list[str], title: str) -> str:
     header = r"\paperheader{" + latex_escape(title) + "}\n"
-    body = "\\begin{flushleft}\\begin{enumerate}\n" + \
-           "".join("\\item " + it + "\n\n" for it in items) + \
-           "\\end{enumerate}\\end{flushleft}\n"
-    return PREAMBLE + header + body + POSTAMBLE
+    parts = [PREAMBLE, header, "\\begin{flushleft}\\begin{enumerate}\n"]
+    for it in items:
+        parts += ("\\item ", it, "\n\n")
+    parts += ("\\end{enumerate}\\end{flushleft}\n", POSTAMBLE)
+    return "".join(parts)
 
 
 # --- Stage 8: qpaper helpers (extract items, make a blueprint, render numbered text) ---
@@ -1696,34 +2067,10 @@ TECTONIC_TIMEOUT = env_int("TECTONIC_TIMEOUT", 45)
 
 def compile_tex_with_tectonic(tex_source: str, *, timeout: int | None = None) -> bytes:
     timeout = TECTONIC_TIMEOUT if timeout is None else timeout
-    if shutil.which("tectonic") is None:
+    if _tectonic_path() is None:
         raise RuntimeError("tectonic not found on PATH (make sure your venv/bin/Scripts dir is on PATH).")
     with tempfile.TemporaryDirectory() as td:
-        tex_path = os.path.join(td, "doc.tex")
-        with open(tex_path, "w", encoding="utf-8") as f:
-            f.write(tex_source)
-        pdf_path = os.path.join(td, "doc.pdf")
-        mode = _detect_tectonic_cmd()
-        if mode == "new":
-            cmd = ["tectonic", "-X", "compile", "--outdir", td, "--keep-logs", tex_path]
-        else:
-            cmd = ["tectonic", tex_path, "--keep-logs"]
-        with _TEX_SEM:
-            proc = subprocess.run(cmd, cwd=td, timeout=timeout,
-                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        if proc.returncode != 0 or not os.path.exists(pdf_path):
-            log_tail = ""
-            log_path = os.path.join(td, "doc.log")
-            if os.path.exists(log_path):
-                with open(log_path, "r", encoding="utf-8", errors="ignore") as lf:
-                    log_tail = lf.read()[-4000:]
-            raise RuntimeError(
-                "Tectonic failed.\n\n"
-                f"STDOUT:\n{proc.stdout.decode(errors='ignore')}\n\n"
-                f"STDERR:\n{proc.stderr.decode(errors='ignore')}\n\n"
-                f"LOG tail:\n{log_tail}\n\n"
-                f"Tried:\n{cmd}"
-            )
+        pdf_path = _tectonic_compile_in(td, tex_source, timeout)
         with open(pdf_path, "rb") as f:
             return f.read()
 
@@ -1753,27 +2100,10 @@ def fix_bad_unit_fracs(tex: str) -> str:
 # near compile_tex_with_tectonic
 def compile_tex_with_tectonic_to_path(tex_source: str, out_path: str, *, timeout: int | None = None) -> None:
     timeout = TECTONIC_TIMEOUT if timeout is None else timeout
-    if shutil.which("tectonic") is None:
+    if _tectonic_path() is None:
         raise RuntimeError("tectonic not found on PATH.")
     with tempfile.TemporaryDirectory() as td:
-        tex_path = os.path.join(td, "doc.tex")
-        with open(tex_path, "w", encoding="utf-8") as f:
-            f.write(tex_source)
-        mode = _detect_tectonic_cmd()
-        cmd = (["tectonic", "-X", "compile", "--outdir", td, "--keep-logs", tex_path]
-               if mode == "new" else
-               ["tectonic", tex_path, "--keep-logs"])
-        with _TEX_SEM:
-            proc = subprocess.run(cmd, cwd=td, timeout=timeout, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        pdf_src = os.path.join(td, "doc.pdf")
-        if proc.returncode != 0 or not os.path.exists(pdf_src):
-            log_tail = ""
-            log_path = os.path.join(td, "doc.log")
-            if os.path.exists(log_path):
-                with open(log_path, "r", encoding="utf-8", errors="ignore") as lf:
-                    log_tail = lf.read()[-4000:]
-            raise RuntimeError(f"Tectonic failed.\n\nSTDOUT:\n{proc.stdout.decode(errors='ignore')}\n\n"
-                               f"STDERR:\n{proc.stderr.decode(errors='ignore')}\n\nLOG tail:\n{log_tail}\n\nTried:\n{cmd}")
+        pdf_src = _tectonic_compile_in(td, tex_source, timeout)
         os.makedirs(os.path.dirname(out_path), exist_ok=True)
         shutil.move(pdf_src, out_path)
 
@@ -1790,14 +2120,93 @@ def compile_or_repair(tex_source: str, *_, **__) -> bytes:
 
 def parallel_map(func, iterable, max_workers=8):
     results = [None] * len(iterable)
+    items = enumerate(iterable)
+    window = 2 * max_workers  # in-flight cap: enough to keep workers busy without queueing every item
     with ThreadPoolExecutor(max_workers=max_workers) as ex:
-        futs = {ex.submit(func, i, x): i for i, x in enumerate(iterable)}
-        for fut in as_completed(futs):
-            idx = futs[fut]
-            results[idx] = fut.result()
+        pending = {ex.submit(func, i, x): i for i, x in islice(items, window)}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                results[pending.pop(fut)] = fut.result()
+            for i, x in islice(items, len(done)):
+                pending[ex.submit(func, i, x)] = i
     return results
 
 
+# --- Stage 11: upload spooling ---
+
+class UploadRequest(Request):
+    """Spool multipart file parts straight into UPLOAD_DIR so /upload can adopt them without a second copy."""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.NamedTemporaryFile(dir=UPLOAD_DIR, prefix=".part-", delete=False)
+
+
+def _spooled_path(fs) -> str | None:
+    """Path of the UPLOAD_DIR spool file backing a FileStorage, if UploadRequest created it."""
+    name = getattr(fs.stream, "name", None)
+    if isinstance(name, str) and os.path.dirname(os.path.abspath(name)) == os.path.abspath(UPLOAD_DIR):
+        return name
+    return None
+
+
+def _discard_spooled(files) -> None:
+    """Remove spool files that a request left behind (rejected early or never adopted)."""
+    for fs in files:
+        path = _spooled_path(fs)
+        if path:
+            try:
+                fs.stream.close()
+                os.unlink(path)
+            except OSError:
+                pass
+
+
+def _spool_upload(fs, max_bytes: int) -> tuple[str, int, str] | None:
+    """
+    Return (tmp_path, size, sha256_hex) for an uploaded part stored in UPLOAD_DIR,
+    or None (and nothing left on disk) if it exceeds max_bytes.
+    """
+    hasher = hashlib.sha256()
+    size = 0
+    path = _spooled_path(fs)
+    if path:
+        # Werkzeug already wrote the part into UPLOAD_DIR: hash it in place.
+        fs.stream.close()
+        with open(path, "rb") as src:
+            while True:
+                chunk = src.read(1024 * 1024)
+                if not chunk:
+                    break
+                hasher.update(chunk)
+                size += len(chunk)
+                if size > max_bytes:
+                    break
+        if size > max_bytes:
+            os.unlink(path)
+            return None
+        return path, size, hasher.hexdigest()
+
+    # Fallback: copy from whatever stream Werkzeug handed us.
+    tmp = tempfile.NamedTemporaryFile(dir=UPLOAD_DIR, delete=False)
+    try:
+        while True:
+            chunk = fs.stream.read(1024 * 1024)
+            if not chunk:
+                break
+            hasher.update(chunk)
+            tmp.write(chunk)
+            size += len(chunk)
+            if size > max_bytes:
+                break
+    finally:
+        tmp.close()
+    if size > max_bytes:
+        os.unlink(tmp.name)
+        return None
+    return tmp.name, size, hasher.hexdigest()
+
+
 # --- Stage 11: content sniffing & zip safety ---
 
 def _looks_pdf(head: bytes) -> bool:
@@ -1832,17 +2241,20 @@ def _zip_safety_ok(fp: str) -> bool:
     """Basic zip bomb guard: total uncompressed size and ratio check."""
     try:
         with zipfile.ZipFile(fp) as z:
-            total_comp = 0
-            total_uncomp = 0
-            for i in z.infolist():
-                total_comp += max(1, i.compress_size)
-                total_uncomp += i.file_size
-            if total_uncomp > ZIP_UNCOMPRESSED_LIMIT_MB * 1024 * 1024:
+            infos = z.infolist()
+        limit = ZIP_UNCOMPRESSED_LIMIT_MB * 1024 * 1024
+        total_comp = 0
+        total_uncomp = 0
+        # Python ints: declared sizes are attacker-controlled and must not wrap
+        for i in infos:
+            total_uncomp += i.file_size
+            if total_uncomp > limit:
                 return False
-            ratio = float(total_uncomp) / float(total_comp or 1)
-            if ratio > ZIP_COMPRESSION_RATIO_MAX:
-                return False
-            return True
+            total_comp += max(1, i.compress_size)
+        ratio = float(total_uncomp) / float(total_comp or 1)
+        if ratio > ZIP_COMPRESSION_RATIO_MAX:
+            return False
+        return True
     except Exception:
         return False
 
@@ -1907,6 +2319,90 @@ def _ocr_pdf_with_tesseract(filepath: str, max_pages: int) -> str:
         return ""
 
 
+_W_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_A_NS = "{http://schemas.openxmlformats.org/drawingml/2006/main}"
+_P_NS = "{http://schemas.openxmlformats.org/presentationml/2006/main}"
+_R_NS = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+_PKG_REL_NS = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+_MC_FALLBACK = "{http://schemas.openxmlformats.org/markup-compatibility/2006}Fallback"
+
+
+def _stream_paragraphs(stream, ns: str, limit: int, *, char_limit: int | None = None,
+                       breaks=("br", "cr"), tabs=("tab",)) -> list[str]:
+    """
+    Text of the first `limit` <ns:p> elements, read with iterparse; elements are cleared as they close.
+    Stops once the paragraphs (plus one joining newline each) reach char_limit.
+    mc:Fallback subtrees are skipped: they repeat the mc:Choice content (e.g. text boxes) for old readers.
+    """
+    budget = TXT_CHAR_LIMIT if char_limit is None else char_limit
+    t_tag, p_tag = ns + "t", ns + "p"
+    br_tags = {ns + b for b in breaks}
+    tab_tags = {ns + t for t in tabs}
+    paras: list[str] = []
+    buf: list[str] = []
+    skip = 0  # depth inside mc:Fallback
+    for event, elem in ET.iterparse(stream, events=("start", "end")):
+        tag = elem.tag
+        if tag == _MC_FALLBACK:
+            if event == "start":
+                skip += 1
+            else:
+                skip -= 1
+                elem.clear()
+            continue
+        if event == "start" or skip:
+            continue
+        if tag == t_tag:
+            if elem.text:
+                buf.append(elem.text)
+        elif tag in br_tags:
+            buf.append("\n")
+        elif tag in tab_tags:
+            buf.append("\t")
+        elif tag == p_tag:
+            text = "".join(buf)
+            paras.append(text)
+            buf.clear()
+            elem.clear()
+            budget -= len(text) + 1
+            if len(paras) >= limit or budget < 0:
+                break
+    return paras
+
+
+def _docx_text(filepath: str) -> str:
+    with zipfile.ZipFile(filepath) as z, z.open("word/document.xml") as f:
+        return "\n".join(_stream_paragraphs(f, _W_NS, DOCX_PARA_LIMIT))
+
+
+def _pptx_slide_parts(z: zipfile.ZipFile) -> list[str]:
+    """Slide part names in presentation order (sldIdLst -> presentation.xml.rels)."""
+    with z.open("ppt/_rels/presentation.xml.rels") as f:
+        targets = {r.get("Id"): r.get("Target", "") for r in ET.parse(f).getroot().iter(_PKG_REL_NS + "Relationship")}
+    with z.open("ppt/presentation.xml") as f:
+        ids = [s.get(_R_NS + "id") for s in ET.parse(f).getroot().iter(_P_NS + "sldId")]
+    out = []
+    for rid in ids:
+        t = targets.get(rid)
+        if t:
+            out.append(t.lstrip("/") if t.startswith("/") else os.path.normpath("ppt/" + t).replace(os.sep, "/"))
+    return out
+
+
+def _pptx_text(filepath: str) -> str:
+    out: list[str] = []
+    budget = TXT_CHAR_LIMIT
+    with zipfile.ZipFile(filepath) as z:
+        for name in _pptx_slide_parts(z)[:PPTX_SLIDE_LIMIT]:
+            with z.open(name) as f:
+                paras = _stream_paragraphs(f, _A_NS, 1 << 30, char_limit=budget, tabs=())
+            out.extend(paras)
+            budget -= sum(len(p) + 1 for p in paras)
+            if budget < 0:
+                break
+    return "\n".join(out)
+
+
 def preprocessing(filepath):
     ext = os.path.splitext(filepath)[1].lower()
 
@@ -1919,45 +2415,72 @@ def preprocessing(filepath):
         # try utf-8, fallback utf-16
         try:
             with open(filepath, "r", encoding="utf-8") as f:
-                return _cap(f.read(), TXT_CHAR_LIMIT)
+                return _cap(f.read(TXT_CHAR_LIMIT), TXT_CHAR_LIMIT)
         except UnicodeDecodeError:
             with open(filepath, "r", encoding="utf-16") as f:
-                return _cap(f.read(), TXT_CHAR_LIMIT)
+                return _cap(f.read(TXT_CHAR_LIMIT), TXT_CHAR_LIMIT)
 
 
     elif ext == ".pdf":
         # Prefer PyMuPDF; add OCR fallback for image-only pages
         try:
             parts = []
+            ocr_jobs = deque()  # (index in parts, future), oldest first
+            ocr_pages = 0
             doc = fitz.open(filepath)
             n = min(len(doc), PDF_PAGE_LIMIT)
             zoom = OCR_DPI / 72.0
             mat = fitz.Matrix(zoom, zoom)
+            can_ocr = ENABLE_OCR and pytesseract is not None and Image is not None
+            total = 0
 
-            for i in range(n):
-                page = doc.load_page(i)
-                t = page.get_text("text") or ""
-
-                # DEBUG: Log page text extraction
-                print(f"DEBUG: Page {i + 1} extracted text length: {len(t)}")
-
-                if t.strip():
-                    parts.append(t)
-                elif ENABLE_OCR and pytesseract is not None and Image is not None:
-                    # OCR this page
-                    print(f"DEBUG: Attempting OCR on page {i + 1}")
-                    try:
-                        pix = page.get_pixmap(matrix=mat, alpha=False)
-                        img = Image.open(io.BytesIO(pix.tobytes("png")))
-                        t_ocr = pytesseract.image_to_string(img, lang=OCR_LANG) or ""
-                        print(f"DEBUG: OCR result length: {len(t_ocr)}")
-                        parts.append(t_ocr)
-                    except Exception as e:
-                        print(f"DEBUG: OCR failed on page {i + 1}: {e}")
+            def _ocr_png(i, png):
+                try:
+                    t_ocr = pytesseract.image_to_string(Image.open(io.BytesIO(png)), lang=OCR_LANG) or ""
+                    print(f"DEBUG: OCR result length: {len(t_ocr)}")
+                    return t_ocr
+                except Exception as e:
+                    print(f"DEBUG: OCR failed on page {i + 1}: {e}")
+                    return ""
+
+            def _collect_oldest():
+                k, fut = ocr_jobs.popleft()
+                parts[k] = fut.result()
+                return len(parts[k]) + 1
+
+            # MuPDF holds the GIL, so pages are read here in order; only tesseract (a subprocess) fans out.
+            # At most 2*workers rendered pages are held in memory at once.
+            max_inflight = 2 * max(1, OCR_WORKERS)
+            with ThreadPoolExecutor(max_workers=max(1, OCR_WORKERS)) as ex:
+                for i in range(n):
+                    if total > TXT_CHAR_LIMIT:
+                        break  # later pages would be cut off by _cap anyway
+                    page = doc.load_page(i)
+                    t = page.get_text("text") or ""
+
+                    # DEBUG: Log page text extraction
+                    print(f"DEBUG: Page {i + 1} extracted text length: {len(t)}")
+
+                    if t.strip():
+                        parts.append(t)
+                        total += len(t) + 1
+                    elif can_ocr and ocr_pages < OCR_PAGE_LIMIT:
+                        print(f"DEBUG: Attempting OCR on page {i + 1}")
+                        while len(ocr_jobs) >= max_inflight:
+                            total += _collect_oldest()
+                        ocr_pages += 1
+                        try:
+                            png = page.get_pixmap(matrix=mat, alpha=False).tobytes("png")
+                            ocr_jobs.append((len(parts), ex.submit(_ocr_png, i, png)))
+                        except Exception as e:
+                            print(f"DEBUG: OCR failed on page {i + 1}: {e}")
+                        parts.append("")
+                    else:
+                        print(f"DEBUG: OCR not available or disabled")
                         parts.append("")
-                else:
-                    print(f"DEBUG: OCR not available or disabled")
-                    parts.append("")
+
+                while ocr_jobs:
+                    _collect_oldest()
 
             result = _cap("\n".join(parts), TXT_CHAR_LIMIT)
             print(f"DEBUG: Final PDF result length: {len(result)}")
@@ -1974,11 +2497,16 @@ def preprocessing(filepath):
                 return ""
 
             out = []
+            total = 0
             try:
                 with pdfplumber.open(filepath) as pdf:
                     n = min(len(pdf.pages), PDF_PAGE_LIMIT)
                     for i in range(n):
-                        out.append(pdf.pages[i].extract_text() or "")
+                        t = pdf.pages[i].extract_text() or ""
+                        out.append(t)
+                        total += len(t) + 1
+                        if total > TXT_CHAR_LIMIT:
+                            break
 
                 text = "\n".join(out)
                 print(f"DEBUG: pdfplumber result length: {len(text)}")
@@ -1997,18 +2525,28 @@ def preprocessing(filepath):
                 return ""
 
     elif ext == ".docx":
+        try:
+            return _cap(_docx_text(filepath), TXT_CHAR_LIMIT)
+        except Exception:
+            pass  # unusual packaging (e.g. strict OOXML): let python-docx have a go
         try:
             doc = docx.Document(filepath)
             paras = []
+            total = 0
             for i, p in enumerate(doc.paragraphs):
-                if i >= DOCX_PARA_LIMIT:
+                if i >= DOCX_PARA_LIMIT or total > TXT_CHAR_LIMIT:
                     break
                 paras.append(p.text)
+                total += len(paras[-1]) + 1
             return _cap("\n".join(paras), TXT_CHAR_LIMIT)
         except Exception:
             return ""
 
     elif ext == ".pptx":
+        try:
+            return _cap(_pptx_text(filepath), TXT_CHAR_LIMIT)
+        except Exception:
+            pass
         try:
             prs = Presentation(filepath)
             out = []
@@ -2093,54 +2631,29 @@ def get_response(instruction, file, model=main_model, max_tokens=1024, temperatu
         return response.choices[0].message.content
 
 
-# =========================
-# Web app
-# =========================
-def website():
-    app = Flask(__name__)
-    app.logger.setLevel(logging.INFO)
-    app.config["MAX_CONTENT_LENGTH"] = MAX_CONTENT_LENGTH
+def _json_response(obj, status: int = 200) -> Response:
+    """JSON Response via orjson when installed (bytes straight out), else the stdlib encoder."""
+    body = orjson.dumps(obj) if orjson is not None else json.dumps(obj, separators=(",", ":"))
+    return Response(body, status=status, mimetype="application/json")
 
-    # --- Stage 15: request ID + security headers ---
 
-    @app.before_request
-    def _req_ctx():
-        # honor inbound X-Request-ID or make one
-        rid = request.headers.get("X-Request-ID")
-        g.request_id = (rid.strip() if rid else str(uuid4()))
+# --- Stage 15: readiness (probed every few seconds; the real checks are cached) ---
+READYZ_TTL_SEC = env_float("APP_READYZ_TTL", 30.0)
+_READY_CACHE = (0.0, True, {})  # (expires_at, ok, checks)
+_READY_LOCK = Lock()
+_READY_PROBE_PATH = os.path.join(OUTPUT_DIR, ".healthcheck")
+_O_TMPFILE = getattr(os, "O_TMPFILE", 0)
 
-    @app.after_request
-    def _secure_headers(resp: Response):
-        # propagate request id
-        try:
-            resp.headers["X-Request-ID"] = g.request_id
-        except Exception:
-            pass
-
-        # conservative, CSP omitted to avoid breaking inline scripts/styles
-        resp.headers.setdefault("X-Content-Type-Options", "nosniff")
-        resp.headers.setdefault("X-Frame-Options", "DENY")
-        resp.headers.setdefault("Referrer-Policy", "strict-origin-when-cross-origin")
-        resp.headers.setdefault("Permissions-Policy", "geolocation=(), microphone=(), camera=()")
-
-        # avoid caching on sensitive routes
-        p = request.path or ""
-        if p.startswith(("/upload", "/status")):
-            resp.headers["Cache-Control"] = "no-store"
-            resp.headers["Pragma"] = "no-cache"
-            resp.headers["Expires"] = "0"
-        return resp
-
-    # --- Stage 13: global guards ---
-    # --- Stage 15: health / readiness probes ---
-
-    @app.route("/healthz")
-    def healthz():
-        # liveness: process is up
-        return {"ok": True, "time": int(time.time())}, 200
 
-    @app.route("/readyz")
-    def readyz():
+def _readiness() -> tuple[bool, dict]:
+    global _READY_CACHE
+    now = time.monotonic()
+    expires, ok, checks = _READY_CACHE
+    if now < expires:
+        return ok, checks
+    with _READY_LOCK:
+        if now < _READY_CACHE[0]:
+            return _READY_CACHE[1], _READY_CACHE[2]
         checks = {}
         ok = True
 
@@ -2152,1848 +2665,136 @@ def website():
             checks["tectonic"] = {"ok": False, "err": str(e)}
             ok = False
 
-        # openai configured (does not call the API)
-        checks["openai_key_present"] = bool(os.getenv("OPENAI_API_KEY", "").strip())
+        # openai configured (does not call the API); read once at import
+        checks["openai_key_present"] = bool(OPENAI_API_KEY)
         if not checks["openai_key_present"]:
             ok = False
 
-        # output dir writable
+        # output dir writable: an unnamed O_TMPFILE inode on Linux (gone on close, nothing to unlink),
+        # else one open of a fixed probe file; the dir is created at startup
         out_ok = True
         try:
-            os.makedirs(OUTPUT_DIR, exist_ok=True)
-            testp = os.path.join(OUTPUT_DIR, f".w_{uuid4().hex}")
-            with open(testp, "w", encoding="utf-8") as f:
-                f.write("ok")
-            os.remove(testp)
+            fd = -1
+            if _O_TMPFILE:
+                try:
+                    fd = os.open(OUTPUT_DIR, os.O_WRONLY | _O_TMPFILE, 0o600)
+                except OSError:
+                    pass  # fs without O_TMPFILE support, or the dir is gone: use the named probe
+            if fd < 0:
+                try:
+                    fd = os.open(_READY_PROBE_PATH, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                except FileNotFoundError:
+                    os.makedirs(OUTPUT_DIR, exist_ok=True)  # wiped while running; recreate once
+                    fd = os.open(_READY_PROBE_PATH, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            os.close(fd)
         except Exception as e:
             out_ok = False
             checks["output_dir_err"] = str(e)
             ok = False
         checks["output_dir_writable"] = out_ok
 
-        status = 200 if ok else 503
-        return {"ok": ok, "checks": checks, "time": int(time.time())}, status
-
-    @app.before_request
-    def _global_security_and_limits():
-        # light maintenance
-        _prune_progress()
-        # Allow static files and favicon without checks
-        if request.endpoint in {"static"}:
-            return
-
-        path = request.path or ""
-
-        # 1) Basic Auth (skip /upload here so we can complete its spinner using fail_progress)
-        if BASIC_AUTH_ENABLED and path not in ("/upload", "/healthz", "/readyz"):
-            if not _auth_ok_for_request():
-                # plain 401 with WWW-Authenticate
-                return _need_www_auth()
-
-        # 2) Lightweight rate limiting for /status and /download
-        ip = _client_ip()
-
-        if path.startswith("/status"):
-            if not _rate_allow("status", ip, RATE_STATUS_PER_10S):
-                # JSON is fine here; frontend ignores occasional errors while polling
-                return ERR["rl_status"], 429
-
-        if path.startswith("/download"):
-            if not _rate_allow("download", ip, RATE_DOWNLOADS_PER_MIN):
-                return ERR["rl_download"], 429
-
-    os.makedirs("templates", exist_ok=True)
-    os.makedirs(UPLOAD_DIR, exist_ok=True)
-    os.makedirs(OUTPUT_DIR, exist_ok=True)
-
-    html_path = os.path.join("templates", "upload.html")
-    html_code = """<!DOCTYPE html>
-<html lang="en">
-<head>
-  <meta charset="utf-8">
-  <title>Build a Mock Exam Paper</title>
-  <meta name="viewport" content="width=device-width, initial-scale=1" />
-  <style>
-  details#advancedCard.adv-disabled .adv-summary{
-  opacity: .55;
-  cursor: not-allowed;
-  pointer-events: none; /* prevent opening */
-}
-  /* drag & drop affordances */
-.qcard[draggable="true"]{ cursor: grab; }
-.qcard.dragging{ opacity:.6; }
-.qcard.drop-target{ outline:2px dashed var(--brand); outline-offset:2px; }
-/* Advanced question widgets — full-width stacked cards */
-.qgrid{
-  display: flex;
-  flex-direction: column;
-  gap: 12px;
-}
-
-.qcard{
-  width: 100%;
-  background: var(--chip);
-  border: 1px solid var(--border);
-  border-radius: 14px;
-  padding: 12px 14px;
-  display: flex;
-  flex-direction: column;
-  transition: border-color .15s, transform .06s ease;
-}
-.qcard:active{ transform: translateY(1px); }
-
-/* header row inside each card */
-.qhead{
-  display: flex;
-  align-items: center;
-  justify-content: space-between;
-  gap: 12px;
-}
-
-.qleft{ display: flex; align-items: center; gap: 10px; min-width: 0; }
-.qright{ opacity: .75; font-size: .9rem; color: var(--muted); } /* placeholder space */
-
-.qbadge{
-  width: 42px; height: 42px; border-radius: 12px;
-  display: flex; align-items: center; justify-content: center;
-  font-weight: 700;
-  background: var(--panel);
-  border: 1px solid var(--border);
-}
-.field.is-disabled { opacity: .58; }
-.qmeta{ display:flex; flex-direction:column; gap:2px; min-width:0; }
-.qtitle{ font-weight:600; white-space:nowrap; overflow:hidden; text-overflow:ellipsis; }
-.qtype{ font-size:.9rem; color: var(--muted); }
-
-/* reserved space for future per-question options */
-.qopts{
-  margin-top: 10px;
-  min-height: 44px;                  /* leaves vertical room for controls later */
-  border: 1px dashed var(--border);  /* subtle placeholder; remove later */
-  border-radius: 10px;
-  background: color-mix(in oklab, var(--panel) 92%, transparent);
-}
-
-/* subtle type tinting on the badge */
-.qcard[data-type="Long"]  .qbadge{ background: color-mix(in oklab, var(--brand) 18%, var(--panel)); }
-.qcard[data-type="Short"] .qbadge{ background: color-mix(in oklab, var(--ok)    18%, var(--panel)); }
-.qcard[data-type="MCQ"]   .qbadge{ background: color-mix(in oklab, var(--warn)  18%, var(--panel)); }
-.qcard[data-type="Math"]  .qbadge{ background: color-mix(in oklab, var(--err)   16%, var(--panel)); }
-  /* Styled selects */
-.select {
-  width: 100%;
-  -webkit-appearance: none;
-  appearance: none;
-  background: var(--panel);
-  color: var(--text);
-  border: 1px solid var(--border);
-  border-radius: 10px;
-  padding: 10px 36px 10px 12px; /* room for chevron */
-  line-height: 1.2;
-  cursor: pointer;
-  transition: border-color .15s, box-shadow .15s, background-color .15s, transform .06s ease;
-  box-shadow: 0 1px 0 rgba(0,0,0,.04);
-}
-.select:hover { border-color: color-mix(in oklab, var(--border) 60%, var(--brand) 40%); }
-.select:active { transform: translateY(1px); }
-.select:focus { outline: none; }
-.select:focus-visible {
-  border-color: var(--brand);
-  box-shadow: 0 0 0 3px color-mix(in oklab, var(--brand) 30%, transparent);
-}
-
-/* error + disabled states (your JS already toggles .invalid) */
-.select.invalid { border-color: var(--err) !important; }
-.select:disabled { opacity: .6; cursor: not-allowed; }
-
-/* wrapper draws the chevron */
-.select-wrap { position: relative; }
-.select-wrap::after{
-  content:"";
-  position:absolute; right:12px; top:50%;
-  width:10px; height:10px; pointer-events:none;
-  transform: translateY(-50%) rotate(45deg);
-  border-right:2px solid var(--muted);
-  border-bottom:2px solid var(--muted);
-  transition: transform .15s, border-color .15s;
-}
-.select-wrap:focus-within::after{
-  transform: translateY(-50%) rotate(225deg);
-  border-color: var(--brand);
-}
-
-/* hide legacy arrows */
-select::-ms-expand { display:none; }
-
-/* dark dropdown panels (best-effort; some UAs ignore) */
-.select option {
-  background: var(--panel);
-  color: var(--text);
-}
-  .radio-inline { display:flex; gap:14px; flex-wrap:wrap; align-items:center; }
-.radio-inline label { display:flex; align-items:center; gap:6px; }
-  .maker-badge{
-  position: fixed;
-  right: 14px;
-  bottom: 14px;
-  z-index: 9999;
-  padding: 8px 10px;
-  font-size: 0.85rem;
-  border-radius: 10px;
-  background: var(--panel);
-  color: var(--muted);
-  border: 1px solid var(--border);
-  box-shadow: 0 6px 18px rgba(0,0,0,.12);
-  user-select: none;
-  -webkit-user-select: none;
-}
-@media (max-width: 640px){
-  .maker-badge{ font-size: 0.8rem; padding: 7px 9px; right: 10px; bottom: 10px; }
-}
-  .invalid {
-  border-color: var(--err) !important;
-}
-  /* Make disabled-looking buttons that ignore clicks */
-.btn[aria-disabled="true"] {
-#drop[aria-disabled="true"] { opacity:.55; pointer-events:none; }
-  opacity: .55;
-  pointer-events: none;
-}
-
-.mini-spinner {
-  width: 14px; height: 14px; border-radius: 50%;
-  border: 2px solid color-mix(in oklab, var(--text) 20%, transparent);
-  border-top-color: var(--text);
-  display: inline-block; vertical-align: text-bottom;
-  margin-right: 8px; animation: spin 1s linear infinite;
-}
-    textarea{
-      width:100%; padding:10px 12px; background:var(--panel); color:var(--text);
-      border:1px solid var(--border); border-radius:10px; resize:vertical; min-height:120px;
-    }
-    :root{
-      --bg:#0b0c0f; --panel:#12141a; --muted:#a3a8b3; --text:#e9ecf1; --brand:#4f8cff;
-      --ok:#1db954; --warn:#f0b429; --err:#ff5a5f; --border:#1d2230; --chip:#1a1f2b;
-    }
-    @media (prefers-color-scheme: light){
-      :root{
-        --bg:#f7f8fb; --panel:#ffffff; --muted:#5f6b7a; --text:#0d1117; --brand:#3b6dde;
-        --ok:#17a054; --warn:#c79007; --err:#d5484d; --border:#e4e7ee; --chip:#f1f3f8;
-      }
-    }
-    *{box-sizing:border-box}
-    /* Let the document grow and paint the gradient across the whole scroll height */
-html{
-  min-height:100%;
-  background: linear-gradient(180deg, var(--bg), color-mix(in oklab, var(--bg) 80%, #000 20%));
-  background-attachment: fixed;
-  font-family: ui-sans-serif, system-ui, -apple-system, "Segoe UI", Roboto, Helvetica, Arial,
-               "Apple Color Emoji","Segoe UI Emoji";
-}
-
-body{
-  margin:0;
-  min-height:100%;
-  background: transparent; /* gradient is on <html> */
-  color: var(--text);
-}
-
-button, input, select, textarea { font: inherit; }
-    .wrap{max-width:980px; margin:32px auto; padding:0 16px;}
-    .brand{display:flex; align-items:center; gap:12px; margin-bottom:16px}
-    .logo{width:36px;height:36px;border-radius:8px;background:linear-gradient(135deg,var(--brand),#7aa6ff)}
-    h1{font-size:1.5rem;margin:0}
-    .subtitle{color:var(--muted);margin:4px 0 24px}
-    .grid{display:grid; grid-template-columns: 1.2fr .8fr; gap:18px}
-    @media (max-width:900px){.grid{grid-template-columns:1fr}}
-
-    .card{
-      background:var(--panel); border:1px solid var(--border); border-radius:14px; padding:18px;
-      box-shadow: 0 10px 30px rgba(0,0,0,.12);
-    }
-
-    /* Progress Section */
-    .progress-section {
-      margin-top: 20px;
-      padding: 18px;
-      border-radius: 14px;
-      background: var(--panel);
-      border: 1px solid var(--border);
-      display: none;
-    }
-
-    .progress-section.show {
-      display: block;
-    }
-
-    .progress-header {
-      display: flex;
-      align-items: center;
-      gap: 12px;
-      margin-bottom: 16px;
-    }
-
-    .progress-bar-container {
-      width: 100%;
-      height: 8px;
-      background: var(--chip);
-      border-radius: 4px;
-      overflow: hidden;
-      margin-bottom: 12px;
-    }
-
-    .progress-bar {
-      height: 100%;
-      background: linear-gradient(90deg, var(--brand), #7aa6ff);
-      width: 0%;
-      transition: width 0.3s ease;
-    }
-
-    .progress-steps {
-      display: grid;
-      gap: 8px;
-    }
-
-    .progress-step {
-      display: flex;
-      align-items: center;
-      gap: 12px;
-      padding: 8px 0;
-      font-size: 0.9rem;
-    }
-
-    .step-icon {
-      width: 20px;
-      height: 20px;
-      border-radius: 50%;
-      display: flex;
-      align-items: center;
-      justify-content: center;
-      font-size: 0.75rem;
-      font-weight: bold;
-    }
-
-    .step-icon.pending {
-      background: var(--chip);
-      color: var(--muted);
-    }
-
-    .step-icon.active {
-      background: var(--brand);
-      color: white;
-    }
-
-    .step-icon.complete {
-      background: var(--ok);
-      color: white;
-    }
-
-    .step-text {
-      flex: 1;
-    }
-
-    .step-time {
-      color: var(--muted);
-      font-size: 0.85rem;
-    }
-
-    .time-estimate {
-      background: var(--chip);
-      padding: 8px 12px;
-      border-radius: 8px;
-      text-align: center;
-      margin-bottom: 16px;
-      font-size: 0.9rem;
-    }
-
-    /* Dropzone */
-    .drop{
-      border:1.5px dashed var(--border); border-radius:14px; padding:24px; text-align:center;
-      background:color-mix(in oklab, var(--panel) 90%, var(--chip) 10%); transition: border-color .15s, background .15s;
-    }
-    .drop.dragover{border-color:var(--brand); background:color-mix(in oklab, var(--chip) 60%, var(--panel) 40%)}
-    .drop p{margin:6px 0 0; color:var(--muted)}
-    .btn{
-      appearance:none; border:1px solid var(--border); background:var(--chip);
-      color:var(--text); padding:10px 14px; border-radius:10px; cursor:pointer; font-weight:600;
-    }
-    .btn.primary{background:var(--brand); border-color:transparent; color:white}
-    .btn.danger{ background: var(--err); border-color: transparent; color:#fff; }
-    .btn.ghost{background:transparent}
-    .btn:disabled{opacity:.6; cursor:not-allowed}
-    .btn-row{display:flex; gap:10px; justify-content:center; margin-top:12px}
-
-    /* File list */
-    .files{display:grid; gap:10px; margin-top:16px}
-    .file{
-      display:flex; align-items:center; gap:12px; padding:10px 12px; border:1px solid var(--border);
-      border-radius:12px; background:var(--chip);
-    }
-    .badge{
-      font-size:.75rem; padding:4px 8px; border-radius:999px; background:var(--panel); border:1px solid var(--border);
-      color:var(--muted);
-    }
-    .file-main{flex:1; min-width:0}
-    .file-name{white-space:nowrap; overflow:hidden; text-overflow:ellipsis}
-    .file-meta{font-size:.85rem; color:var(--muted)}
-    .file-remove{border:none; background:transparent; color:var(--err); cursor:pointer; font-weight:700}
-
-    /* Form */
-    .form-row{display:grid; grid-template-columns: 1fr 1fr; gap:12px}
-    .form-row.stacked{grid-template-columns:1fr}
-    .field{display:flex; flex-direction:column; gap:6px}
-    label{font-weight:600}
-    input[type="text"], input[type="number"]{
-      width:100%; padding:10px 12px; background:var(--panel); color:var(--text);
-      border:1px solid var(--border); border-radius:10px;
-    }
-    input[type="number"]{appearance: textfield}
-    .help{color:var(--muted); font-size:.9rem}
-
-    /* Status */
-    .status{margin-top:14px; padding:12px; border-radius:12px; display:none}
-    .status.show{display:block}
-    .status.ok{background:color-mix(in oklab, var(--ok) 15%, transparent); border:1px solid color-mix(in oklab, var(--ok) 60%, var(--border))}
-    .status.err{background:color-mix(in oklab, var(--err) 15%, transparent); border:1px solid color-mix(in oklab, var(--err) 60%, var(--border))}
-    .status.warn{background:color-mix(in oklab, var(--warn) 15%, transparent); border:1px solid color-mix(in oklab, var(--warn) 60%, var(--border))}
-
-    /* Footer */
-    .footer{margin:26px 0 6px; color:var(--muted); font-size:.9rem; text-align:center}
-    .spinner{
-      width:18px;height:18px;border-radius:50%; border:3px solid color-mix(in oklab, var(--text) 20%, transparent);
-      border-top-color: var(--text); animation:spin 1s linear infinite; display:inline-block; vertical-align:middle; margin-right:8px
-    }
-    @keyframes spin{to{transform:rotate(360deg)}}
-    a.link{color:var(--brand); font-weight:600; text-decoration:none}
-    a.link:hover{text-decoration:underline}
-
-    /* Animation for smooth transitions */
-    .fade-in {
-      animation: fadeIn 0.3s ease-in;
-    }
-
-    @keyframes fadeIn {
-      from { opacity: 0; transform: translateY(10px); }
-      to { opacity: 1; transform: translateY(0); }
-    }
-/* Collapsible Advanced header */
-details.card { padding: 0; }                 /* we’ll pad the summary instead */
-.adv-summary {
-  display: flex; align-items: center; justify-content: space-between;
-  gap: 12px; padding: 14px 18px; cursor: pointer; user-select: none;
-  list-style: none;
-}
-.adv-summary::-webkit-details-marker { display: none; }
-.adv-summary::marker { content: ""; }
-
-/* chevron */
-.adv-summary::after {
-  content:""; width:10px; height:10px; transform: rotate(-45deg);
-  border-right:2px solid var(--muted); border-bottom:2px solid var(--muted);
-  transition: transform .15s, border-color .15s;
-}
-details[open] .adv-summary::after { transform: rotate(45deg); border-color: var(--brand); }
-
-.adv-title { font-size: 1.1rem; font-weight: 700; }
-.adv-count { color: var(--muted); font-size: 0.9rem; }
-
-.adv-body { padding: 0 18px 16px; }
-.adv-summary{
-  display: flex;
-  align-items: center;
-  gap: 12px;
-  padding: 14px 18px;
-  cursor: pointer;
-  user-select: none;
-  /* remove the old space-between if you had it */
-  justify-content: flex-start;   /* <- ensures items don't spread */
-}
-
-/* Push the count to the right, just before the chevron */
-.adv-count{
-  margin-left: auto;             /* <- moves it to the right edge */
-  margin-right: 8px;             /* small gap before the chevron */
-  color: var(--muted);
-  font-size: 0.9rem;
-}
-
-/* Keep the chevron pinned at the far right as before */
-.adv-summary::after{
-  content:"";
-  width:10px; height:10px; transform: rotate(-45deg);
-  border-right:2px solid var(--muted); border-bottom:2px solid var(--muted);
-  transition: transform .15s, border-color .15s;
-}
-details[open] .adv-summary::after{
-  transform: rotate(45deg);
-  border-color: var(--brand);
-}
-/* --- Advanced controls box --- */
-.adv-controls{
-  margin: 8px 0 12px;
-  padding: 12px;
-  border: 1px solid var(--border);
-  border-radius: 10px;
-  background: var(--chip);
-}
-.adv-checks{
-  display: grid;
-  gap: 10px;
-  margin: 0; padding: 0;
-  border: 0;
-}
-.adv-checks .chk{
-  display: flex;
-  align-items: center;
-  gap: 8px;
-}
-.sr-only{
-  position:absolute; width:1px; height:1px; padding:0; margin:-1px;
-  overflow:hidden; clip:rect(0,0,0,0); white-space:nowrap; border:0;
-}
-/* qopts layout: Topic | Difficulty | Type */
-.qopts{
-  margin-top: 12px;
-  padding: 12px;
-  border: 1px dashed var(--border);
-  border-radius: 10px;
-  background: color-mix(in oklab, var(--panel) 92%, transparent);
-}
-.qrow{
-  display: grid;
-  grid-template-columns: 1.2fr 1fr 1.2fr; /* Topic | Diff | Type */
-  gap: 12px;
-}
-@media (max-width: 760px){
-  .qrow{ grid-template-columns: 1fr; }
-}
-.qopt{ display:flex; flex-direction:column; gap:8px; }
-.qopt label{ font-weight:600; font-size:.95rem; }
-.qopt .muted{ color:var(--muted); font-weight:500; }
-
-.qopt input[type="text"]{
-  width:100%; padding:10px 12px; background:var(--panel); color:var(--text);
-  border:1px solid var(--border); border-radius:10px;
-}
-
-.pill-group{ display:flex; gap:10px; flex-wrap:wrap; }
-.pill{
-  display:inline-flex; align-items:center; gap:6px; padding:8px 10px;
-  border:1px solid var(--border); border-radius:999px; background:var(--chip);
-  user-select:none;
-}
-.pill input{ accent-color: var(--brand); }
-
-/* Visually mute disabled groups */
-.qopt.is-disabled{ opacity:.58; }
-  </style>
-</head>
-<body>
-  <div class="wrap">
-    <div class="brand">
-      <div class="logo" aria-hidden="true"></div>
-      <div>
-        <h1>Build a Mock Exam Paper</h1>
-        <div class="subtitle">Upload study files, choose question counts, and generate a polished paper + mark scheme.</div>
-      </div>
-    </div>
-
-    <div class="grid">
-      <!-- Left: Files -->
-      <section class="card">
-        <h2 style="margin:0 0 8px">Your files</h2>
-        <div id="drop" class="drop" tabindex="0" role="button" aria-label="Upload files">
-          <strong>Drag &amp; drop</strong> .txt, .pdf, .docx, .pptx, .rtf here
-          <p>or</p>
-          <div class="btn-row">
-            <button class="btn" id="chooseBtn" type="button">Choose files</button>
-            <input id="file" type="file" multiple accept=".txt,.pdf,.docx,.pptx,.rtf" style="display:none" />
-          </div>
-          <p class="help" id="limitHelp">Max {{ max_file_mb|int }} MB per file</p>
-        </div>
-
-        <div class="files" id="file-list" aria-live="polite"></div>
-        <hr style="border:none; border-top:1px solid var(--border); margin:16px 0">
-
-        <div class="field">
-          <label for="manualText">Or, if you prefer, describe some of the exam materials yourself:</label>
-          <textarea id="manualText" rows="6" placeholder="Paste or type your study material here..."></textarea>
-          <div class="help">
-            We'll treat this exactly like an uploaded .txt file.
-            <span id="manualCount" style="float:right">0 characters</span>
-          </div>
-        </div>
-      </section>
-
-      <!-- Right: Options -->
-      <section class="card">
-        <h2 style="margin:0 0 8px">Options</h2>
-        <div class="field">
-  <label for="title">Title</label>
-  <input type="text" id="title" maxlength="80" placeholder="e.g. Physics Mock Paper" value="" />
-  <div id="titleHelp" class="help">Appears on both PDFs</div>
-  <div id="titleHint" class="help" style="margin-top:6px; display:none; color: var(--err);">
-    Please enter a title.
-  </div>
-</div>
-<div class="field" id="qcountRow" style="margin-top:10px">
-  <label for="qcount">Number of questions</label>
-  <div class="select-wrap">
-    <select id="qcount" class="select"></select>
-  </div>
-  <div id="qcountHint" class="help" style="margin-top:6px; display:none; color: var(--err);">
-    Please select a number of questions.
-  </div>
-</div>
-        <div id="optDifficulty" class="field" style="margin-top:12px">
-  <label for="difficulty">Overall difficulty level:</label>
-  <div class="radio-inline" role="radiogroup" aria-label="Difficulty level">
-    <label><input type="radio" name="difficulty" id="diff-easy" value="easy"> Easy <span class="help">(fastest)</span></label>
-    <label><input type="radio" name="difficulty" id="diff-medium" value="medium" checked> Medium <span class="help">(standard)</span></label>
-    <label><input type="radio" name="difficulty" id="diff-hard" value="hard"> Hard <span class="help">(slowest)</span></label>
-  </div>
-  <div class="help">Relative estimates only: Easy ≈ 0.8× time, Medium ≈ 1.0×, Hard ≈ 1.2×.</div>
-  <div class="help">Individual question settings can be tweaked in Advanced.</div>
-</div>
-
-
-        <div class="btn-row" style="justify-content:flex-start; margin-top:16px">
-          <button class="btn primary" id="submitBtn" type="button" disabled>
-            <span id="submitSpinner" class="spinner" style="display:none"></span>
-            Generate PDFs
-          </button>
-          <button class="btn ghost" id="clearBtn" type="button">Clear list</button>
-        </div>
-
-        <div id="response" class="status" role="status" aria-live="polite"></div>
-      </section>
-    </div>
-
-<!-- Advanced -->
-<details id="advancedCard" class="card fade-in" style="display:none; margin-top:16px">
-  <summary class="adv-summary">
-    <span class="adv-title">Advanced</span>
-    <span class="adv-count" id="advCount" aria-live="polite"></span>
-  </summary>
-
-  <div class="adv-body">
-  <!-- NEW: per-question customization toggles -->
-  <div class="adv-controls">
-    <fieldset class="adv-checks">
-      <legend class="sr-only">Per-question customization</legend>
-
-      <label class="chk">
-        <input type="checkbox" id="advTopicChk">
-        Provide additional instructions per question
-      </label>
-
-      <label class="chk">
-        <input type="checkbox" id="advDiffChk">
-        Customize individual question difficulties
-      </label>
-
-      <label class="chk">
-        <input type="checkbox" id="advTypeChk">
-        Customize individual question types
-      </label>
-    </fieldset>
-  </div>
-
-  <div id="advEmpty" class="help">No questions yet. Pick counts in Options.</div>
-  <div id="qGrid" class="qgrid" role="list"></div>
-</div>
-</details>
-<!-- Progress Section -->
-    <div id="progressSection" class="progress-section" tabindex="-1" role="region" aria-label="Generation progress">
-      <div class="progress-header">
-        <h3 style="margin:0; font-size:1.1rem;">Generating your exam paper...</h3>
-        <div class="spinner"></div>
-      </div>
-
-      <div class="time-estimate">
-        <strong>Estimated time:</strong> <span id="timeEstimate">30-60 seconds</span>
-      </div>
-
-      <div class="progress-bar-container">
-        <div id="progressBar" class="progress-bar"></div>
-      </div>
-
-      <div class="progress-steps" id="progressSteps">
-        <div class="progress-step">
-          <div class="step-icon pending" id="step1">1</div>
-          <div class="step-text">Processing and analyzing your files...</div>
-          <div class="step-time" id="time1"></div>
-        </div>
-        <div class="progress-step">
-          <div class="step-icon pending" id="step2">2</div>
-          <div class="step-text">Creating intelligent summaries...</div>
-          <div class="step-time" id="time2"></div>
-        </div>
-        <div class="progress-step">
-          <div class="step-icon pending" id="step3">3</div>
-          <div class="step-text">Generating exam questions...</div>
-          <div class="step-time" id="time3"></div>
-        </div>
-        <div class="progress-step">
-          <div class="step-icon pending" id="step4">4</div>
-          <div class="step-text">Creating marking scheme...</div>
-          <div class="step-time" id="time4"></div>
-        </div>
-        <div class="progress-step">
-          <div class="step-icon pending" id="step5">5</div>
-          <div class="step-text">Compiling PDFs...</div>
-          <div class="step-time" id="time5"></div>
-        </div>
-      </div>
-    </div>
-    <!-- Downloads -->
-<section id="downloadsCard" class="card fade-in" style="display:none; margin-top:16px">
-  <h2 style="margin:0 0 8px">Downloads</h2>
-  <div class="btn-row" style="justify-content:flex-start">
-    <a id="dlQuestions" class="btn" href="#" aria-disabled="true">
-      <span class="mini-spinner" aria-hidden="true"></span>Questions.pdf
-    </a>
-    <a id="dlAnswers" class="btn" href="#" aria-disabled="true">
-      <span class="mini-spinner" aria-hidden="true"></span>Answers.pdf
-    </a>
-  </div>
-  <div class="help">These will activate automatically when ready. You can keep browsing this page.</div>
-</section>
-
-
-    <div class="footer">By uploading, you confirm you have rights to the content. Supported: .txt, .pdf, .docx, .pptx, .rtf</div>
-  </div>
-
-  <script>
-    const MAX_FILE_MB = {{ max_file_mb|int }};
-    const validExts = [".txt",".pdf",".docx",".pptx",".rtf"];
-
-    const drop = document.getElementById('drop');
-    const downloadsCard = document.getElementById('downloadsCard');
-const dlQuestions = document.getElementById('dlQuestions');
-const dlAnswers = document.getElementById('dlAnswers');
-    const chooseBtn = document.getElementById('chooseBtn');
-    const fileInput = document.getElementById('file');
-    const fileList = document.getElementById('file-list');
-    const submitBtn = document.getElementById('submitBtn');
-    const submitSpinner = document.getElementById('submitSpinner');
-    const clearBtn = document.getElementById('clearBtn');
-    const responseEl = document.getElementById('response');
-    const manualTextEl = document.getElementById('manualText');
-    const manualCountEl = document.getElementById('manualCount');
-    const progressSection = document.getElementById('progressSection');
-const optDifficulty = document.getElementById('optDifficulty');
-const titleHelp     = document.getElementById('titleHelp');
-const advCountEl    = document.getElementById('advCount');
-    const MAX_RETRIES = 0; // Avoid hammering TPM after a 429; user can click again
-    const progressBar = document.getElementById('progressBar');
-    const titleInput = document.getElementById('title');
-const titleHint  = document.getElementById('titleHint');
-    const timeEstimate = document.getElementById('timeEstimate');
-    let qErrorArmed = false; // show question-count error only after a failed submit
-    let titleErrorArmed = false;
-    let qcountErrorArmed = false; // show qcount error only after a failed submit
-    let serverProgress = 0;      // % from backend
-  let statusInterval = null;   // polling timer
-  let currentJob = null;       // job id for this run
-  let genAbort = null;         // AbortController for /upload
-let didCancel = false;       // flag to suppress error UI on cancel
-let clearListDefault = null; // original Clear-list handler we can restore
-  const SOFT_CAP = 85;  
-    let lastProgress = 0; // ensures progress never decreases
-    let visibleProgress = 0;         // what we actually render
-let genStartTs = 0;              // when generation started
-// remember the user's global difficulty to restore later
-let savedGlobalDifficulty = null;
-const INTRO_HOLD_MS = 1800;      // ignore server jumps for the first 1.8s
-const MAX_STEP = 2.2;            // max % the bar may advance per tick
-const CATCHUP = 0.35;   
-function lockUI(){
-  document.body.classList.add('ui-locked');
-
-  // Left column
-  chooseBtn.disabled = true;
-  chooseBtn.setAttribute('aria-disabled','true');
-  fileInput.disabled = true;
-  drop.setAttribute('aria-disabled','true');
-  manualTextEl.disabled = true;
-
-  // Options
-  titleInput.disabled = true;
-  qcountInput.disabled = true;
-  document.querySelectorAll('input[name="difficulty"]').forEach(r => r.disabled = true);
-  optDifficulty?.setAttribute('aria-disabled','true');
-
-  // Advanced: keep the <summary> clickable, but disable all controls inside the panel
-  advancedCard
-    .querySelectorAll(':where(input, textarea, select, button)')
-    .forEach(el => { el.disabled = true; });
-
-  // DO NOT touch the Downloads links; they should remain usable.
-}
-
-function unlockUI(){
-  document.body.classList.remove('ui-locked');
-
-  // Left column
-  chooseBtn.disabled = false;
-  chooseBtn.removeAttribute('aria-disabled');
-  fileInput.disabled = false;
-  drop.removeAttribute('aria-disabled');
-  manualTextEl.disabled = false;
-  clearBtn.disabled = false;
-  clearBtn.removeAttribute('aria-disabled');
-
-  // Options
-  titleInput.disabled = false;
-  qcountInput.disabled = false;
-  document.querySelectorAll('input[name="difficulty"]').forEach(r => r.disabled = false);
-  optDifficulty?.removeAttribute('aria-disabled');
-
-  // Advanced controls back on; re-apply your per-question enable/disable rules
-  advancedCard
-    .querySelectorAll(':where(input, textarea, select, button)')
-    .forEach(el => { el.disabled = false; });
-
-  applyAdvToggles();     // respects advTopicChk/advDiffChk/advTypeChk
-  refreshSubmitState();  // re-evaluate submit availability
-}
-function swapClearToCancel(){
-  // preserve original handler if not already stored
-  if (!clearListDefault) clearListDefault = clearBtn.onclick || clearListDefaultHandler;
-
-  clearBtn.textContent = 'Cancel';
-  clearBtn.classList.remove('ghost');
-  clearBtn.classList.add('danger');
-  clearBtn.removeAttribute('aria-disabled');
-  clearBtn.disabled = false;
-  clearBtn.onclick = cancelGeneration;
-}
-
-function restoreClearAsClear(){
-  clearBtn.textContent = 'Clear list';
-  clearBtn.classList.remove('danger');
-  clearBtn.classList.add('ghost');
-  clearBtn.onclick = (clearListDefault || clearListDefaultHandler);
-  clearBtn.disabled = false;
-  clearBtn.removeAttribute('aria-disabled');
-}
-
-async function cancelGeneration(){
-  // mark intent and stop the request
-  didCancel = true;
-
-  // ask backend to stop current job (best effort)
-  try {
-    if (currentJob) {
-      await fetch('/cancel', {
-        method:'POST',
-        headers:{ 'Content-Type':'application/json' },
-        body: JSON.stringify({ job: currentJob })
-      });
-    }
-  } catch (_) {}
-
-  // abort the in-flight /upload fetch (front-end)
-  try { if (genAbort) genAbort.abort(); } catch (_) {}
-
-  // stop progress/status UI
-if (statusInterval) { clearInterval(statusInterval); statusInterval = null; }
-resetProgress();
-deactivateDownloads('Generation canceled. No files were produced.');
-
-  // UI: restore
-  restoreClearAsClear();
-  submitSpinner.style.display = 'none';
-  unlockUI();
-  setStatus('warn', 'Generation canceled. Your files and settings are preserved.');
-
-  // remove leave protection + restore title (use globals set below)
-  try { if (window._beforeUnloadHandler) window.removeEventListener('beforeunload', window._beforeUnloadHandler); } catch(_) {}
-  if (window._originalTitle) document.title = window._originalTitle;
-  window._beforeUnloadHandler = null;
-  genAbort = null;
-}
-    let files = [];
-    let progressInterval;
-    let startTime;
-const qcountInput = document.getElementById('qcount');
-// --- Advanced widgets model + DnD ---
-const advancedCard = document.getElementById('advancedCard');
-const qGrid        = document.getElementById('qGrid');   // matches your HTML
-qGrid.addEventListener('change', (e) => {
-  const t = e.target;
-  if (!t.matches('input[type="radio"][name^="type_"]')) return;
-
-  const card = t.closest('.qcard');
-  if (!card) return;
-
-  const id = card.dataset.id;
-  const item = advModel.find(x => x.id === id);
-  if (!item) return;
-
-  item.type = t.value;
-
-  const qtypeEl = card.querySelector('.qtype');
-  if (qtypeEl) qtypeEl.textContent = `Type: ${item.type}`;
-
-  card.dataset.type = item.type || '';
-  if (!item.type) card.removeAttribute('data-type');
-  refreshSubmitState();
-});
-
-let advModel = [];
-// Persist any in-flight edits from the DOM into advModel (topic, per-question diff)
-function captureAdvFormState(){
-  qGrid.querySelectorAll('.qcard').forEach(card => {
-    const id = card.dataset.id;
-    const item = advModel.find(x => x.id === id);
-    if (!item) return;
-
-    // topic
-    const t = card.querySelector(`#topic_${id}`);
-    if (t) item.topic = t.value;
-
-    // per-question difficulty
-    const d = card.querySelector(`input[name="diff_${id}"]:checked`);
-    if (d) item.diff = d.value;
-  });
-}
-let dragSrcId = null;
-
-const mkId = () =>
-  (crypto.randomUUID ? crypto.randomUUID() : 'id_' + Math.random().toString(36).slice(2));
-// remove the other two qcountInput.addEventListener('change', ...) lines
-qcountInput.addEventListener('change', () => {
-  syncAdvToQCount();      // only rebuild when the count actually changes
-  refreshSubmitState();   // then (cheap) validation / enablement
-});
-function fillRange(id, min, max){
-  const el = document.getElementById(id);
-  el.innerHTML = '';
-  for (let i = min; i <= max; i++){
-    const opt = document.createElement('option');
-    opt.value = String(i);
-    opt.textContent = String(i);
-    el.appendChild(opt);
-  }
-  el.value = String(min);
-}
-
-// Replace old fillRange usage for qcount with this:
-  function populateQCountWithPlaceholder(id, min, max){
-    const el = document.getElementById(id);
-    el.innerHTML = '';
-
-    // Placeholder option
-    const ph = document.createElement('option');
-    ph.value = '';
-    ph.textContent = 'Select';
-    ph.disabled = false;    // keep it clickable so users can open the menu
-    ph.selected = true;     // default selection
-    el.appendChild(ph);
-
-    for (let i = min; i <= max; i++){
-      const opt = document.createElement('option');
-      opt.value = String(i);
-      opt.textContent = String(i);
-      el.appendChild(opt);
-    }
-
-    // Ensure the placeholder is the current value
-    el.value = '';
-  }
-
-  // Populate on load
-  populateQCountWithPlaceholder('qcount', 1, 30);
-applyAdvToggles(); // already present, but safe to call here too
-refreshSubmitState();
-// Helper: parse counts safely
-    function utf8Bytes(str){
-      const enc = new TextEncoder();
-      return enc.encode(str);
-    }
-
-    function manualTextToFile(){
-      const text = document.getElementById('manualText').value.trim();
-      if (!text) return null;
-      const blob = new Blob([text], { type: 'text/plain' });
-      return new File([blob], 'manual_input.txt', { type: 'text/plain' });
-    }
-
-    function bytesToSize(bytes){
-      const u = ['B','KB','MB','GB']; let i=0, n=bytes;
-      while(n>=1024 && i<u.length-1){ n/=1024; i++; }
-      return n.toFixed(n>=10||i===0?0:1)+' '+u[i];
-    }
-
-    function allowedExtension(filename){
-      const idx = filename.lastIndexOf(".");
-      if (idx < 0) return false;
-      const ext = filename.substring(idx).toLowerCase();
-      return validExts.includes(ext);
-    }
-
-    async function calculateFileHash(file){
-      const buf = await file.arrayBuffer();
-      const hashBuffer = await crypto.subtle.digest('SHA-256', buf);
-      const arr = Array.from(new Uint8Array(hashBuffer));
-      return arr.map(b=>b.toString(16).padStart(2,'0')).join('');
-    }
-
-    function setStatus(type, html){
-      responseEl.className = 'status show ' + type;
-      responseEl.innerHTML = html;
-    }
+        # a failing probe is re-checked sooner so recovery shows up quickly
+        ttl = READYZ_TTL_SEC if ok else min(READYZ_TTL_SEC, 5.0)
+        _READY_CACHE = (now + ttl, ok, checks)
+        return ok, checks
 
-    function clearStatus(){
-      responseEl.className = 'status';
-      responseEl.innerHTML = '';
-    }
-function refreshSubmitState(){
-  const hasManual = !!manualTextEl.value.trim();
-  const titleVal  = titleInput.value.trim();
-  const isExam = true;
-  const qcountOK  = getQuestionCount() > 0; // true only when not on placeholder
-
-  // Enable submit when there is at least one input (files or manual).
-  // We do NOT block the button for qcount here so the user can "attempt"
-  // and then we show the red hint.
-  const hasAnyInput = (files.length > 0 || hasManual);
-  // Block submit unless required per-question radios are filled (when toggled on)
-const diffOn = !!document.getElementById('advDiffChk')?.checked;
-const typeOn = !!document.getElementById('advTypeChk')?.checked;
-const totalQs = getQuestionCount();
-
-// Count checked radios in the advanced grid
-const diffsChecked = document.querySelectorAll('.qopt-diff input[type="radio"]:checked').length;
-const typesChecked = document.querySelectorAll('.qopt-type input[type="radio"]:checked').length;
-
-// You must fill the radios for whichever checklist(s) are on
-let perQuestionOK = true;
-if (diffOn) perQuestionOK = perQuestionOK && (diffsChecked === totalQs);
-if (typeOn) perQuestionOK = perQuestionOK && (typesChecked === totalQs);
-
-// Final enable/disable
-submitBtn.disabled = !(hasAnyInput && perQuestionOK);
-
-
-  // Title inline error
-  if (titleErrorArmed && !titleVal) {
-    titleHint.style.display = 'block';
-    titleInput.classList.add('invalid');
-  } else {
-    titleHint.style.display = 'none';
-    titleInput.classList.remove('invalid');
-    if (titleVal) titleErrorArmed = false;
-  }
-
-  // qcount inline hint only AFTER an attempted submit
-  const qcountHint = document.getElementById('qcountHint');
-  const qcountSel  = document.getElementById('qcount');
-  const showQErr   = qcountErrorArmed && isExam && !qcountOK;
-
-  if (qcountHint) qcountHint.style.display = showQErr ? 'block' : 'none';
-  if (qcountSel)  qcountSel.classList.toggle('invalid', showQErr);
-
-  // Keep Advanced widget count in sync with qcount
-}
-    function renderFiles(){
-      fileList.innerHTML = '';
-      files.forEach(({file, hash})=>{
-        const item = document.createElement('div');
-        item.className = 'file';
-        const ext = file.name.split('.').pop()?.toUpperCase() || '';
-        item.innerHTML = `
-          <span class="badge" aria-label="File type">${ext}</span>
-          <div class="file-main">
-            <div class="file-name" title="${file.name}">${file.name}</div>
-            <div class="file-meta">${bytesToSize(file.size)}</div>
-          </div>
-          <button class="file-remove" aria-label="Remove ${file.name}">&times;</button>
-        `;
-         item.querySelector('.file-remove').onclick = ()=>{
-   const idx = files.findIndex(f => f.hash === hash);
-  if (idx > -1) {
-    files.splice(idx, 1);
-    renderFiles();
-    refreshSubmitState();
-}
-        };
-        fileList.appendChild(item);
-      });
-    }
-
-    async function acceptFileList(list){
-  clearStatus();
-
-  const incoming = Array.isArray(list) ? list : Array.from(list || []);
-  const existingHashes = new Set(files.map(f => f.hash));
-  const batchHashes = new Set();
-
-  for (const f of incoming){
-    if (!allowedExtension(f.name)){
-      setStatus('warn', `Unsupported format for <strong>${f.name}</strong>. Allowed: ${validExts.join(', ')}`);
-      continue;
-    }
-    if (f.size > MAX_FILE_MB*1024*1024){
-      setStatus('warn', `<strong>${f.name}</strong> is larger than ${MAX_FILE_MB} MB.`);
-      continue;
-    }
 
-    const hash = await calculateFileHash(f);
-    if (existingHashes.has(hash) || batchHashes.has(hash)){
-      setStatus('warn', `Duplicate content detected for <strong>${f.name}</strong>. Skipped.`);
-      continue;
-    }
-
-    files.push({ file: f, hash });
-    batchHashes.add(hash);
-  }
-
-  renderFiles();
-  refreshSubmitState();
-}
-
-
-    function estimateProcessingTime() {
-  const isExam = true;
-  const totalFiles = files.length + (manualTextEl.value.trim() ? 1 : 0);
-
-  const numQuestions = getQuestionCount();
-
-  let estimatedSeconds = 15;
-estimatedSeconds += totalFiles * 3;
-estimatedSeconds += numQuestions * 1.5;
-
-  if (estimatedSeconds < 20) return "30-45 seconds";
-  if (estimatedSeconds < 40) return "45-60 seconds";
-  if (estimatedSeconds < 60) return "60-90 seconds";
-  return "1-2 minutes";
-}
-
-    function updateProgressStep(stepNumber, status, timeText = '') {
-      const stepIcon = document.getElementById(`step${stepNumber}`);
-      const stepTime = document.getElementById(`time${stepNumber}`);
-
-      stepIcon.className = `step-icon ${status}`;
-      if (status === 'complete') {
-        stepIcon.innerHTML = '✓';
-      } else if (status === 'active') {
-        stepIcon.innerHTML = stepNumber;
-      }
-
-      if (stepTime && timeText) {
-        stepTime.textContent = timeText;
-      }
-    }
-
-    function startProgressSimulation() {
-  startTime = Date.now();
-  progressSection.classList.add('show', 'fade-in');
-    // Auto-scroll to the progress section when generation starts
-  // Wait one frame so the browser lays out the newly-shown section, then scroll.
-  requestAnimationFrame(() => {
-    // a11y: move programmatic focus to the region, without causing a second jump
-    if (!progressSection.hasAttribute('tabindex')) progressSection.setAttribute('tabindex', '-1');
-    progressSection.focus({ preventScroll: true });
-
-    // smooth scroll the section to the top of the viewport
-    progressSection.scrollIntoView({ behavior: 'smooth', block: 'start' });
-  });
-  timeEstimate.textContent = estimateProcessingTime();
-
-  let currentStep = 1;
-  let progress = 0;
-  lastProgress = 0; // reset monotonic tracker each run
-  genStartTs = Date.now();
-visibleProgress = 0;
-
-  const stepTimings = [
-    { step: 1, duration: 8000, progress: 15 },
-    { step: 2, duration: 15000, progress: 35 },
-    { step: 3, duration: 20000, progress: 70 },
-    { step: 4, duration: 8000, progress: 85 },
-    { step: 5, duration: 7000, progress: 100 }
-  ];
-
-  let stepStartTime = Date.now();
-  updateProgressStep(1, 'active');
-
-  progressInterval = setInterval(() => {
-    const stepElapsed = Date.now() - stepStartTime;
-
-    // Handle step transitions
-    const currentStepData = stepTimings[currentStep - 1];
-    if (currentStepData && stepElapsed >= currentStepData.duration) {
-  const stepDuration = ((Date.now() - stepStartTime) / 1000).toFixed(1);
-
-  if (currentStep < 5) {
-    // Steps 1–4 can turn green when their simulated time elapses
-    updateProgressStep(currentStep, 'complete', `${stepDuration}s`);
-    currentStep++;
-    if (currentStep <= stepTimings.length) {
-      stepStartTime = Date.now();
-      updateProgressStep(currentStep, 'active');
-    }
-  } else {
-    // Step 5 should remain BLUE (active) until the server actually finishes.
-    // Do nothing here; completeProgress() will mark it 'complete' at the real end.
-  }
-}
-
-
-    // ===== SMOOTHED HYBRID PROGRESS SECTION =====
-
-// 1) Compute simulated target for the current step
-const targetProgress = stepTimings.find(s => s.step === currentStep)?.progress || 0;
-const randomFactor = Math.random() * 5 - 2.5; // ±2.5%
-let sim = targetProgress + randomFactor;
-sim = Math.min(SOFT_CAP, sim); // SOFT_CAP = 85
-
-// 2) For the first INTRO_HOLD_MS, ignore server jumps to avoid the "sudden halfway" effect
-const now = Date.now();
-const inIntro = (now - genStartTs) < INTRO_HOLD_MS;
-
-// Goal is either calm simulation (during intro) or the higher of sim/server (after intro)
-let goal = inIntro ? Math.min(sim, SOFT_CAP) : Math.max(sim, serverProgress);
-
-// Keep the UI below 95% until the server is actually near the end
-if (serverProgress < 96) goal = Math.min(95, goal);
-
-// 3) Rate-limit toward the goal (no big jumps)
-if (goal > visibleProgress) {
-  const gap = goal - visibleProgress;                  // how far we are from where we want to be
-  const step = Math.min(MAX_STEP, Math.max(0.6, gap * CATCHUP)); // close a fraction, but cap per tick
-  visibleProgress += step;
-}
-
-// 4) Monotonic safety and render
-visibleProgress = Math.max(visibleProgress, lastProgress);
-lastProgress = visibleProgress;
-progress = visibleProgress;
-progressBar.style.width = `${progress}%`;
-
-// ===== END SMOOTHED HYBRID PROGRESS SECTION =====
-
-  }, 500);
-}
-
-
-
-    function completeProgress() {
-      if (progressInterval) {
-        clearInterval(progressInterval);
-        progressInterval = null;
-      }
-      if (statusInterval) { clearInterval(statusInterval); statusInterval = null; }
-
-      // Complete all remaining steps
-      for (let i = 1; i <= 5; i++) {
-        updateProgressStep(i, 'complete');
-      }
-
-      progressBar.style.width = '100%';
-      lastProgress = 100; // <-- add this
-      visibleProgress = 100;
-
-      // Hide progress section after a brief delay
-      setTimeout(() => {
-        progressSection.classList.remove('show');
-      }, 2000);
-    }
-
-    function resetProgress() {
-      if (progressInterval) {
-        clearInterval(progressInterval);
-        progressInterval = null;
-      }
-      if (statusInterval) { clearInterval(statusInterval); statusInterval = null; }
-
-      progressSection.classList.remove('show');
-progressBar.style.width = '0%';
-lastProgress = 0;
-serverProgress = 0;
-visibleProgress = 0;    // <-- add
-genStartTs = 0;         // <-- add
-
-
-      // Reset all steps
-      for (let i = 1; i <= 5; i++) {
-        updateProgressStep(i, 'pending');
-        const stepIcon = document.getElementById(`step${i}`);
-        const stepTime = document.getElementById(`time${i}`);
-        stepIcon.innerHTML = i;
-        if (stepTime) stepTime.textContent = '';
-      }
-    }
-    function startStatusPolling(job) {
-  serverProgress = 0;
-  if (statusInterval) { clearInterval(statusInterval); statusInterval = null; }
-  statusInterval = setInterval(async () => {
-    try {
-      const r = await fetch(`/status?job=${encodeURIComponent(job)}`, { cache: 'no-store' });
-      if (!r.ok) return;
-      const s = await r.json();
-
-      if (typeof s.pct === 'number') {
-        serverProgress = Math.max(serverProgress, s.pct);
-      }
-      // Optional: reflect step labels in UI (kept simple here)
-      // if (s.label) { /* you could display s.label somewhere */ }
-
-      if (s.status === 'done' || serverProgress >= 100) {
-  // Let the smoothing loop take it to 100; then finalize once we're close
-  serverProgress = 100;
-  if (visibleProgress >= 99) {
-    completeProgress();
-    clearInterval(statusInterval);
-    statusInterval = null;
-  }
-}
-    } catch (e) {
-      // ignore intermittent network errors
-    }
-  }, 1000);
-}
-
-    function showDownloadsPending() {
-  downloadsCard.style.display = 'block';
-
-// reset the default helper text each run
-const help = downloadsCard.querySelector('.help');
-if (help) {
-  help.textContent = 'These will activate automatically when ready. You can keep browsing this page.';
-}
+# =========================
+# Web app
+# =========================
+@lru_cache(maxsize=32)
+def _static_version(folder: str, name: str) -> str:
+    """Short content hash of a static asset (read once per process)."""
+    with open(os.path.join(folder, name), "rb") as f:
+        return hashlib.blake2b(f.read(), digest_size=6).hexdigest()
 
-// disable links + ensure each has a spinner
-[dlQuestions, dlAnswers].forEach(a => {
-  a.setAttribute('aria-disabled', 'true');
-  a.removeAttribute('href');
-  a.removeAttribute('target');
-  if (!a.querySelector('.mini-spinner')) {
-    const s = document.createElement('span');
-    s.className = 'mini-spinner';
-    s.setAttribute('aria-hidden', 'true');
-    a.prepend(s);
-  }
-});
-}
 
-function activateDownloads() {
-  // Enable & point directly at your Flask downloads
-  dlQuestions.removeAttribute('aria-disabled');
-  dlQuestions.href = '/download/questions';
-  dlQuestions.target = '_blank';
+class ExamFlask(Flask):
+    def get_send_file_max_age(self, filename):
+        # versioned static assets (?v=<hash>) may be cached for a year; PDFs and the rest keep the default
+        if request.endpoint == "static" and request.args.get("v"):
+            return STATIC_MAX_AGE_SEC
+        return super().get_send_file_max_age(filename)
 
-  dlAnswers.removeAttribute('aria-disabled');
-  dlAnswers.href = '/download/answers';
-  dlAnswers.target = '_blank';
 
-  // Remove the little spinners now that they’re ready
-  const spinners = downloadsCard.querySelectorAll('.mini-spinner');
-  spinners.forEach(s => s.remove());
-}
+def website():
+    app = ExamFlask(__name__)
+    app.request_class = UploadRequest
+    app.logger.setLevel(logging.INFO)
+    app.config["MAX_CONTENT_LENGTH"] = MAX_CONTENT_LENGTH
 
+    # --- Stage 15: request ID + security headers ---
 
-    // Drag & drop
-    ;['dragenter','dragover'].forEach(evt=>{
-      drop.addEventListener(evt, e=>{ e.preventDefault(); e.stopPropagation(); drop.classList.add('dragover'); });
-    });
-    document.getElementById('advTopicChk')?.addEventListener('change', applyAdvToggles);
-document.getElementById('advDiffChk') ?.addEventListener('change', applyAdvToggles);
-document.getElementById('advTypeChk') ?.addEventListener('change', applyAdvToggles);
-
-// Also call once on load in case Advanced is already open:
-applyAdvToggles();
-titleInput.addEventListener('input', refreshSubmitState);
-    ;['dragleave','drop'].forEach(evt=>{
-      drop.addEventListener(evt, e=>{ e.preventDefault(); e.stopPropagation(); drop.classList.remove('dragover'); });
-    });
-    drop.addEventListener('drop', e=>{
-    if (document.body.classList.contains('ui-locked')) return;
-      const dt = e.dataTransfer;
-      if (dt?.files?.length) acceptFileList(dt.files);
-    });
-
-    chooseBtn.onclick = ()=> fileInput.click();
-     fileInput.onchange = async () => {
-  const picked = Array.from(fileInput.files); // snapshot, not live
-  await acceptFileList(picked);               // wait for hashing, etc.
-  fileInput.value = '';                       // now safe to clear
-};
-
-    manualTextEl.addEventListener('input', ()=>{
-      const len = manualTextEl.value.length;
-      manualCountEl.textContent = `${len} character${len===1?'':'s'}`;
-      refreshSubmitState();
-    });
-function deactivateDownloads(reason = '') {
-  // disable links and remove any pending spinners
-  [dlQuestions, dlAnswers].forEach(a => {
-    a.setAttribute('aria-disabled', 'true');
-    a.removeAttribute('href');
-    a.removeAttribute('target');
-  });
-  const spinners = downloadsCard.querySelectorAll('.mini-spinner');
-  spinners.forEach(s => s.remove());
-
-  if (reason) {
-    const help = downloadsCard.querySelector('.help');
-    if (help) help.textContent = reason;
-  }
-}
-function clearListDefaultHandler(){
-  files = []; renderFiles();
-  manualTextEl.value = ''; manualCountEl.textContent = '0 characters';
-  qErrorArmed = false;
-  advModel = []; renderAdvGrid();    // <-- reset Advanced
-  refreshSubmitState(); clearStatus(); resetProgress();
-}
-clearListDefault = clearListDefaultHandler;   // save original
-clearBtn.onclick = clearListDefaultHandler;   // wire it up as default
-
-
-async function runGenerationOnce() {
-  clearStatus();          // no yellow boxes carried over
-  resetProgress();        // reset steps, bar, timers
-
-    // Passed validation — now proceed
-  // --- NEW: auto-open Advanced on generate ---
-    // --- NEW: auto-collapse Advanced on generate ---
-  advancedCard.open = false;
-
-  submitBtn.disabled = true;
-  submitSpinner.style.display = 'inline-block';
-lockUI();
-didCancel = false;         // new run
-swapClearToCancel();       // turn Clear into red Cancel
-  // fresh job id for a truly clean restart
-  currentJob = (crypto.randomUUID && crypto.randomUUID()) || Math.random().toString(36).slice(2);
-
-  // show disabled downloads each attempt for consistent UX
-  showDownloadsPending();
-
-  // leave-protection + title swap per attempt
-  const originalTitle = document.title;
-  const beforeUnloadHandler = (e)=>{ e.preventDefault(); e.returnValue=''; };
-  window.addEventListener('beforeunload', beforeUnloadHandler);
-  document.title = 'Generating… ⏳ ' + (document.getElementById('title').value || 'Mock Exam Paper');
-    window._originalTitle = originalTitle;            // expose for cancel
-window._beforeUnloadHandler = beforeUnloadHandler;
-  // start progress + backend polling
-  startProgressSimulation();
-  startStatusPolling(currentJob);
-
-  try {
-    const fd = new FormData();
-    fd.append('job', currentJob);
-
-    // files already in memory
-    files.forEach(({file})=> fd.append('file[]', file));
-
-    // optional manual text as a .txt file
-    const manualFile = manualTextToFile();
-    if (manualFile){
-      const buf = await manualFile.arrayBuffer();
-      const sha = await crypto.subtle.digest('SHA-256', buf);
-      const arr = Array.from(new Uint8Array(sha));
-      const manualHash = arr.map(b=>b.toString(16).padStart(2,'0')).join('');
-       const currentHashes = new Set(files.map(f => f.hash));
- if (!currentHashes.has(manualHash)) {
-   fd.append('file[]', manualFile);
- }
-    }
+    @app.before_request
+    def _req_ctx():
+        # honor inbound X-Request-ID or make one
+        rid = request.headers.get("X-Request-ID")
+        g.request_id = (rid.strip() if rid else f"{_RID_PREFIX}-{next(_RID_SEQ):x}")
 
-    fd.append('qcount', qcountInput.value || '1');
-// Keep legacy fields at 0 so backend doesn’t choke (until server supports qcount)
-fd.append('long',  '0');
-fd.append('short', '0');
-fd.append('mcq',   '0');
-fd.append('math',  '0');
-    fd.append('title', document.getElementById('title').value || 'Mock Exam Paper');
-    fd.append('mode', 'exam');
-    let chosenDifficulty = '';
-const perQuestionDiff = document.getElementById('advDiffChk')?.checked;
-
-if (!perQuestionDiff) {
-  chosenDifficulty = (document.querySelector('input[name="difficulty"]:checked') || {}).value || 'medium';
-}
-// If per-question is on, we intentionally send an empty string (no global difficulty)
-fd.append('difficulty', chosenDifficulty);
-// Per-question overrides
-const topicsOn = document.getElementById('advTopicChk')?.checked;
-const diffOn   = document.getElementById('advDiffChk')?.checked;
-const typeOn   = document.getElementById('advTypeChk')?.checked;
-
-if (advModel.length) {
-  if (typeOn) {
-    const types = advModel.map(it => {
-      const sel = document.querySelector(`input[name="type_${it.id}"]:checked`);
-      return sel ? sel.value : '';
-    });
-    fd.append('q_types', JSON.stringify(types));
-  }
-  if (topicsOn) {
-    const topics = advModel.map(it => {
-      const inp = document.getElementById(`topic_${it.id}`);
-      return inp ? inp.value.trim() : '';
-    });
-    fd.append('q_topics', JSON.stringify(topics));
-  }
-  if (diffOn) {
-    const diffs = advModel.map(it => {
-      const sel = document.querySelector(`input[name="diff_${it.id}"]:checked`);
-      return sel ? sel.value : '';
-    });
-    fd.append('q_diffs', JSON.stringify(diffs));
-  }
-}
+    @app.teardown_request
+    def _drop_spooled_parts(exc=None):
+        # only if the form was actually parsed; adopted parts are already gone
+        files = request.__dict__.get("files")
+        if files:
+            _discard_spooled(fs for _, fs in files.items(multi=True))
 
-    genAbort = new AbortController();
-const res = await fetch('/upload', { method:'POST', body: fd, signal: genAbort.signal });
-    const text = await res.text();
+    @app.after_request
+    def _secure_headers(resp: Response):
+        if request.endpoint == "static":
+            # scripts/stylesheets still need nosniff; caching and request ids don't apply
+            resp.headers["X-Content-Type-Options"] = "nosniff"
+            return resp
+        if request.path in _PROBE_PATHS:
+            return resp  # probes are not browser responses
+        h = resp.headers
+        # propagate request id (unset only if _req_ctx never ran)
+        rid = getattr(g, "request_id", None)
+        if rid is not None:
+            h["X-Request-ID"] = rid
+        # one pass over the existing headers instead of a list scan per setdefault
+        present = {k.lower() for k in h.keys()}
+        for lk, k, v in _SECURITY_HEADER_ITEMS:
+            if lk not in present:
+                h[k] = v
+        if request.path.startswith(_NO_STORE_PREFIXES):
+            h.update(_NO_STORE_HEADERS)
+        return resp
 
-    if (!res.ok) {
-      // fail this attempt cleanly so caller can restart from the top
-      throw new Error(text || 'Generation failed');
-    }
+    # --- Stage 13: global guards ---
+    # --- Stage 15: health / readiness probes ---
 
-    // success path
-    completeProgress();
-    activateDownloads();
-    setStatus('ok', 'Your PDFs are ready. Use the buttons below to download.');
-
-    // cleanup after success
-    files = []; renderFiles();
-    qErrorArmed = false;
-    refreshSubmitState();
-
-    return { ok: true };
-  } catch (e) {
-  // ensure UI is clean for a full restart (progress reset handled by cancelGeneration if used)
-  if (!didCancel) {
-  resetProgress();
-  clearStatus();
-  deactivateDownloads('Generation failed. No files were produced.');
-}
-  if (e && (e.name === 'AbortError' || didCancel)) {
-    return { ok: false, canceled: true };
-  }
-  return { ok: false, error: e?.message || 'Network error.' };
-}
- finally {
- restoreClearAsClear();  // always put the Clear button back
-genAbort = null;
-    // per-attempt cleanup
-    if (statusInterval) { clearInterval(statusInterval); statusInterval = null; }
-    window.removeEventListener('beforeunload', beforeUnloadHandler);
-    document.title = originalTitle;
-    submitSpinner.style.display = 'none';
-    unlockUI();
-    submitBtn.disabled = (files.length === 0 && !manualTextEl.value.trim());
-  }
-}
-/** Render the Advanced grid from advModel; renumber 1..N every time. */
-function getQuestionCount(){
-  const v = (qcountInput.value || '').trim();
-  if (!v) return 0; // placeholder not chosen
-  const n = parseInt(v, 10);
-  return Number.isNaN(n) ? 0 : Math.max(1, n);
-}
-function syncAdvToQCount(){
-  const N = getQuestionCount();
-
-  // shrink
-  if (advModel.length > N) {
-    advModel = advModel.slice(0, N);
-  }
-  // grow
-  while (advModel.length < N) {
-  advModel.push({ id: mkId(), topic: '', type: '', diff: '' });
-}
+    @app.route("/healthz")
+    def healthz():
+        # liveness: process is up (hand-built body, no JSON provider round trip)
+        return Response(f'{{"ok":true,"time":{int(time.time())}}}\n', status=200, mimetype="application/json")
 
-  renderAdvGrid();
-}
-function applyAdvToggles(){
-  const topicsOn = document.getElementById('advTopicChk')?.checked;
-  const diffOn   = document.getElementById('advDiffChk')?.checked;
-  const typeOn   = document.getElementById('advTypeChk')?.checked;
-
-  // Topic inputs
-  document.querySelectorAll('.qopt-topic').forEach(box=>{
-    box.classList.toggle('is-disabled', !topicsOn);
-    const inp = box.querySelector('textarea');
-    if (inp) inp.disabled = !topicsOn;
-  });
-
-  // Difficulty radios (per-question)
-  document.querySelectorAll('.qopt-diff').forEach(box=>{
-    box.classList.toggle('is-disabled', !diffOn);
-    box.querySelectorAll('input[type="radio"]').forEach(r=> r.disabled = !diffOn);
-  });
-
-  // Type radios
-  document.querySelectorAll('.qopt-type').forEach(box=>{
-    box.classList.toggle('is-disabled', !typeOn);
-    box.querySelectorAll('input[type="radio"]').forEach(r=> r.disabled = !typeOn);
-  });
-
-  // --- Global difficulty (Options tab) ---
-  const optDiffGroup  = document.getElementById('optDifficulty');
-  const globalRadios  = optDiffGroup ? optDiffGroup.querySelectorAll('input[name="difficulty"]') : [];
-
-  if (diffOn) {
-    // Save current selection ONCE when turning per-question on
-    if (savedGlobalDifficulty === null) {
-      const sel = Array.from(globalRadios).find(r => r.checked);
-      savedGlobalDifficulty = sel ? sel.value : null;
-    }
-    // Visually blank + lock the group while per-question is active
-    globalRadios.forEach(r => { r.checked = false; r.disabled = true; });
-    optDiffGroup?.setAttribute('aria-disabled','true');
-    optDiffGroup?.classList.add('is-disabled');
-  } else {
-    // Re-enable the group
-    globalRadios.forEach(r => { r.disabled = false; });
-    optDiffGroup?.removeAttribute('aria-disabled');
-    optDiffGroup?.classList.remove('is-disabled');
-
-    // ✅ Only restore a value if we previously saved one
-    if (savedGlobalDifficulty !== null) {
-      const target = Array.from(globalRadios).find(r => r.value === savedGlobalDifficulty);
-      if (target) {
-        Array.from(globalRadios).forEach(r => r.checked = false);
-        target.checked = true;
-      }
-      savedGlobalDifficulty = null; // clear stash after restoring
-    }
-    // 🔒 No "default to medium" here; leave user’s choice untouched.
-  }
-  // Re-check submit availability whenever toggles change
-refreshSubmitState();
-}
-function renderAdvGrid() {
-  const isExam = true;
-  const qcount  = getQuestionCount();
-  // Persist current input values before we wipe/rebuild the grid
-  captureAdvFormState();
-
-  // Advanced is only usable in exam mode AND when qcount is chosen
-  if (!isExam || qcount === 0) {
-    advancedCard.classList.add('adv-disabled');
-    advancedCard.style.display = isExam ? 'block' : 'none'; // show disabled header in exam mode
-    advancedCard.removeAttribute('open');                   // can't open
-    const emptyEl = document.getElementById('advEmpty');
-    if (emptyEl) emptyEl.style.display = isExam ? 'block' : 'none';
-    if (advCountEl) advCountEl.textContent = isExam ? 'Select a number' : '';
-    qGrid.innerHTML = '';
-    return;
-  }
-
-  // From here, Advanced is enabled and may open/close
-  advancedCard.classList.remove('adv-disabled');
-  advancedCard.style.display = 'block';
-
-  qGrid.innerHTML = '';
-  const count = advModel.length;
-
-  // show/hide the whole Advanced card
-  const emptyEl = document.getElementById('advEmpty');
-  if (!count) {
-    if (emptyEl) emptyEl.style.display = 'block';
-    if (advCountEl) advCountEl.textContent = '';
-    advancedCard.removeAttribute('open'); // keep it closed by default
-    return;
-  }
-
-  if (emptyEl) emptyEl.style.display = 'none';
-  if (advCountEl) advCountEl.textContent = `${count} question${count === 1 ? '' : 's'}`;
-
-  advModel.forEach((item, idx) => {
-    const el = document.createElement('div');
-    el.className = 'qcard';
-    el.dataset.id = item.id;
-    el.setAttribute('draggable', 'true');
-
-    el.innerHTML = `
-  <div class="qhead">
-    <div class="qleft">
-      <div class="qbadge" aria-label="Question ${idx+1}">${idx+1}</div>
-      <div class="qmeta">
-        <div class="qtitle">Question ${idx+1}</div>
-        <div class="qtype muted">Type: ${item.type || 'N/A'}</div>
-      </div>
-    </div>
-  </div>
-
-  <div class="qopts" role="group" aria-label="Options for question ${idx+1}">
-    <div class="qrow">
-      <!-- a) Topic -->
-      <div class="qopt qopt-topic is-disabled">
-        <label for="topic_${item.id}">Additional instructions:</label>
-        <textarea id="topic_${item.id}" placeholder="e.g. Make this a multi-part question about the periodic table" disabled maxlength="200" rows="3"></textarea>
-
-      </div>
-
-      <!-- b) Difficulty -->
-      <div class="qopt qopt-diff is-disabled">
-        <label>Difficulty</label>
-        <div class="pill-group" role="radiogroup" aria-label="Difficulty">
-          <label class="pill"><input type="radio" name="diff_${item.id}" value="easy"   disabled> Easy</label>
-          <label class="pill"><input type="radio" name="diff_${item.id}" value="medium" disabled> Medium</label>
-          <label class="pill"><input type="radio" name="diff_${item.id}" value="hard"   disabled> Hard</label>
-        </div>
-      </div>
-
-      <!-- c) Type -->
-      <div class="qopt qopt-type is-disabled">
-        <label>Question type</label>
-        <div class="pill-group" role="radiogroup" aria-label="Question type">
-          <label class="pill"><input type="radio" name="type_${item.id}" value="Long"  ${item.type==='Long'  ? 'checked' : ''} disabled> Long</label>
-          <label class="pill"><input type="radio" name="type_${item.id}" value="Short" ${item.type==='Short' ? 'checked' : ''} disabled> Short</label>
-          <label class="pill"><input type="radio" name="type_${item.id}" value="MCQ"   ${item.type==='MCQ'   ? 'checked' : ''} disabled> MCQ</label>
-          <label class="pill"><input type="radio" name="type_${item.id}" value="Math"  ${item.type==='Math'  ? 'checked' : ''} disabled> Math</label>
-        </div>
-      </div>
-    </div>
-  </div>
-`;
-// Restore Topic value and keep it synced to the model
-const topicInput = el.querySelector(`#topic_${item.id}`);
-if (topicInput) {
-  topicInput.value = item.topic || '';
-  topicInput.addEventListener('input', (e) => {
-    const m = advModel.find(x => x.id === item.id);
-    if (m) m.topic = e.target.value;
-  });
-}
+    @app.route("/readyz")
+    def readyz():
+        ok, checks = _readiness()
+        status = 200 if ok else 503
+        return _json_response({"ok": ok, "checks": checks, "time": int(time.time())}, status)
 
-// Restore per-question Difficulty and keep it synced
-if (item.diff) {
-  const d = el.querySelector(`input[name="diff_${item.id}"][value="${item.diff}"]`);
-  if (d) d.checked = true;
-}
-el.querySelectorAll(`input[name="diff_${item.id}"]`).forEach(r => {
-  r.addEventListener('change', (e) => {
-    const m = advModel.find(x => x.id === item.id);
-    if (m) m.diff = e.target.value;
-    refreshSubmitState();
-  });
-});
-if (item.type) {
-  el.dataset.type = item.type;     // enables your .qcard[data-type="…"] badge tint
-} else {
-  el.removeAttribute('data-type');
-}
-    el.addEventListener('dragstart', (e) => {
-      dragSrcId = item.id;
-      el.classList.add('dragging');
-      e.dataTransfer.effectAllowed = 'move';
-      e.dataTransfer.setData('text/plain', dragSrcId);
-    });
-    el.addEventListener('dragend', () => {
-      dragSrcId = null;
-      el.classList.remove('dragging');
-      qGrid.querySelectorAll('.drop-target').forEach(n => n.classList.remove('drop-target'));
-    });
-    el.addEventListener('dragover', (e) => { e.preventDefault(); e.dataTransfer.dropEffect = 'move'; });
-    el.addEventListener('dragenter', () => { if (el.dataset.id !== dragSrcId) el.classList.add('drop-target'); });
-    el.addEventListener('dragleave', () => { el.classList.remove('drop-target'); });
-    el.addEventListener('drop', (e) => {
-      e.preventDefault();
-      const src = e.dataTransfer.getData('text/plain') || dragSrcId;
-const tgt = el.dataset.id;
-if (!src || !tgt || src === tgt) return;
-const i = advModel.findIndex(x => x.id === src);
-const j = advModel.findIndex(x => x.id === tgt);
-if (i < 0 || j < 0) return;
-
-// NEW: persist any typed values before we mutate advModel
-captureAdvFormState();
-
-[advModel[i], advModel[j]] = [advModel[j], advModel[i]];
-renderAdvGrid();
-    });
-
-    qGrid.appendChild(el);
-  });
-
-  // Enable/disable per the three checkboxes
-  applyAdvToggles();
-  refreshSubmitState();
-}
-    async function submitFiles(){
-  clearStatus();
-  resetProgress();
-
-  const isExam = true;
-  const titleVal = titleInput.value.trim();
-  const qcountOK = getQuestionCount() > 0;
-
-  // Validate BEFORE disabling button / showing spinner
-  if (!titleVal) {
-    titleErrorArmed = true;
-    refreshSubmitState();
-    return;
-  }
-
-  if (isExam && !qcountOK) {
-    qcountErrorArmed = true;       // arm the red complaint now
-    refreshSubmitState();          // shows the red hint + invalid border
-    document.getElementById('qcount').focus();
-    return;
-  }
-
-  // Passed validation — now proceed
-  submitBtn.disabled = true;
-  submitSpinner.style.display = 'inline-block';
-// Hard-stop if total questions is 0 (extra safety)
-
-// --- auto-retry wrapper ---
-let attempt = 0;
-let result;
-
-do {
-  attempt++;
-  result = await runGenerationOnce();
-  if (result.ok) break; // success, stop retrying
-} while (attempt <= MAX_RETRIES);
-
-// If still failing after retries, show one final error box (not the inline field hints)
-if (!result.ok) {
-  if (result.canceled) {
-    // user canceled: no error box
-  } else {
-    setStatus(
-      'err',
-      `Sorry, we couldn't complete your generation${
-        MAX_RETRIES ? ` after ${attempt} attempt(s)` : ''
-      }. Please try again later.`
-    );
-  }
-}
-    }
+    @app.before_request
+    def _global_security_and_limits():
+        # Allow static files, favicon and probes without checks
+        if request.endpoint in {"static"} or request.path in _PROBE_PATHS:
+            return
+        # light maintenance
+        _periodic_maintenance()
 
-    submitBtn.onclick = submitFiles;
-
-    // Keyboard activation for drop area
-    drop.addEventListener('keydown', e=>{
-      if (e.key === 'Enter' || e.key === ' ') { e.preventDefault(); fileInput.click(); }
-    });
-    renderAdvGrid();
-refreshSubmitState();
-  </script>
-  <div class="maker-badge" aria-label="Made by Ashton Dowling">Made by Ashton Dowling</div>
-</body>
-</html>
-"""
+        # 1) Basic Auth (skip /upload here so we can complete its spinner using fail_progress)
+        if BASIC_AUTH_ENABLED and request.endpoint != "upload_file":
+            if not _auth_ok_for_request():
+                # plain 401 with WWW-Authenticate
+                return _need_www_auth()
 
-    if not os.path.exists(html_path) or open(html_path, "r", encoding="utf-8").read() != html_code:
-        with open(html_path, "w", encoding="utf-8") as f:
-            f.write(html_code)
+        # 2) Lightweight rate limiting for /status and /download
+        bucket = _EP_LIMITS.get(request.endpoint)
+        if bucket is not None and not _RL[bucket].allow(_client_ip()):
+            # JSON is fine here; frontend ignores occasional errors while polling
+            return _err_response("rl_" + bucket, 429)
 
-    # Clear folders on start
+    # Create and clear folders on start
     for folder in (UPLOAD_DIR, OUTPUT_DIR):
         os.makedirs(folder, exist_ok=True)
         for filename in os.listdir(folder):
@@ -4003,17 +2804,34 @@ refreshSubmitState();
             elif os.path.isdir(file_path):
                 shutil.rmtree(file_path)
 
+    def static_url(name: str) -> str:
+        # content-versioned, so the browser can cache it for a year and still see every deploy
+        return url_for("static", filename=name, v=_static_version(app.static_folder, name))
+
+    @lru_cache(maxsize=1)
+    def _home_page() -> tuple[bytes, bytes]:
+        # the page only varies by MAX_FILE_MB, so render and gzip it once per process
+        html = render_template("upload.html", max_file_mb=MAX_FILE_MB, static_url=static_url,
+                               allowed_exts=list(ALLOWED_EXTENSIONS_ORDERED)).encode("utf-8")
+        return html, gzip.compress(html, compresslevel=9)
+
     @app.route("/")
     def home():
-        return render_template("upload.html", max_file_mb=MAX_FILE_MB)
+        html, gz = _home_page()
+        if "gzip" in request.headers.get("Accept-Encoding", ""):
+            resp = Response(gz, mimetype="text/html")
+            resp.headers["Content-Encoding"] = "gzip"
+        else:
+            resp = Response(html, mimetype="text/html")
+        resp.headers["Vary"] = "Accept-Encoding"
+        return resp
 
     @app.route("/status")
     def status():
         job = request.args.get("job", "").strip()
         if not job:
             return {"error": "missing job"}, 400
-        with PROGRESS_LOCK:
-            state = PROGRESS.get(job)
+        state = PROGRESS.get(job)
         if not state:
             # Unknown job: return a neutral payload so the client doesn't break
             resp = {"status": "unknown", "pct": 0, "step": 0, "label": ""}
@@ -4035,8 +2853,7 @@ refreshSubmitState();
         job = (data.get("job") or request.form.get("job") or "").strip()
         if not job:
             return {"error": "missing job"}, 400
-        with CANCELED_LOCK:
-            CANCELED_JOBS.add(job)
+        mark_canceled(job)
         # Do NOT mark PROGRESS as 'done' here; the client handles UI reset on cancel.
         return {"ok": True}, 200
 
@@ -4065,12 +2882,10 @@ refreshSubmitState();
         if not filename:
             return "Invalid file requested", 400
 
-        meta = _read_run_meta() or {}
-        mode = meta.get("mode")
-        available = set(meta.get("available", []))
-
         path = os.path.join(OUTPUT_DIR, filename)
         if not os.path.exists(path):
+            # run meta is only needed to explain a miss
+            available = set((_read_run_meta() or {}).get("available", []))
             if available and kind not in available:
                 return (
                     f"The file for <em>{kind}.pdf</em> wasn’t produced in the last run. "
@@ -4080,8 +2895,9 @@ refreshSubmitState();
             # default fallback
             return "File not found. Generate it first.", 404
 
-        # Normal send
-        return send_from_directory(OUTPUT_DIR, filename, as_attachment=True)
+        # Normal send: conditional (ETag/Range) and handed to the server's file_wrapper, i.e. sendfile under gunicorn
+        return send_from_directory(OUTPUT_DIR, filename, as_attachment=True,
+                                   mimetype="application/pdf", conditional=True)
 
     @app.route("/download/manifest")
     def download_manifest():
@@ -4143,7 +2959,7 @@ refreshSubmitState();
                 return fail_progress(job, pct=96, step=1, label="Auth required",
                                      http_status=401, msg=ERR["auth_required"])
 
-            if not _rate_allow("upload", ip, RATE_UPLOADS_PER_MIN):
+            if not _RL["upload"].allow(ip):
                 return fail_progress(job, pct=96, step=1, label="Rate limited",
                                      http_status=429, msg=ERR["rl_upload"])
             if "file[]" not in request.files:
@@ -4296,42 +3112,27 @@ refreshSubmitState();
                     return fail_progress(job, pct=96, step=1, label="Invalid file format",
                                          http_status=415, msg=ERR["invalid_ext"].format(name=f.filename))
 
-                # Stream to a temp file, compute sha256 and size
-                hasher = hashlib.sha256()
-                tmp = tempfile.NamedTemporaryFile(dir=UPLOAD_DIR, delete=False)
-                size = 0
-                try:
-                    while True:
-                        chunk = f.stream.read(64 * 1024)
-                        if not chunk:
-                            break
-                        hasher.update(chunk)
-                        tmp.write(chunk)
-                        size += len(chunk)
-                        if size > MAX_FILE_MB * 1024 * 1024:
-                            tmp.close()
-                            os.unlink(tmp.name)
-                            return fail_progress(job, pct=96, step=1, label="File too large",
-                                                 http_status=413, msg=ERR["file_too_big"])
-                finally:
-                    tmp.flush();
-                    tmp.close()
+                # Adopt the spooled part (or copy it), computing sha256 and size
+                spooled = _spool_upload(f, MAX_FILE_MB * 1024 * 1024)
+                if spooled is None:
+                    return fail_progress(job, pct=96, step=1, label="File too large",
+                                         http_status=413, msg=ERR["file_too_big"])
+                tmp_name, size, file_hash = spooled
 
                 total_bytes += size
                 if total_bytes > TOTAL_UPLOAD_MB * 1024 * 1024:
-                    os.unlink(tmp.name)
+                    os.unlink(tmp_name)
                     return fail_progress(job, pct=96, step=1, label="Upload too large",
                                          http_status=413, msg=ERR["total_upload_too_big"])
 
-                file_hash = hasher.hexdigest()
                 if file_hash in seen_hashes:
                     # duplicate content; drop temp
-                    os.unlink(tmp.name)
+                    os.unlink(tmp_name)
                     continue
                 seen_hashes.add(file_hash)
 
                 # Light content sniff (first 8 bytes)
-                with open(tmp.name, "rb") as tfr:
+                with open(tmp_name, "rb") as tfr:
                     head = tfr.read(8)
 
                 ext = os.path.splitext(f.filename)[1].lower()
@@ -4341,9 +3142,9 @@ refreshSubmitState();
                     if ok:
                         # reject encrypted PDFs early
                         try:
-                            with fitz.open(tmp.name) as d:
+                            with fitz.open(tmp_name) as d:
                                 if getattr(d, "is_encrypted", False) and getattr(d, "needs_pass", False):
-                                    os.unlink(tmp.name)
+                                    os.unlink(tmp_name)
                                     return fail_progress(job, pct=96, step=2, label="Encrypted PDF",
                                                          http_status=422, msg=ERR["pdf_encrypted"])
                         except Exception:
@@ -4353,11 +3154,11 @@ refreshSubmitState();
                 elif ext in (".docx", ".pptx"):
                     ok = _looks_zip(head)
                     if ok:
-                        kind = _office_zip_kind(tmp.name)
+                        kind = _office_zip_kind(tmp_name)
                         if (ext == ".docx" and kind != "docx") or (ext == ".pptx" and kind != "pptx"):
                             ok = False
-                        if ok and not _zip_safety_ok(tmp.name):
-                            os.unlink(tmp.name)
+                        if ok and not _zip_safety_ok(tmp_name):
+                            os.unlink(tmp_name)
                             return fail_progress(job, pct=96, step=2, label="Unsafe Office archive",
                                                  http_status=422, msg=ERR["zip_bomb"])
                 elif ext == ".txt":
@@ -4367,7 +3168,7 @@ refreshSubmitState();
                     ok = False
 
                 if not ok:
-                    os.unlink(tmp.name)
+                    os.unlink(tmp_name)
                     return fail_progress(job, pct=96, step=1, label="Content/extension mismatch",
                                          http_status=415, msg=ERR["mime_mismatch"])
 
@@ -4386,7 +3187,7 @@ refreshSubmitState();
                     moved = False
                     for _ in range(6):  # ~300ms total
                         try:
-                            os.replace(tmp.name, filepath)
+                            os.replace(tmp_name, filepath)
                             moved = True
                             break
                         except PermissionError:
@@ -4397,7 +3198,7 @@ refreshSubmitState();
                         base, extn = os.path.splitext(safe_name)
                         unique = f"{base}-{uuid4().hex[:6]}{extn}"
                         filepath = os.path.join(UPLOAD_DIR, unique)
-                        os.replace(tmp.name, filepath)
+                        os.replace(tmp_name, filepath)
 
                 filepaths.append(filepath)
             set_progress(job, 10, step=1, label="Processing files")
@@ -4436,7 +3237,7 @@ refreshSubmitState();
             if n_files == 0:
                 return "No valid files to process", 400
 
-            per_file_tokens = [fast_token_estimate(d) for d in docs]
+            per_file_tokens = token_counts(docs)
             # --- NEW: if materials are mathematical and user didn't specify types, force all to Math ---
             # --- NEW: if materials are mathematical and user didn't specify types, set Math proportionally ---
             try:
@@ -4529,18 +3330,21 @@ refreshSubmitState();
                     "Material:\n"
                 )
 
+                batch_tpl = (
+                    "Each block below is a separate file, headed '=== [F<tag>] ==='.\n"
+                    "For EACH file, extract exactly {target_bullets} key exam points from that file only.\n"
+                    "Format: '- [F<tag>] [fact/formula/concept]' ({words_each} words each), using that file's tag\n"
+                    "Focus: definitions, formulas, processes, examples, and testable content.\n"
+                    "{style_line}\n"
+                    "Target output: ~{target_tokens} tokens total\n"
+                    "Materials:\n"
+                )
+
                 summaries = [None] * n_files
+                groups = pack_summary_batches([per_file_tokens[i] for i in indices])
                 with ThreadPoolExecutor(max_workers=K_parallel) as ex:
-                    futs = []
-                    for local_idx, doc in enumerate(docs_shuffled):
-                        original_idx = indices[local_idx]
-                        tag = original_idx + 1
-
-                        adjusted_target = adaptive_summary_length(
-                            fast_token_estimate(doc),
-                            per_file_target
-                        )
-                        max_tokens_sum = min(SUMMARY_TOKENS_HARD_MAX, int(adjusted_target * 1.35) + 120)
+                    def _submit_single(local_idx, tag):
+                        adjusted_target = adaptive_summary_length(per_file_tokens[indices[local_idx]], per_file_target)
                         prompt = prompt_tpl.format(
                             tag=tag,
                             target_bullets=target_bullets,
@@ -4548,18 +3352,56 @@ refreshSubmitState();
                             style_line=cfg["sum_style"],
                             target_tokens=adjusted_target,
                         )
+                        max_tokens_sum = min(SUMMARY_TOKENS_HARD_MAX, int(adjusted_target * 1.35) + 120)
+                        return ex.submit(get_response, prompt, docs_shuffled[local_idx], summary_model,
+                                         max_tokens_sum, cfg["sum_temp"])
 
-                        futs.append((
-                            local_idx,
-                            ex.submit(get_response, prompt, doc, summary_model, max_tokens_sum, cfg["sum_temp"])
-                        ))
-
-                    for local_idx, fut in futs:
+                    futs = []
+                    for group in groups:
+                        tags = [indices[local_idx] + 1 for local_idx in group]
+                        if len(group) == 1:
+                            futs.append((group, tags, _submit_single(group[0], tags[0])))
+                        else:
+                            targets = [adaptive_summary_length(per_file_tokens[indices[local_idx]], per_file_target)
+                                       for local_idx in group]
+                            adjusted_target = sum(targets)
+                            max_tokens_sum = min(SUMMARY_TOKENS_HARD_MAX * len(group),
+                                                 int(adjusted_target * 1.35) + 120 * len(group))
+                            prompt = batch_tpl.format(
+                                target_bullets=target_bullets,
+                                words_each=cfg["sum_words_each"],
+                                style_line=cfg["sum_style"],
+                                target_tokens=adjusted_target,
+                            )
+                            material = "\n\n".join(
+                                f"=== [F{tag}] ===\n{docs_shuffled[local_idx]}" for tag, local_idx in zip(tags, group)
+                            )
+                            futs.append((
+                                group, tags,
+                                ex.submit(get_response, prompt, material, summary_model, max_tokens_sum, cfg["sum_temp"])
+                            ))
+
+                    retries = []
+                    for group, tags, fut in futs:
                         try:
                             s = fut.result()
                         except Exception:
                             s = ""
-                        summaries[local_idx] = s or ""
+                        if len(group) == 1:
+                            summaries[group[0]] = s or ""
+                        else:
+                            per_tag = split_batched_summary(s, tags)
+                            for tag, local_idx in zip(tags, group):
+                                summaries[local_idx] = per_tag[tag]
+                                if not per_tag[tag]:
+                                    # the batched reply had nothing routable for this file: summarize it alone
+                                    retries.append((local_idx, _submit_single(local_idx, tag)))
+
+                    for local_idx, fut in retries:
+                        try:
+                            summaries[local_idx] = fut.result() or ""
+                        except Exception:
+                            summaries[local_idx] = ""
                 bullets_per_file = [parse_tagged_bullets(s) for s in summaries]
                 # NEW: randomize bullet order within each file to avoid intra-file bias
                 for blts in bullets_per_file:
@@ -4577,6 +3419,7 @@ refreshSubmitState();
             # === Main questions call ===
             # === Main questions call (Stage 6: blueprint-driven) ===
             questions_needed = len(blueprint)
+            spec_lines = precompute_spec_lines(blueprint)  # reused by both continuation prompts
 
             # Build per-item prompt (use global difficulty only if provided; per-item diffs override)
             instruction_q = get_quality_question_instruction_from_blueprint(
@@ -4633,7 +3476,8 @@ refreshSubmitState();
                         end_idx=end_missing,
                         material=text_for_main,
                         blueprint=blueprint,
-                        global_difficulty=difficulty_norm
+                        global_difficulty=difficulty_norm,
+                        spec_lines=spec_lines,
                     ),
                     "",
                     model=main_model,
@@ -4642,7 +3486,6 @@ refreshSubmitState();
                 )
                 q_items += split_numbered_items(cont)[: (questions_needed - len(q_items))]
             q_items = clamp_items(q_items, questions_needed)
-            q_items = strip_headers_from_items(q_items)
             # Upgrade trivial-looking HARD items (any type); capped to keep runtime tight
             q_items = enforce_hard_items(
                 q_items, blueprint, difficulty_norm, model=main_model, n_out_q_cap=n_out_q_cap, max_regens=2
@@ -4688,6 +3531,7 @@ refreshSubmitState();
                     end_idx=end_missing,
                     questions_text=questions,
                     blueprint=blueprint,
+                    spec_lines=spec_lines,
                 )
                 cont_a = get_response(
                     cont_a_instr,
@@ -4702,7 +3546,6 @@ refreshSubmitState();
             if len(a_items) > answers_needed:
                 a_items = a_items[:answers_needed]
 
-            a_items = strip_headers_from_items(a_items)
             # After you build a_items:
             # --- ANSWERS SANITIZE (mirror questions + new sqrt/frac fixes) ---
             # --- ANSWERS SANITIZE (simple) ---
@@ -4754,6 +3597,8 @@ refreshSubmitState();
     app.logger.info("Caps: SUMMARY %d (%d..%d), Q_IN=%d, Q_OUT=%d, A_OUT=%d",
                     RECOMMENDED_SUMMARY_TOKENS, SUMMARY_TOKENS_HARD_MIN, SUMMARY_TOKENS_HARD_MAX,
                     ALWAYS_SAFE_MAIN_Q_INPUT_CAP, TARGET_MAX_N_OUT_Q, TARGET_MAX_N_OUT_A)
+    # load the BPE encoding now rather than inside the first upload's request thread
+    app.logger.info("Token counts: %s", "tiktoken" if _token_encoder() is not None else "char heuristic")
 
     # --- Stage 15: error handlers ---
 
@@ -0,0 +1,1227 @@
+    const drop = document.getElementById('drop');
+    const downloadsCard = document.getElementById('downloadsCard');
+const dlQuestions = document.getElementById('dlQuestions');
+const dlAnswers = document.getElementById('dlAnswers');
+    const chooseBtn = document.getElementById('chooseBtn');
+    const fileInput = document.getElementById('file');
+    const fileList = document.getElementById('file-list');
+    const submitBtn = document.getElementById('submitBtn');
+    const submitSpinner = document.getElementById('submitSpinner');
+    const clearBtn = document.getElementById('clearBtn');
+    const responseEl = document.getElementById('response');
+    const manualTextEl = document.getElementById('manualText');
+    const manualCountEl = document.getElementById('manualCount');
+    const progressSection = document.getElementById('progressSection');
+const optDifficulty = document.getElementById('optDifficulty');
+const difficultyRadios = document.getElementsByName('difficulty');   // static radios, live NodeList
+const titleHelp     = document.getElementById('titleHelp');
+const advCountEl    = document.getElementById('advCount');
+    const MAX_RETRIES = 0; // Avoid hammering TPM after a 429; user can click again
+    const progressBar = document.getElementById('progressBar');
+    const titleInput = document.getElementById('title');
+const titleHint  = document.getElementById('titleHint');
+    const timeEstimate = document.getElementById('timeEstimate');
+    let qErrorArmed = false; // show question-count error only after a failed submit
+    let titleErrorArmed = false;
+    let qcountErrorArmed = false; // show qcount error only after a failed submit
+    let serverProgress = 0;      // % from backend
+  let statusInterval = null;   // polling timer
+  let currentJob = null;       // job id for this run
+  let genAbort = null;         // AbortController for /upload
+let didCancel = false;       // flag to suppress error UI on cancel
+let clearListDefault = null; // original Clear-list handler we can restore
+  const SOFT_CAP = 85;  
+    let lastProgress = 0; // ensures progress never decreases
+    let visibleProgress = 0;         // what we actually render
+let genStartTs = 0;              // when generation started
+// remember the user's global difficulty to restore later
+let savedGlobalDifficulty = null;
+const INTRO_HOLD_MS = 1800;      // ignore server jumps for the first 1.8s
+const MAX_STEP = 2.2;            // max % the bar may advance per tick
+const CATCHUP = 0.35;   
+const PROGRESS_TICK_MS = 500;    // simulation cadence; the timer is paused while the tab is hidden
+function lockUI(){
+  document.body.classList.add('ui-locked');
+
+  // Left column
+  chooseBtn.disabled = true;
+  chooseBtn.setAttribute('aria-disabled','true');
+  fileInput.disabled = true;
+  drop.setAttribute('aria-disabled','true');
+  manualTextEl.disabled = true;
+
+  // Options
+  titleInput.disabled = true;
+  qcountInput.disabled = true;
+  for (const r of difficultyRadios) r.disabled = true;
+  optDifficulty?.setAttribute('aria-disabled','true');
+
+  // Advanced: keep the <summary> clickable, but make the whole panel body inert
+  // (one attribute write instead of disabling every control; dimmed via body.ui-locked)
+  advBody.inert = true;
+
+  // DO NOT touch the Downloads links; they should remain usable.
+}
+
+function unlockUI(){
+  document.body.classList.remove('ui-locked');
+
+  // Left column
+  chooseBtn.disabled = false;
+  chooseBtn.removeAttribute('aria-disabled');
+  fileInput.disabled = false;
+  drop.removeAttribute('aria-disabled');
+  manualTextEl.disabled = false;
+  clearBtn.disabled = false;
+  clearBtn.removeAttribute('aria-disabled');
+
+  // Options
+  titleInput.disabled = false;
+  qcountInput.disabled = false;
+  for (const r of difficultyRadios) r.disabled = false;
+  optDifficulty?.removeAttribute('aria-disabled');
+
+  // Advanced controls back on; re-apply your per-question enable/disable rules
+  advBody.inert = false;
+
+  applyAdvToggles();     // respects advTopicChk/advDiffChk/advTypeChk
+  refreshSubmitState();  // re-evaluate submit availability
+}
+function swapClearToCancel(){
+  // preserve original handler if not already stored
+  if (!clearListDefault) clearListDefault = clearBtn.onclick || clearListDefaultHandler;
+
+  clearBtn.textContent = 'Cancel';
+  clearBtn.classList.remove('ghost');
+  clearBtn.classList.add('danger');
+  clearBtn.removeAttribute('aria-disabled');
+  clearBtn.disabled = false;
+  clearBtn.onclick = cancelGeneration;
+}
+
+function restoreClearAsClear(){
+  clearBtn.textContent = 'Clear list';
+  clearBtn.classList.remove('danger');
+  clearBtn.classList.add('ghost');
+  clearBtn.onclick = (clearListDefault || clearListDefaultHandler);
+  clearBtn.disabled = false;
+  clearBtn.removeAttribute('aria-disabled');
+}
+
+async function cancelGeneration(){
+  // mark intent and stop the request
+  didCancel = true;
+
+  // ask backend to stop current job (best effort)
+  try {
+    if (currentJob) {
+      await fetch('/cancel', {
+        method:'POST',
+        headers:{ 'Content-Type':'application/json' },
+        body: JSON.stringify({ job: currentJob })
+      });
+    }
+  } catch (_) {}
+
+  // abort the in-flight /upload fetch (front-end)
+  try { if (genAbort) genAbort.abort(); } catch (_) {}
+
+  // stop progress/status UI
+if (statusInterval) { clearInterval(statusInterval); statusInterval = null; }
+resetProgress();
+deactivateDownloads('Generation canceled. No files were produced.');
+
+  // UI: restore
+  restoreClearAsClear();
+  submitSpinner.style.display = 'none';
+  unlockUI();
+  setStatus('warn', 'Generation canceled. Your files and settings are preserved.');
+
+  // remove leave protection + restore title (use globals set below)
+  try { if (window._beforeUnloadHandler) window.removeEventListener('beforeunload', window._beforeUnloadHandler); } catch(_) {}
+  if (window._originalTitle) document.title = window._originalTitle;
+  window._beforeUnloadHandler = null;
+  genAbort = null;
+}
+    let files = [];
+    let progressInterval;   // setInterval handle for the progress loop
+    let progressTick = null; // tick of the active run, so it can resume when the tab is shown again
+    let startTime;
+const qcountInput = document.getElementById('qcount');
+// --- Advanced widgets model + DnD ---
+const advancedCard = document.getElementById('advancedCard');
+const advBody      = advancedCard.querySelector('.adv-body');
+const qGrid        = document.getElementById('qGrid');   // matches your HTML
+// One delegated listener per event type for every card (cards are rebuilt often)
+qGrid.addEventListener('change', (e) => {
+  const t = e.target;
+  if (t.type !== 'radio') return;
+
+  const card = t.closest('.qcard');
+  if (!card) return;
+
+  const item = advById.get(card.dataset.id);
+  if (!item) return;
+
+  if (t.name.startsWith('diff_')) {
+    item.diff = t.value;
+    scheduleRefresh();
+    return;
+  }
+  if (!t.name.startsWith('type_')) return;
+
+  item.type = t.value;
+
+  const qtypeEl = card.querySelector('.qtype');
+  if (qtypeEl) qtypeEl.textContent = `Type: ${item.type}`;
+
+  card.dataset.type = item.type || '';
+  if (!item.type) card.removeAttribute('data-type');
+  scheduleRefresh();
+});
+
+qGrid.addEventListener('input', (e) => {
+  const t = e.target;
+  if (t.tagName !== 'TEXTAREA' || !t.id.startsWith('topic_')) return;
+  const item = advById.get(t.id.slice(6));
+  if (item) item.topic = t.value;
+});
+
+let advModel = [];
+const advById = new Map();   // id -> advModel item, rebuilt by renderAdvGrid()
+// Persist any in-flight edits from the DOM into advModel (topic, per-question diff)
+function captureAdvFormState(){
+  qGrid.querySelectorAll('.qcard').forEach(card => {
+    const id = card.dataset.id;
+    const item = advById.get(id);
+    if (!item) return;
+
+    // topic
+    const t = card.querySelector(`#topic_${id}`);
+    if (t) item.topic = t.value;
+
+    // per-question difficulty
+    const d = card.querySelector(`input[name="diff_${id}"]:checked`);
+    if (d) item.diff = d.value;
+  });
+}
+let dragSrcId = null;
+
+// Pick the id generator once (randomUUID is missing outside secure contexts)
+const mkId = (typeof crypto !== 'undefined' && crypto.randomUUID)
+  ? crypto.randomUUID.bind(crypto)
+  : () => 'id_' + Math.random().toString(36).slice(2);
+// remove the other two qcountInput.addEventListener('change', ...) lines
+qcountInput.addEventListener('change', () => {
+  syncAdvToQCount();      // only rebuild when the count actually changes
+  refreshSubmitState();   // then (cheap) validation / enablement
+});
+function fillRange(id, min, max){
+  const el = document.getElementById(id);
+  const frag = document.createDocumentFragment();
+  for (let i = min; i <= max; i++){
+    const opt = document.createElement('option');
+    opt.value = String(i);
+    opt.textContent = String(i);
+    frag.appendChild(opt);
+  }
+  el.replaceChildren(frag);   // one insertion for all options
+  el.value = String(min);
+}
+
+// Replace old fillRange usage for qcount with this:
+  function populateQCountWithPlaceholder(id, min, max){
+    const el = document.getElementById(id);
+    const frag = document.createDocumentFragment();
+
+    // Placeholder option
+    const ph = document.createElement('option');
+    ph.value = '';
+    ph.textContent = 'Select';
+    ph.disabled = false;    // keep it clickable so users can open the menu
+    ph.selected = true;     // default selection
+    frag.appendChild(ph);
+
+    for (let i = min; i <= max; i++){
+      const opt = document.createElement('option');
+      opt.value = String(i);
+      opt.textContent = String(i);
+      frag.appendChild(opt);
+    }
+    el.replaceChildren(frag);   // one insertion for all options
+
+    // Ensure the placeholder is the current value
+    el.value = '';
+  }
+
+  // Populate on load
+  populateQCountWithPlaceholder('qcount', 1, 30);
+applyAdvToggles(); // already present, but safe to call here too
+refreshSubmitState();
+// Helper: parse counts safely
+    // Reuse the File (and its dedup hash) while the manual text is unchanged
+    let manualCache = { value: null, file: null, hash: null };
+    function manualTextToFile(){
+      const value = manualTextEl.value;
+      if (value === manualCache.value) return manualCache.file;
+      const text = value.trim();
+      const file = text ? new File([text], 'manual_input.txt', { type: 'text/plain' }) : null;
+      manualCache = { value, file, hash: null };
+      return file;
+    }
+    async function manualFileHash(file){
+      if (manualCache.file !== file || !manualCache.hash) {
+        const hash = await calculateFileHash(file);
+        if (manualCache.file === file) manualCache.hash = hash;
+        return hash;
+      }
+      return manualCache.hash;
+    }
+
+    function bytesToSize(bytes){
+      const u = ['B','KB','MB','GB']; let i=0, n=bytes;
+      while(n>=1024 && i<u.length-1){ n/=1024; i++; }
+      return n.toFixed(n>=10||i===0?0:1)+' '+u[i];
+    }
+
+    function allowedExtension(filename){
+      const idx = filename.lastIndexOf(".");
+      if (idx < 0) return false;
+      const ext = filename.substring(idx).toLowerCase();
+      return validExts.has(ext);
+    }
+
+    const HEX = Array.from({ length: 256 }, (_, i) => i.toString(16).padStart(2, '0'));
+    function toHex(u8){
+      let s = '';
+      for (let i = 0; i < u8.length; i++) s += HEX[u8[i]];
+      return s;
+    }
+
+    // Dedup fingerprint: small files are hashed whole; larger ones by size + first/last 64 KB
+    const HASH_EDGE = 64 * 1024;
+    async function calculateFileHash(file){
+      let buf;
+      if (file.size <= 2 * HASH_EDGE) {
+        buf = await file.arrayBuffer();
+      } else {
+        const [head, tail] = await Promise.all([
+          file.slice(0, HASH_EDGE).arrayBuffer(),
+          file.slice(file.size - HASH_EDGE).arrayBuffer(),
+        ]);
+        buf = new Uint8Array(8 + head.byteLength + tail.byteLength);
+        new DataView(buf.buffer).setFloat64(0, file.size);
+        buf.set(new Uint8Array(head), 8);
+        buf.set(new Uint8Array(tail), 8 + head.byteLength);
+      }
+      const hashBuffer = await crypto.subtle.digest('SHA-256', buf);
+      return toHex(new Uint8Array(hashBuffer));
+    }
+
+    async function fullFileHash(file){
+      return toHex(new Uint8Array(await crypto.subtle.digest('SHA-256', await file.arrayBuffer())));
+    }
+
+    // Called when two fingerprints match. Above 2*HASH_EDGE the fingerprint is only sampled,
+    // so confirm on the full bytes before treating the files as duplicates.
+    async function sameContent(a, b){
+      if (a.size !== b.size) return false;
+      if (a.size <= 2 * HASH_EDGE) return true;
+      const [ha, hb] = await Promise.all([fullFileHash(a), fullFileHash(b)]);
+      return ha === hb;
+    }
+
+    function setStatus(type, html){
+      responseEl.className = 'status show ' + type;
+      responseEl.innerHTML = html;
+    }
+
+    function clearStatus(){
+      responseEl.className = 'status';
+      responseEl.innerHTML = '';
+    }
+// True if the manual box has any non-space text (no trimmed copy of a large paste)
+const hasManualText = () => /\S/.test(manualTextEl.value);
+
+// Coalesce keystroke-driven refreshes into one per animation frame
+let refreshPending = false;
+function scheduleRefresh(){
+  if (refreshPending) return;
+  refreshPending = true;
+  requestAnimationFrame(() => {
+    refreshPending = false;
+    // unlockUI refreshes on its own; don't re-enable Submit mid-generation
+    if (!document.body.classList.contains('ui-locked')) refreshSubmitState();
+  });
+}
+function refreshSubmitState(){
+  const hasManual = hasManualText();
+  const titleVal  = titleInput.value.trim();
+  const isExam = true;
+  const qcountOK  = getQuestionCount() > 0; // true only when not on placeholder
+
+  // Enable submit when there is at least one input (files or manual).
+  // We do NOT block the button for qcount here so the user can "attempt"
+  // and then we show the red hint.
+  const hasAnyInput = (files.length > 0 || hasManual);
+  // Block submit unless required per-question radios are filled (when toggled on)
+const diffOn = !!document.getElementById('advDiffChk')?.checked;
+const typeOn = !!document.getElementById('advTypeChk')?.checked;
+const totalQs = getQuestionCount();
+
+// Count answered questions from the model (kept in sync by the qGrid listeners)
+let diffsChecked = 0, typesChecked = 0;
+if (qGrid.firstChild) {
+  for (const it of advModel) {
+    if (it.diff) diffsChecked++;
+    if (it.type) typesChecked++;
+  }
+}
+
+// You must fill the radios for whichever checklist(s) are on
+let perQuestionOK = true;
+if (diffOn) perQuestionOK = perQuestionOK && (diffsChecked === totalQs);
+if (typeOn) perQuestionOK = perQuestionOK && (typesChecked === totalQs);
+
+// Final enable/disable
+submitBtn.disabled = !(hasAnyInput && perQuestionOK);
+
+
+  // Title inline error
+  if (titleErrorArmed && !titleVal) {
+    titleHint.style.display = 'block';
+    titleInput.classList.add('invalid');
+  } else {
+    titleHint.style.display = 'none';
+    titleInput.classList.remove('invalid');
+    if (titleVal) titleErrorArmed = false;
+  }
+
+  // qcount inline hint only AFTER an attempted submit
+  const qcountHint = document.getElementById('qcountHint');
+  const qcountSel  = document.getElementById('qcount');
+  const showQErr   = qcountErrorArmed && isExam && !qcountOK;
+
+  if (qcountHint) qcountHint.style.display = showQErr ? 'block' : 'none';
+  if (qcountSel)  qcountSel.classList.toggle('invalid', showQErr);
+
+  // Keep Advanced widget count in sync with qcount
+}
+    // Rendered rows keyed by content hash; renderFiles only adds/removes the difference
+    const fileRows = new Map();
+    fileList.addEventListener('click', (e)=>{
+      const btn = e.target.closest('.file-remove');
+      if (!btn) return;
+      const hash = btn.closest('.file')?.dataset.hash;
+      const idx = files.findIndex(f => f.hash === hash);
+      if (idx > -1) {
+        files.splice(idx, 1);
+        renderFiles();
+        refreshSubmitState();
+      }
+    });
+
+    function renderFiles(){
+      const live = new Set(files.map(f => f.hash));
+      for (const [hash, row] of fileRows) {
+        if (!live.has(hash)) { row.remove(); fileRows.delete(hash); }
+      }
+
+      const frag = document.createDocumentFragment();
+      files.forEach(({file, hash})=>{
+        if (fileRows.has(hash)) return;   // already on screen
+        const item = document.createElement('div');
+        item.className = 'file';
+        item.dataset.hash = hash;
+        const ext = file.name.split('.').pop()?.toUpperCase() || '';
+        item.innerHTML = `
+          <span class="badge" aria-label="File type">${ext}</span>
+          <div class="file-main">
+            <div class="file-name" title="${file.name}">${file.name}</div>
+            <div class="file-meta">${bytesToSize(file.size)}</div>
+          </div>
+          <button class="file-remove" aria-label="Remove ${file.name}">&times;</button>
+        `;
+        fileRows.set(hash, item);
+        frag.appendChild(item);
+      });
+      fileList.appendChild(frag);   // files only ever grow at the end
+    }
+
+    async function acceptFileList(list){
+  clearStatus();
+
+  const incoming = Array.isArray(list) ? list : Array.from(list || []);
+  const seen = new Map(files.map(f => [f.hash, f.file]));   // key -> File, existing and this batch
+
+  // Hash every acceptable file concurrently; rejects resolve to null
+  const hashes = await Promise.all(incoming.map(f =>
+    (allowedExtension(f.name) && f.size <= MAX_FILE_MB*1024*1024) ? calculateFileHash(f) : null
+  ));
+
+  // Walk in drop order so status messages and dedup stay deterministic
+  for (let i = 0; i < incoming.length; i++){
+    const f = incoming[i];
+    if (!allowedExtension(f.name)){
+      setStatus('warn', `Unsupported format for <strong>${f.name}</strong>. Allowed: ${[...validExts].join(', ')}`);
+      continue;
+    }
+    if (f.size > MAX_FILE_MB*1024*1024){
+      setStatus('warn', `<strong>${f.name}</strong> is larger than ${MAX_FILE_MB} MB.`);
+      continue;
+    }
+
+    let hash = hashes[i];
+    const prior = seen.get(hash);
+    if (prior){
+      if (await sameContent(f, prior)){
+        setStatus('warn', `Duplicate content detected for <strong>${f.name}</strong>. Skipped.`);
+        continue;
+      }
+      hash = await fullFileHash(f);   // sampled fingerprints collided: key this file by its full digest
+      if (seen.has(hash)){
+        setStatus('warn', `Duplicate content detected for <strong>${f.name}</strong>. Skipped.`);
+        continue;
+      }
+    }
+
+    files.push({ file: f, hash });
+    seen.set(hash, f);
+  }
+
+  renderFiles();
+  refreshSubmitState();
+}
+
+
+    function estimateProcessingTime() {
+  const isExam = true;
+  const totalFiles = files.length + (hasManualText() ? 1 : 0);
+
+  const numQuestions = getQuestionCount();
+
+  let estimatedSeconds = 15;
+estimatedSeconds += totalFiles * 3;
+estimatedSeconds += numQuestions * 1.5;
+
+  if (estimatedSeconds < 20) return "30-45 seconds";
+  if (estimatedSeconds < 40) return "45-60 seconds";
+  if (estimatedSeconds < 60) return "60-90 seconds";
+  return "1-2 minutes";
+}
+
+    function updateProgressStep(stepNumber, status, timeText = '') {
+      const stepIcon = document.getElementById(`step${stepNumber}`);
+      const stepTime = document.getElementById(`time${stepNumber}`);
+
+      stepIcon.className = `step-icon ${status}`;
+      if (status === 'complete') {
+        stepIcon.innerHTML = '✓';
+      } else if (status === 'active') {
+        stepIcon.innerHTML = stepNumber;
+      }
+
+      if (stepTime && timeText) {
+        stepTime.textContent = timeText;
+      }
+    }
+
+    function startProgressSimulation() {
+  startTime = Date.now();
+  progressSection.classList.add('show', 'fade-in');
+    // Auto-scroll to the progress section when generation starts
+  // Wait one frame so the browser lays out the newly-shown section, then scroll.
+  requestAnimationFrame(() => {
+    // a11y: move programmatic focus to the region, without causing a second jump
+    if (!progressSection.hasAttribute('tabindex')) progressSection.setAttribute('tabindex', '-1');
+    progressSection.focus({ preventScroll: true });
+
+    // smooth scroll the section to the top of the viewport
+    progressSection.scrollIntoView({ behavior: 'smooth', block: 'start' });
+  });
+  timeEstimate.textContent = estimateProcessingTime();
+
+  let currentStep = 1;
+  let progress = 0;
+  lastProgress = 0; // reset monotonic tracker each run
+  genStartTs = Date.now();
+visibleProgress = 0;
+
+  const stepTimings = [
+    { step: 1, duration: 8000, progress: 15 },
+    { step: 2, duration: 15000, progress: 35 },
+    { step: 3, duration: 20000, progress: 70 },
+    { step: 4, duration: 8000, progress: 85 },
+    { step: 5, duration: 7000, progress: 100 }
+  ];
+
+  let stepStartTime = Date.now();
+  updateProgressStep(1, 'active');
+
+  let lastWritten = -1;
+  const tick = () => {
+    const stepElapsed = Date.now() - stepStartTime;
+
+    // Handle step transitions
+    const currentStepData = stepTimings[currentStep - 1];
+    if (currentStepData && stepElapsed >= currentStepData.duration) {
+  const stepDuration = ((Date.now() - stepStartTime) / 1000).toFixed(1);
+
+  if (currentStep < 5) {
+    // Steps 1–4 can turn green when their simulated time elapses
+    updateProgressStep(currentStep, 'complete', `${stepDuration}s`);
+    currentStep++;
+    if (currentStep <= stepTimings.length) {
+      stepStartTime = Date.now();
+      updateProgressStep(currentStep, 'active');
+    }
+  } else {
+    // Step 5 should remain BLUE (active) until the server actually finishes.
+    // Do nothing here; completeProgress() will mark it 'complete' at the real end.
+  }
+}
+
+
+    // ===== SMOOTHED HYBRID PROGRESS SECTION =====
+
+// 1) Compute simulated target for the current step
+const targetProgress = stepTimings.find(s => s.step === currentStep)?.progress || 0;
+const randomFactor = Math.random() * 5 - 2.5; // ±2.5%
+let sim = targetProgress + randomFactor;
+sim = Math.min(SOFT_CAP, sim); // SOFT_CAP = 85
+
+// 2) For the first INTRO_HOLD_MS, ignore server jumps to avoid the "sudden halfway" effect
+const now = Date.now();
+const inIntro = (now - genStartTs) < INTRO_HOLD_MS;
+
+// Goal is either calm simulation (during intro) or the higher of sim/server (after intro)
+let goal = inIntro ? Math.min(sim, SOFT_CAP) : Math.max(sim, serverProgress);
+
+// Keep the UI below 95% until the server is actually near the end
+if (serverProgress < 96) goal = Math.min(95, goal);
+
+// 3) Rate-limit toward the goal (no big jumps)
+if (goal > visibleProgress) {
+  const gap = goal - visibleProgress;                  // how far we are from where we want to be
+  const step = Math.min(MAX_STEP, Math.max(0.6, gap * CATCHUP)); // close a fraction, but cap per tick
+  visibleProgress += step;
+}
+
+// 4) Monotonic safety and render
+visibleProgress = Math.max(visibleProgress, lastProgress);
+lastProgress = visibleProgress;
+progress = visibleProgress;
+if (progress !== lastWritten) {
+  progressBar.style.width = `${progress}%`;
+  lastWritten = progress;
+}
+
+// ===== END SMOOTHED HYBRID PROGRESS SECTION =====
+
+  };
+  progressTick = tick;
+  if (!document.hidden) progressInterval = setInterval(tick, PROGRESS_TICK_MS);
+}
+
+// No wake-ups in background tabs: stop the simulation timer while hidden, resume on return
+document.addEventListener('visibilitychange', () => {
+  if (document.hidden) {
+    if (progressInterval) { clearInterval(progressInterval); progressInterval = null; }
+  } else if (progressTick && !progressInterval) {
+    progressTick();
+    progressInterval = setInterval(progressTick, PROGRESS_TICK_MS);
+  }
+});
+
+
+
+    function completeProgress() {
+      if (progressInterval) {
+        clearInterval(progressInterval);
+        progressInterval = null;
+      }
+      progressTick = null;
+      if (statusInterval) { clearInterval(statusInterval); statusInterval = null; }
+
+      // Complete all remaining steps
+      for (let i = 1; i <= 5; i++) {
+        updateProgressStep(i, 'complete');
+      }
+
+      progressBar.style.width = '100%';
+      lastProgress = 100; // <-- add this
+      visibleProgress = 100;
+
+      // Hide progress section after a brief delay
+      setTimeout(() => {
+        progressSection.classList.remove('show');
+      }, 2000);
+    }
+
+    function resetProgress() {
+      if (progressInterval) {
+        clearInterval(progressInterval);
+        progressInterval = null;
+      }
+      progressTick = null;
+      if (statusInterval) { clearInterval(statusInterval); statusInterval = null; }
+
+      progressSection.classList.remove('show');
+progressBar.style.width = '0%';
+lastProgress = 0;
+serverProgress = 0;
+visibleProgress = 0;    // <-- add
+genStartTs = 0;         // <-- add
+
+
+      // Reset all steps
+      for (let i = 1; i <= 5; i++) {
+        updateProgressStep(i, 'pending');
+        const stepIcon = document.getElementById(`step${i}`);
+        const stepTime = document.getElementById(`time${i}`);
+        stepIcon.innerHTML = i;
+        if (stepTime) stepTime.textContent = '';
+      }
+    }
+    function startStatusPolling(job) {
+  serverProgress = 0;
+  if (statusInterval) { clearInterval(statusInterval); statusInterval = null; }
+  statusInterval = setInterval(async () => {
+    try {
+      const r = await fetch(`/status?job=${encodeURIComponent(job)}`, { cache: 'no-store' });
+      if (!r.ok) return;
+      const s = await r.json();
+
+      if (typeof s.pct === 'number') {
+        serverProgress = Math.max(serverProgress, s.pct);
+      }
+      // Optional: reflect step labels in UI (kept simple here)
+      // if (s.label) { /* you could display s.label somewhere */ }
+
+      if (s.status === 'done' || serverProgress >= 100) {
+  // Let the smoothing loop take it to 100; then finalize once we're close
+  serverProgress = 100;
+  if (visibleProgress >= 99) {
+    completeProgress();
+    clearInterval(statusInterval);
+    statusInterval = null;
+  }
+}
+    } catch (e) {
+      // ignore intermittent network errors
+    }
+  }, 1000);
+}
+
+    function showDownloadsPending() {
+  downloadsCard.style.display = 'block';
+
+// reset the default helper text each run
+const help = downloadsCard.querySelector('.help');
+if (help) {
+  help.textContent = 'These will activate automatically when ready. You can keep browsing this page.';
+}
+
+// disable links + ensure each has a spinner
+[dlQuestions, dlAnswers].forEach(a => {
+  a.setAttribute('aria-disabled', 'true');
+  a.removeAttribute('href');
+  a.removeAttribute('target');
+  if (!a.querySelector('.mini-spinner')) {
+    const s = document.createElement('span');
+    s.className = 'mini-spinner';
+    s.setAttribute('aria-hidden', 'true');
+    a.prepend(s);
+  }
+});
+}
+
+function activateDownloads() {
+  // Enable & point directly at your Flask downloads
+  dlQuestions.removeAttribute('aria-disabled');
+  dlQuestions.href = '/download/questions';
+  dlQuestions.target = '_blank';
+
+  dlAnswers.removeAttribute('aria-disabled');
+  dlAnswers.href = '/download/answers';
+  dlAnswers.target = '_blank';
+
+  // Remove the little spinners now that they’re ready
+  const spinners = downloadsCard.querySelectorAll('.mini-spinner');
+  spinners.forEach(s => s.remove());
+}
+
+
+    // Drag & drop
+    ;['dragenter','dragover'].forEach(evt=>{
+      drop.addEventListener(evt, e=>{ e.preventDefault(); e.stopPropagation(); drop.classList.add('dragover'); });
+    });
+    document.getElementById('advTopicChk')?.addEventListener('change', applyAdvToggles);
+document.getElementById('advDiffChk') ?.addEventListener('change', applyAdvToggles);
+document.getElementById('advTypeChk') ?.addEventListener('change', applyAdvToggles);
+
+// Also call once on load in case Advanced is already open:
+applyAdvToggles();
+titleInput.addEventListener('input', scheduleRefresh);
+    ;['dragleave','drop'].forEach(evt=>{
+      drop.addEventListener(evt, e=>{ e.preventDefault(); e.stopPropagation(); drop.classList.remove('dragover'); });
+    });
+    drop.addEventListener('drop', e=>{
+    if (document.body.classList.contains('ui-locked')) return;
+      const dt = e.dataTransfer;
+      if (dt?.files?.length) acceptFileList(dt.files);
+    });
+
+    chooseBtn.onclick = ()=> fileInput.click();
+     fileInput.onchange = async () => {
+  const picked = Array.from(fileInput.files); // snapshot, not live
+  await acceptFileList(picked);               // wait for hashing, etc.
+  fileInput.value = '';                       // now safe to clear
+};
+
+    manualTextEl.addEventListener('input', ()=>{
+      const len = manualTextEl.value.length;
+      manualCountEl.textContent = `${len} character${len===1?'':'s'}`;
+      scheduleRefresh();
+    });
+function deactivateDownloads(reason = '') {
+  // disable links and remove any pending spinners
+  [dlQuestions, dlAnswers].forEach(a => {
+    a.setAttribute('aria-disabled', 'true');
+    a.removeAttribute('href');
+    a.removeAttribute('target');
+  });
+  const spinners = downloadsCard.querySelectorAll('.mini-spinner');
+  spinners.forEach(s => s.remove());
+
+  if (reason) {
+    const help = downloadsCard.querySelector('.help');
+    if (help) help.textContent = reason;
+  }
+}
+function clearListDefaultHandler(){
+  files = []; renderFiles();
+  manualTextEl.value = ''; manualCountEl.textContent = '0 characters';
+  qErrorArmed = false;
+  advModel = []; renderAdvGrid();    // <-- reset Advanced
+  refreshSubmitState(); clearStatus(); resetProgress();
+}
+clearListDefault = clearListDefaultHandler;   // save original
+clearBtn.onclick = clearListDefaultHandler;   // wire it up as default
+
+
+async function runGenerationOnce() {
+  clearStatus();          // no yellow boxes carried over
+  resetProgress();        // reset steps, bar, timers
+
+    // Passed validation — now proceed
+  // --- NEW: auto-open Advanced on generate ---
+    // --- NEW: auto-collapse Advanced on generate ---
+  advancedCard.open = false;
+
+  submitBtn.disabled = true;
+  submitSpinner.style.display = 'inline-block';
+lockUI();
+didCancel = false;         // new run
+swapClearToCancel();       // turn Clear into red Cancel
+  // fresh job id for a truly clean restart
+  currentJob = mkId();
+
+  // show disabled downloads each attempt for consistent UX
+  showDownloadsPending();
+
+  // leave-protection + title swap per attempt
+  const originalTitle = document.title;
+  const beforeUnloadHandler = (e)=>{ e.preventDefault(); e.returnValue=''; };
+  window.addEventListener('beforeunload', beforeUnloadHandler);
+  document.title = 'Generating… ⏳ ' + (document.getElementById('title').value || 'Mock Exam Paper');
+    window._originalTitle = originalTitle;            // expose for cancel
+window._beforeUnloadHandler = beforeUnloadHandler;
+  // start progress + backend polling
+  startProgressSimulation();
+  startStatusPolling(currentJob);
+
+  try {
+    const fd = new FormData();
+    fd.append('job', currentJob);
+
+    // files already in memory
+    files.forEach(({file})=> fd.append('file[]', file));
+
+    // optional manual text as a .txt file
+    const manualFile = manualTextToFile();
+    if (manualFile){
+      const manualHash = await manualFileHash(manualFile);   // same fingerprint as uploads
+       const twin = files.find(f => f.hash === manualHash);
+ if (!twin || !(await sameContent(manualFile, twin.file))) {
+   fd.append('file[]', manualFile);
+ }
+    }
+
+    fd.append('qcount', qcountInput.value || '1');
+// Keep legacy fields at 0 so backend doesn’t choke (until server supports qcount)
+fd.append('long',  '0');
+fd.append('short', '0');
+fd.append('mcq',   '0');
+fd.append('math',  '0');
+    fd.append('title', document.getElementById('title').value || 'Mock Exam Paper');
+    fd.append('mode', 'exam');
+    let chosenDifficulty = '';
+const perQuestionDiff = document.getElementById('advDiffChk')?.checked;
+
+if (!perQuestionDiff) {
+  chosenDifficulty = (document.querySelector('input[name="difficulty"]:checked') || {}).value || 'medium';
+}
+// If per-question is on, we intentionally send an empty string (no global difficulty)
+fd.append('difficulty', chosenDifficulty);
+// Per-question overrides
+const topicsOn = document.getElementById('advTopicChk')?.checked;
+const diffOn   = document.getElementById('advDiffChk')?.checked;
+const typeOn   = document.getElementById('advTypeChk')?.checked;
+
+if (advModel.length) {
+  if (typeOn) {
+    const types = advModel.map(it => {
+      const sel = document.querySelector(`input[name="type_${it.id}"]:checked`);
+      return sel ? sel.value : '';
+    });
+    fd.append('q_types', JSON.stringify(types));
+  }
+  if (topicsOn) {
+    const topics = advModel.map(it => {
+      const inp = document.getElementById(`topic_${it.id}`);
+      return inp ? inp.value.trim() : '';
+    });
+    fd.append('q_topics', JSON.stringify(topics));
+  }
+  if (diffOn) {
+    const diffs = advModel.map(it => {
+      const sel = document.querySelector(`input[name="diff_${it.id}"]:checked`);
+      return sel ? sel.value : '';
+    });
+    fd.append('q_diffs', JSON.stringify(diffs));
+  }
+}
+
+    genAbort = new AbortController();
+const res = await fetch('/upload', { method:'POST', body: fd, signal: genAbort.signal });
+    const text = await res.text();
+
+    if (!res.ok) {
+      // fail this attempt cleanly so caller can restart from the top
+      throw new Error(text || 'Generation failed');
+    }
+
+    // success path
+    completeProgress();
+    activateDownloads();
+    setStatus('ok', 'Your PDFs are ready. Use the buttons below to download.');
+
+    // cleanup after success
+    files = []; renderFiles();
+    qErrorArmed = false;
+    refreshSubmitState();
+
+    return { ok: true };
+  } catch (e) {
+  // ensure UI is clean for a full restart (progress reset handled by cancelGeneration if used)
+  if (!didCancel) {
+  resetProgress();
+  clearStatus();
+  deactivateDownloads('Generation failed. No files were produced.');
+}
+  if (e && (e.name === 'AbortError' || didCancel)) {
+    return { ok: false, canceled: true };
+  }
+  return { ok: false, error: e?.message || 'Network error.' };
+}
+ finally {
+ restoreClearAsClear();  // always put the Clear button back
+genAbort = null;
+    // per-attempt cleanup
+    if (statusInterval) { clearInterval(statusInterval); statusInterval = null; }
+    window.removeEventListener('beforeunload', beforeUnloadHandler);
+    document.title = originalTitle;
+    submitSpinner.style.display = 'none';
+    unlockUI();
+    submitBtn.disabled = (files.length === 0 && !hasManualText());
+  }
+}
+/** Render the Advanced grid from advModel; renumber 1..N every time. */
+function getQuestionCount(){
+  const v = (qcountInput.value || '').trim();
+  if (!v) return 0; // placeholder not chosen
+  const n = parseInt(v, 10);
+  return Number.isNaN(n) ? 0 : Math.max(1, n);
+}
+function syncAdvToQCount(){
+  const N = getQuestionCount();
+
+  // shrink
+  if (advModel.length > N) {
+    advModel = advModel.slice(0, N);
+  }
+  // grow
+  while (advModel.length < N) {
+  advModel.push({ id: mkId(), topic: '', type: '', diff: '' });
+}
+
+  renderAdvGrid();
+}
+function applyAdvToggles(){
+  const topicsOn = document.getElementById('advTopicChk')?.checked;
+  const diffOn   = document.getElementById('advDiffChk')?.checked;
+  const typeOn   = document.getElementById('advTypeChk')?.checked;
+
+  // Topic inputs
+  document.querySelectorAll('.qopt-topic').forEach(box=>{
+    box.classList.toggle('is-disabled', !topicsOn);
+    const inp = box.querySelector('textarea');
+    if (inp) inp.disabled = !topicsOn;
+  });
+
+  // Difficulty radios (per-question)
+  document.querySelectorAll('.qopt-diff').forEach(box=>{
+    box.classList.toggle('is-disabled', !diffOn);
+    box.querySelectorAll('input[type="radio"]').forEach(r=> r.disabled = !diffOn);
+  });
+
+  // Type radios
+  document.querySelectorAll('.qopt-type').forEach(box=>{
+    box.classList.toggle('is-disabled', !typeOn);
+    box.querySelectorAll('input[type="radio"]').forEach(r=> r.disabled = !typeOn);
+  });
+
+  // --- Global difficulty (Options tab) ---
+  const optDiffGroup  = optDifficulty;
+  const globalRadios  = difficultyRadios;
+
+  if (diffOn) {
+    // Save current selection ONCE when turning per-question on
+    if (savedGlobalDifficulty === null) {
+      const sel = Array.from(globalRadios).find(r => r.checked);
+      savedGlobalDifficulty = sel ? sel.value : null;
+    }
+    // Visually blank + lock the group while per-question is active
+    globalRadios.forEach(r => { r.checked = false; r.disabled = true; });
+    optDiffGroup?.setAttribute('aria-disabled','true');
+    optDiffGroup?.classList.add('is-disabled');
+  } else {
+    // Re-enable the group
+    globalRadios.forEach(r => { r.disabled = false; });
+    optDiffGroup?.removeAttribute('aria-disabled');
+    optDiffGroup?.classList.remove('is-disabled');
+
+    // ✅ Only restore a value if we previously saved one
+    if (savedGlobalDifficulty !== null) {
+      const target = Array.from(globalRadios).find(r => r.value === savedGlobalDifficulty);
+      if (target) {
+        Array.from(globalRadios).forEach(r => r.checked = false);
+        target.checked = true;
+      }
+      savedGlobalDifficulty = null; // clear stash after restoring
+    }
+    // 🔒 No "default to medium" here; leave user’s choice untouched.
+  }
+  // Re-check submit availability whenever toggles change
+refreshSubmitState();
+}
+function renderAdvGrid() {
+  const isExam = true;
+  const qcount  = getQuestionCount();
+  // Persist current input values before we wipe/rebuild the grid
+  captureAdvFormState();
+  advById.clear();
+  for (const it of advModel) advById.set(it.id, it);
+
+  // Advanced is only usable in exam mode AND when qcount is chosen
+  if (!isExam || qcount === 0) {
+    advancedCard.classList.add('adv-disabled');
+    advancedCard.style.display = isExam ? 'block' : 'none'; // show disabled header in exam mode
+    advancedCard.removeAttribute('open');                   // can't open
+    const emptyEl = document.getElementById('advEmpty');
+    if (emptyEl) emptyEl.style.display = isExam ? 'block' : 'none';
+    if (advCountEl) advCountEl.textContent = isExam ? 'Select a number' : '';
+    qGrid.innerHTML = '';
+    return;
+  }
+
+  // From here, Advanced is enabled and may open/close
+  advancedCard.classList.remove('adv-disabled');
+  advancedCard.style.display = 'block';
+
+  qGrid.innerHTML = '';
+  const count = advModel.length;
+
+  // show/hide the whole Advanced card
+  const emptyEl = document.getElementById('advEmpty');
+  if (!count) {
+    if (emptyEl) emptyEl.style.display = 'block';
+    if (advCountEl) advCountEl.textContent = '';
+    advancedCard.removeAttribute('open'); // keep it closed by default
+    return;
+  }
+
+  if (emptyEl) emptyEl.style.display = 'none';
+  if (advCountEl) advCountEl.textContent = `${count} question${count === 1 ? '' : 's'}`;
+
+  advModel.forEach((item, idx) => {
+    const el = document.createElement('div');
+    el.className = 'qcard';
+    el.dataset.id = item.id;
+    el.setAttribute('draggable', 'true');
+
+    el.innerHTML = `
+  <div class="qhead">
+    <div class="qleft">
+      <div class="qbadge" aria-label="Question ${idx+1}">${idx+1}</div>
+      <div class="qmeta">
+        <div class="qtitle">Question ${idx+1}</div>
+        <div class="qtype muted">Type: ${item.type || 'N/A'}</div>
+      </div>
+    </div>
+  </div>
+
+  <div class="qopts" role="group" aria-label="Options for question ${idx+1}">
+    <div class="qrow">
+      <!-- a) Topic -->
+      <div class="qopt qopt-topic is-disabled">
+        <label for="topic_${item.id}">Additional instructions:</label>
+        <textarea id="topic_${item.id}" placeholder="e.g. Make this a multi-part question about the periodic table" disabled maxlength="200" rows="3"></textarea>
+
+      </div>
+
+      <!-- b) Difficulty -->
+      <div class="qopt qopt-diff is-disabled">
+        <label>Difficulty</label>
+        <div class="pill-group" role="radiogroup" aria-label="Difficulty">
+          <label class="pill"><input type="radio" name="diff_${item.id}" value="easy"   disabled> Easy</label>
+          <label class="pill"><input type="radio" name="diff_${item.id}" value="medium" disabled> Medium</label>
+          <label class="pill"><input type="radio" name="diff_${item.id}" value="hard"   disabled> Hard</label>
+        </div>
+      </div>
+
+      <!-- c) Type -->
+      <div class="qopt qopt-type is-disabled">
+        <label>Question type</label>
+        <div class="pill-group" role="radiogroup" aria-label="Question type">
+          <label class="pill"><input type="radio" name="type_${item.id}" value="Long"  ${item.type==='Long'  ? 'checked' : ''} disabled> Long</label>
+          <label class="pill"><input type="radio" name="type_${item.id}" value="Short" ${item.type==='Short' ? 'checked' : ''} disabled> Short</label>
+          <label class="pill"><input type="radio" name="type_${item.id}" value="MCQ"   ${item.type==='MCQ'   ? 'checked' : ''} disabled> MCQ</label>
+          <label class="pill"><input type="radio" name="type_${item.id}" value="Math"  ${item.type==='Math'  ? 'checked' : ''} disabled> Math</label>
+        </div>
+      </div>
+    </div>
+  </div>
+`;
+// Restore Topic value (kept synced by the delegated qGrid 'input' listener)
+const topicInput = el.querySelector(`#topic_${item.id}`);
+if (topicInput) topicInput.value = item.topic || '';
+
+// Restore per-question Difficulty (kept synced by the delegated qGrid 'change' listener)
+if (item.diff) {
+  const d = el.querySelector(`input[name="diff_${item.id}"][value="${item.diff}"]`);
+  if (d) d.checked = true;
+}
+if (item.type) {
+  el.dataset.type = item.type;     // enables your .qcard[data-type="…"] badge tint
+} else {
+  el.removeAttribute('data-type');
+}
+    el.addEventListener('dragstart', (e) => {
+      dragSrcId = item.id;
+      el.classList.add('dragging');
+      e.dataTransfer.effectAllowed = 'move';
+      e.dataTransfer.setData('text/plain', dragSrcId);
+    });
+    el.addEventListener('dragend', () => {
+      dragSrcId = null;
+      el.classList.remove('dragging');
+      qGrid.querySelectorAll('.drop-target').forEach(n => n.classList.remove('drop-target'));
+    });
+    el.addEventListener('dragover', (e) => { e.preventDefault(); e.dataTransfer.dropEffect = 'move'; });
+    el.addEventListener('dragenter', () => { if (el.dataset.id !== dragSrcId) el.classList.add('drop-target'); });
+    el.addEventListener('dragleave', () => { el.classList.remove('drop-target'); });
+    el.addEventListener('drop', (e) => {
+      e.preventDefault();
+      const src = e.dataTransfer.getData('text/plain') || dragSrcId;
+const tgt = el.dataset.id;
+if (!src || !tgt || src === tgt) return;
+const i = advModel.findIndex(x => x.id === src);
+const j = advModel.findIndex(x => x.id === tgt);
+if (i < 0 || j < 0) return;
+
+// NEW: persist any typed values before we mutate advModel
+captureAdvFormState();
+
+[advModel[i], advModel[j]] = [advModel[j], advModel[i]];
+renderAdvGrid();
+    });
+
+    qGrid.appendChild(el);
+  });
+
+  // Enable/disable per the three checkboxes
+  applyAdvToggles();
+  refreshSubmitState();
+}
+    async function submitFiles(){
+  clearStatus();
+  resetProgress();
+
+  const isExam = true;
+  const titleVal = titleInput.value.trim();
+  const qcountOK = getQuestionCount() > 0;
+
+  // Validate BEFORE disabling button / showing spinner
+  if (!titleVal) {
+    titleErrorArmed = true;
+    refreshSubmitState();
+    return;
+  }
+
+  if (isExam && !qcountOK) {
+    qcountErrorArmed = true;       // arm the red complaint now
+    refreshSubmitState();          // shows the red hint + invalid border
+    document.getElementById('qcount').focus();
+    return;
+  }
+
+  // Passed validation — now proceed
+  submitBtn.disabled = true;
+  submitSpinner.style.display = 'inline-block';
+// Hard-stop if total questions is 0 (extra safety)
+
+// --- auto-retry wrapper ---
+let attempt = 0;
+let result;
+
+do {
+  attempt++;
+  result = await runGenerationOnce();
+  if (result.ok) break; // success, stop retrying
+} while (attempt <= MAX_RETRIES);
+
+// If still failing after retries, show one final error box (not the inline field hints)
+if (!result.ok) {
+  if (result.canceled) {
+    // user canceled: no error box
+  } else {
+    setStatus(
+      'err',
+      `Sorry, we couldn't complete your generation${
+        MAX_RETRIES ? ` after ${attempt} attempt(s)` : ''
+      }. Please try again later.`
+    );
+  }
+}
+    }
+
+    submitBtn.onclick = submitFiles;
+
+    // Keyboard activation for drop area
+    drop.addEventListener('keydown', e=>{
+      if (e.key === 'Enter' || e.key === ' ') { e.preventDefault(); fileInput.click(); }
+    });
+    renderAdvGrid();
+refreshSubmitState();